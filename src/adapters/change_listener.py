@@ -0,0 +1,123 @@
+"""
+Подписка на события об изменениях таблиц, которые шлют триггеры БД через NOTIFY (см. mappings.listen_for_changes).
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import asyncpg
+
+from adapters.mappings import CHANGES_CHANNEL
+
+
+@dataclass(frozen=True)
+class ChangeEvent:
+    table: str
+    op: str
+    version: int
+    key: Optional[str] = None
+    old_key: Optional[str] = None
+
+    @property
+    def keys(self) -> List[str]:
+        """Значения ключа строки до и после изменения"""
+        return [key for key in (self.key, self.old_key) if key is not None]
+
+
+ChangeHandler = Callable[[ChangeEvent], Awaitable[None]]
+ResetHandler = Callable[[], Awaitable[None]]
+
+
+class ChangeListener:
+    """
+    Держит отдельное соединение с LISTEN и вызывает обработчики, подписанные на таблицы, по порядку поступления.
+    События, пришедшие, пока соединения не было, потеряны, поэтому после каждого (пере)подключения вызываются
+    обработчики сброса - они должны очистить кэши целиком. version - наибольшая из полученных версий.
+    """
+
+    def __init__(self, dsn: str, channel: str = CHANGES_CHANNEL, reconnect_delay: float = 1):
+        self.dsn = dsn
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.version = 0
+        self._handlers: Dict[str, List[ChangeHandler]] = defaultdict(list)
+        self._reset_handlers: List[ResetHandler] = []
+        self._queue: asyncio.Queue[Optional[ChangeEvent]] = asyncio.Queue()
+        self._connection: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.connected = asyncio.Event()
+
+    def __repr__(self) -> str:
+        return f"ChangeListener(channel={self.channel}, version={self.version})"
+
+    def subscribe(self, table: str, handler: ChangeHandler) -> None:
+        self._handlers[table].append(handler)
+
+    def on_reset(self, handler: ResetHandler) -> None:
+        self._reset_handlers.append(handler)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+        self.connected.clear()
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            self._queue.put_nowait(ChangeEvent(**json.loads(payload)))
+        except (ValueError, TypeError) as e:
+            logging.warning(f"Непонятное событие в канале {channel}: {payload} ({e})")
+
+    def _on_termination(self, connection) -> None:
+        self._queue.put_nowait(None)
+
+    async def _connect(self) -> asyncpg.Connection:
+        while True:
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                connection.add_termination_listener(self._on_termination)
+                await connection.add_listener(self.channel, self._on_notification)
+                return connection
+            except (OSError, asyncpg.PostgresError) as e:
+                logging.warning(f"Не удалось подписаться на {self.channel}, повтор через {self.reconnect_delay} с: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _run(self) -> None:
+        while True:
+            self._connection = await self._connect()
+            await self._dispatch_reset()
+            self.connected.set()
+            while (change := await self._queue.get()) is not None:
+                await self._dispatch(change)
+            self.connected.clear()
+            logging.warning(f"Соединение с подпиской на {self.channel} потеряно, переподключаемся")
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _dispatch(self, change: ChangeEvent) -> None:
+        self.version = max(self.version, change.version)
+        for handler in self._handlers.get(change.table, []):
+            try:
+                await handler(change)
+            except Exception:
+                logging.exception(f"Ошибка в обработчике события {change}")
+
+    async def _dispatch_reset(self) -> None:
+        for handler in self._reset_handlers:
+            try:
+                await handler()
+            except Exception:
+                logging.exception("Ошибка в обработчике сброса кэшей")
@@ -1,27 +1,66 @@
+from typing import Optional
+
 from sqlalchemy import create_engine
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import clear_mappers
 
 from adapters.mappings import get_mapper_registry
 from configs.settings import PGSettings
 
+_engine_async: Optional[AsyncEngine] = None
+_session_factory: Optional[async_sessionmaker[AsyncSession]] = None
+
+
+def get_engine_async() -> AsyncEngine:
+    """Возвращает общий на процесс движок, создавая его при первом обращении"""
+    global _engine_async
+    if _engine_async is None:
+        settings = PGSettings()
+        _engine_async = create_async_engine(
+            settings.db_connection_async(),
+            isolation_level="READ COMMITTED",
+            pool_size=settings.PG_POOL_SIZE,
+            max_overflow=settings.PG_MAX_OVERFLOW,
+            pool_recycle=settings.PG_POOL_RECYCLE,
+            pool_pre_ping=settings.PG_POOL_PRE_PING,
+            # echo=True
+        )
+    return _engine_async
 
-def get_engine_async():
-    return create_async_engine(
-        PGSettings().db_connection_async(),
-        isolation_level="REPEATABLE READ",
-        # echo=True
-    )
+
+def get_session_factory() -> async_sessionmaker[AsyncSession]:
+    """Возвращает общую на процесс фабрику сессий, привязанную к общему движку"""
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = async_sessionmaker(
+            bind=get_engine_async(),
+            expire_on_commit=False,
+        )
+    return _session_factory
+
+
+async def dispose_engine_async() -> None:
+    """Закрывает пул соединений. Следующее обращение к БД создаст движок заново"""
+    global _engine_async, _session_factory
+    if _engine_async is not None:
+        await _engine_async.dispose()
+    _engine_async = None
+    _session_factory = None
 
 
 def get_engine_sync():
     return create_engine(
         PGSettings().db_connection_sync(),
-        isolation_level="REPEATABLE READ",
+        isolation_level="READ COMMITTED",
         # echo=True
     )
 
 
+def start_mappers() -> None:
+    """Маппинг классов на таблицы без создания схемы: при запуске бота и воркера схему создают миграции"""
+    get_mapper_registry()
+
+
 def start_db_sync():
     mapper_registry = get_mapper_registry()
     engine = get_engine_sync()
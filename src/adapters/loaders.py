@@ -0,0 +1,49 @@
+"""
+Профили загрузки связей. В маппинге все связи lazy="raise", поэтому обращение к незагруженной связи
+падает сразу, а не тянет полбазы. Репозиторий принимает профиль и превращает его в опции загрузчика
+для своей сущности: каждый сценарий загружает ровно то, что читает.
+"""
+from enum import StrEnum
+from typing import Optional
+
+from sqlalchemy.orm import selectinload, joinedload
+
+from domain.models import Visitor, Resource, Record, OldRecord
+
+
+class LoadProfile(StrEnum):
+    # Брони стейджа или посетителя, текущие и будущие из них считаются по as_of в Python
+    dashboard = "dashboard"
+    # Бронь вместе с ресурсом и посетителем - отмена и проверка прав
+    booking = "booking"
+    # Прошлые брони вместе с ресурсом и посетителем
+    history = "history"
+    # Брони вместе с посетителем, которому нужно написать
+    notification = "notification"
+
+
+def _get_profiles() -> dict:
+    # Атрибуты связей появляются у классов только после маппинга, поэтому опции строятся при вызове
+    return {
+        LoadProfile.dashboard: {
+            Resource: [selectinload(Resource.records)],
+            Visitor: [selectinload(Visitor.records)],
+        },
+        LoadProfile.booking: {
+            Record: [joinedload(Record.resource), joinedload(Record.visitor)],
+            Resource: [joinedload(Resource.category)],
+        },
+        LoadProfile.history: {
+            OldRecord: [joinedload(OldRecord.resource), joinedload(OldRecord.visitor)],
+        },
+        LoadProfile.notification: {
+            Record: [joinedload(Record.visitor)],
+        },
+    }
+
+
+def get_loader_options(entity: type, profile: Optional[LoadProfile]) -> list:
+    """Опции загрузчика для entity по профилю. Без профиля связи не загружаются"""
+    if profile is None:
+        return []
+    return _get_profiles()[profile].get(entity, [])
@@ -1,3 +1,7 @@
+import re
+from datetime import datetime as dt, timezone as tz
+from typing import Optional
+
 from sqlalchemy import (
     Table,
     Column,
@@ -5,36 +9,61 @@ from sqlalchemy import (
     String,
     Boolean,
     DateTime,
-    MetaData, Identity, ForeignKey, text,
+    MetaData, Identity, ForeignKey, text, DDL, event, func, Index, literal_column, ColumnElement, select,
 )
-from sqlalchemy.orm import registry, relationship
+from sqlalchemy.dialects.postgresql import ExcludeConstraint
+from sqlalchemy.orm import registry, relationship, column_property
 
 from domain.models import Visitor, Resource, Record, Category, OldRecord
-from helpers.helpers import get_time_now
+
+# Колонки ресурса, по которым работает поиск
+RESOURCE_SEARCH_COLUMNS = ("name", "external_id", "comment", "address")
+
+
+def get_resource_search_document(columns) -> ColumnElement:
+    """
+    Склеивает колонки ресурса, по которым работает поиск, в одну строку. По ней построен триграммный
+    GIN-индекс (pg_trgm), который ускоряет и ILIKE '%...%', и нечеткое сравнение %>. Выражение в запросе
+    должно совпадать с индексным, поэтому в нем только константы, без параметров
+    """
+    separator, empty = literal_column("' '"), literal_column("''")
+    document = func.coalesce(getattr(columns, RESOURCE_SEARCH_COLUMNS[0]), empty)
+    for column in RESOURCE_SEARCH_COLUMNS[1:]:
+        document = document.op("||")(separator).op("||")(func.coalesce(getattr(columns, column), empty))
+    return document
 
 
 def get_resource_table(metadata: MetaData):
-    return Table(
+    table = Table(
         "resource",
         metadata,
-        Column("resource_id", Integer, Identity(start=1, increment=1), nullable=False),
-        Column("name", String, nullable=False, primary_key=True),
+        Column("resource_id", Integer, Identity(start=1, increment=1), primary_key=True, nullable=False),
+        Column("name", String, nullable=False, unique=True),
         Column("category_name", ForeignKey("category.name", onupdate="cascade", ondelete="cascade"), nullable=False),
         Column("external_id", String),
         Column("comment", String),
         Column("address", String),
         Column("created_at", DateTime(timezone=True), server_default=text("TIMEZONE('utc', now())")),
         Column("updated_at", DateTime(timezone=True), server_default=text("TIMEZONE('utc', now())"),
-               onupdate=text("TIMEZONE('utc', now())"))
+               onupdate=text("TIMEZONE('utc', now())")),
+        # И фильтр по категории, и сортировка по имени для постраничного вывода
+        Index("resource_category_name_name_idx", "category_name", "name"),
     )
+    table.append_constraint(Index(
+        "resource_search_trgm_idx", get_resource_search_document(table.c).label("search_document"),
+        postgresql_using="gin", postgresql_ops={"search_document": "gin_trgm_ops"}
+    ))
+    event.listen(table, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    listen_for_changes(table)
+    return table
 
 
 def get_visitor_table(metadata: MetaData):
-    return Table(
+    table = Table(
         "visitor",
         metadata,
-        Column("visitor_id", Integer, Identity(start=1, increment=1), nullable=False),
-        Column("email", String, primary_key=True, nullable=False),
+        Column("visitor_id", Integer, Identity(start=1, increment=1), primary_key=True, nullable=False),
+        Column("email", String, nullable=False, unique=True),
         Column("is_admin", Boolean, default=False),
         Column("external_id", Integer, unique=True),
         Column("chat_id", Integer, unique=True),
@@ -45,39 +74,140 @@ def get_visitor_table(metadata: MetaData):
         Column("updated_at", DateTime(timezone=True), server_default=text("TIMEZONE('utc', now())"),
                onupdate=text("TIMEZONE('utc', now())"))
     )
+    listen_for_changes(table, key_column="external_id")
+    return table
+
+
+RECORD_PERIOD_EXCLUDE_CONSTRAINT = "record_resource_id_period_excl"
+
+
+CHANGES_CHANNEL = "cache_invalidation"
+CHANGE_VERSION_SEQUENCE = "change_event_version_seq"
+
+CREATE_CHANGE_VERSION_SEQUENCE = DDL(f"CREATE SEQUENCE IF NOT EXISTS {CHANGE_VERSION_SEQUENCE}")
+# Событие об изменении таблицы: {"table", "op", "version"} и, для построчных триггеров, "key" - значение колонки,
+# имя которой передано аргументом триггера. Если UPDATE поменял это значение, прежнее передается в "old_key".
+# Версия берется из общей последовательности и только растет
+CREATE_NOTIFY_CHANGE_FUNCTION = DDL(f"""
+    CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+    DECLARE
+        payload jsonb := jsonb_build_object(
+            'table', TG_TABLE_NAME, 'op', TG_OP, 'version', nextval('{CHANGE_VERSION_SEQUENCE}')
+        );
+    BEGIN
+        IF TG_LEVEL = 'ROW' AND TG_NARGS > 0 THEN
+            payload := payload || jsonb_build_object(
+                'key', (CASE WHEN TG_OP = 'DELETE' THEN to_jsonb(OLD) ELSE to_jsonb(NEW) END) ->> TG_ARGV[0]
+            );
+            IF TG_OP = 'UPDATE' AND (to_jsonb(OLD) ->> TG_ARGV[0]) IS DISTINCT FROM (to_jsonb(NEW) ->> TG_ARGV[0]) THEN
+                payload := payload || jsonb_build_object('old_key', to_jsonb(OLD) ->> TG_ARGV[0]);
+            END IF;
+        END IF;
+        PERFORM pg_notify('{CHANGES_CHANNEL}', payload::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+""")
+
+
+def get_notify_change_trigger(table_name: str, key_column: Optional[str] = None) -> DDL:
+    """Без key_column - одно событие на запрос, с ним - событие на каждую измененную строку"""
+    if key_column is None:
+        return DDL(f"CREATE TRIGGER {table_name}_notify_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                   f"ON {table_name} FOR EACH STATEMENT EXECUTE FUNCTION notify_change()")
+    return DDL(f"CREATE TRIGGER {table_name}_notify_change AFTER INSERT OR UPDATE OR DELETE "
+               f"ON {table_name} FOR EACH ROW EXECUTE FUNCTION notify_change('{key_column}')")
+
+
+def listen_for_changes(table: Table, key_column: Optional[str] = None) -> None:
+    """Вешает на таблицу триггер, который сообщает об изменениях в канал CHANGES_CHANNEL"""
+    event.listen(table, "before_create", CREATE_CHANGE_VERSION_SEQUENCE)
+    event.listen(table, "before_create", CREATE_NOTIFY_CHANGE_FUNCTION)
+    event.listen(table, "after_create", get_notify_change_trigger(table.name, key_column))
+
+
+def get_record_period(take_date, return_date):
+    """Период брони как tstzrange с включенными границами - так же, как пересечение проверялось раньше в коде"""
+    return func.tstzrange(take_date, return_date, text("'[]'"))
 
 
 def get_record_table(metadata: MetaData):
-    return Table(
+    table = Table(
         "record",
         metadata,
         Column("record_id", Integer, Identity(start=1, increment=1), primary_key=True, nullable=False),
-        Column("resource_name", ForeignKey("resource.name", onupdate="cascade", ondelete="cascade"),
-               nullable=False),
-        Column("email", ForeignKey("visitor.email", onupdate="cascade", ondelete="cascade"), nullable=False),
+        Column("resource_id", ForeignKey("resource.resource_id", ondelete="cascade"), nullable=False),
+        Column("visitor_id", ForeignKey("visitor.visitor_id", ondelete="cascade"), nullable=False),
         Column("take_date", DateTime(timezone=True)),
         Column("return_date", DateTime(timezone=True)),
         Column("enqueue_date", DateTime(timezone=True)),
         Column("created_at", DateTime(timezone=True), server_default=text("TIMEZONE('utc', now())")),
         Column("updated_at", DateTime(timezone=True), server_default=text("TIMEZONE('utc', now())"),
                onupdate=text("TIMEZONE('utc', now())")),
+        # Две брони одного ресурса не могут пересекаться по времени. Записи очереди (без take_date) не проверяем
+        ExcludeConstraint(
+            ("resource_id", "="),
+            (get_record_period(text("take_date"), text("return_date")), "&&"),
+            name=RECORD_PERIOD_EXCLUDE_CONSTRAINT,
+            using="gist",
+            where=text("take_date IS NOT NULL"),
+        ),
+        Index("record_resource_id_take_date_idx", "resource_id", "take_date"),
+        Index("record_visitor_id_take_date_idx", "visitor_id", "take_date"),
+        Index("record_return_date_idx", "return_date"),
     )
+    # Для "=" по числу в gist-индексе нужно расширение btree_gist
+    event.listen(table, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+    listen_for_changes(table)
+    return table
+
+
+OLD_RECORD_DEFAULT_PARTITION = "old_record_default"
+OLD_RECORD_PARTITION_PATTERN = re.compile(r"^old_record_y(\d{4})m(\d{2})$")
+
+
+def get_old_record_partition_name(month: dt) -> str:
+    """Имя месячного раздела истории: old_record_y2026m10 - брони, возвращенные в октябре 2026 (UTC)"""
+    return f"old_record_y{month.year:04d}m{month.month:02d}"
+
+
+def parse_old_record_partition_name(name: str) -> Optional[dt]:
+    """Начало месяца раздела истории по его имени. Для раздела по умолчанию и чужих таблиц - None"""
+    match = OLD_RECORD_PARTITION_PATTERN.match(name)
+    if match is None:
+        return None
+    return dt(year=int(match.group(1)), month=int(match.group(2)), day=1, tzinfo=tz.utc)
+
+
+def is_old_record_partition(name: str) -> bool:
+    """Разделы создаются не из метаданных, а воркером - миграциям их сравнивать не с чем"""
+    return name == OLD_RECORD_DEFAULT_PARTITION or parse_old_record_partition_name(name) is not None
 
 
 def get_old_record_table(metadata: MetaData):
-    return Table(
+    table = Table(
         "old_record",
         metadata,
         Column("record_id", Integer, primary_key=True, nullable=False),
-        Column("resource_name", ForeignKey("resource.name", onupdate="cascade", ondelete="cascade"),
-               nullable=False),
-        Column("email", ForeignKey("visitor.email", onupdate="cascade", ondelete="cascade"), nullable=False),
+        Column("resource_id", ForeignKey("resource.resource_id", ondelete="cascade"), nullable=False),
+        Column("visitor_id", ForeignKey("visitor.visitor_id", ondelete="cascade"), nullable=False),
         Column("take_date", DateTime(timezone=True)),
-        Column("return_date", DateTime(timezone=True)),
+        # Ключ разделов. Первичный ключ секционированной таблицы обязан его включать
+        Column("return_date", DateTime(timezone=True), primary_key=True, nullable=False),
         Column("enqueue_date", DateTime(timezone=True)),
         Column("created_at", DateTime(timezone=True)),
         Column("updated_at", DateTime(timezone=True)),
+        Index("old_record_resource_id_take_date_idx", "resource_id", "take_date"),
+        Index("old_record_visitor_id_take_date_idx", "visitor_id", "take_date"),
+        # Месячные разделы по return_date: запрос с границей по дате читает только нужные месяцы,
+        # а месяцы старше срока хранения отцепляются целиком, без DELETE
+        postgresql_partition_by="RANGE (return_date)",
     )
+    # Сюда попадают строки месяцев, для которых воркер еще не создал раздел
+    event.listen(table, "after_create", DDL(
+        f"CREATE TABLE IF NOT EXISTS {OLD_RECORD_DEFAULT_PARTITION} PARTITION OF old_record DEFAULT"
+    ))
+    return table
 
 
 def get_category_table(metadata: MetaData):
@@ -91,6 +221,21 @@ def get_category_table(metadata: MetaData):
     )
 
 
+def get_record_projections(table: Table, resource: Table, visitor: Table) -> dict:
+    """
+    resource_name и email брони - только для чтения: в таблице лежат целочисленные resource_id и visitor_id,
+    а имя ресурса и почта посетителя подтягиваются подзапросом по их первичным ключам
+    """
+    return {
+        "resource_name": column_property(
+            select(resource.c.name).where(resource.c.resource_id == table.c.resource_id).scalar_subquery()
+        ),
+        "email": column_property(
+            select(visitor.c.email).where(visitor.c.visitor_id == table.c.visitor_id).scalar_subquery()
+        ),
+    }
+
+
 def get_empty_metadata() -> MetaData:
     return MetaData(naming_convention={
         "ix": "%(column_0_label)s_idx",
@@ -101,14 +246,29 @@ def get_empty_metadata() -> MetaData:
     })
 
 
+def get_metadata() -> MetaData:
+    """Схема БД без маппинга классов - для миграций"""
+    metadata = get_empty_metadata()
+    get_category_table(metadata)
+    get_visitor_table(metadata)
+    get_resource_table(metadata)
+    get_record_table(metadata)
+    get_old_record_table(metadata)
+    return metadata
+
+
 def get_mapper_registry():
+    """
+    Маппинг классов на таблицы. Связи по умолчанию не загружаются (lazy="raise"): каждый сценарий
+    подгружает только то, что читает, через профиль загрузки из adapters/loaders.py
+    """
     mapper_registry = registry(metadata=get_empty_metadata())
     category = get_category_table(mapper_registry.metadata)
     category_mapper = mapper_registry.map_imperatively(
         Category,
         category,
         properties={
-            "resources": relationship("Resource", back_populates="category", lazy="selectin")
+            "resources": relationship("Resource", back_populates="category", lazy="raise")
         }
     )
     visitor = get_visitor_table(mapper_registry.metadata)
@@ -116,61 +276,32 @@ def get_mapper_registry():
         Visitor,
         visitor,
         properties={
-            "records": relationship("Record", back_populates="visitor", lazy="selectin"),
-            "old_records": relationship("OldRecord", back_populates="visitor", lazy="selectin"),
-            "future_records": relationship(
-                "Record",
-                back_populates="visitor",
-                lazy="selectin",
-                primaryjoin="and_(Visitor.email == Record.email, Record.take_date > func.now())",
-                order_by="Record.take_date.asc()",
-            ),
-            "take_records": relationship(
-                "Record",
-                back_populates="visitor",
-                lazy="selectin",
-                primaryjoin="and_(Visitor.email == Record.email, Record.take_date <= func.now())",
-                order_by="Record.take_date.asc()",
-            ),
+            "records": relationship("Record", back_populates="visitor", lazy="raise"),
+            "old_records": relationship("OldRecord", back_populates="visitor", lazy="raise"),
             "queue_records": relationship(
                 "Record",
                 back_populates="visitor",
-                lazy="selectin",
-                primaryjoin="and_(Visitor.email == Record.email, Record.enqueue_date != None)",
+                lazy="raise",
+                primaryjoin="and_(Visitor.visitor_id == Record.visitor_id, Record.enqueue_date != None)",
                 order_by="Record.enqueue_date.asc()",
             ),
         }
     )
     resource = get_resource_table(mapper_registry.metadata)
-    time = get_time_now()
     resource_mapper = mapper_registry.map_imperatively(
         Resource,
         resource,
         properties={
-            "category": relationship("Category", back_populates="resources", lazy="joined", uselist=False),
-            "old_records": relationship("OldRecord", back_populates="resource", lazy="selectin"),
-            "records": relationship("Record", back_populates="resource", lazy="selectin"),
+            "category": relationship("Category", back_populates="resources", lazy="raise", uselist=False),
+            "old_records": relationship("OldRecord", back_populates="resource", lazy="raise"),
+            "records": relationship("Record", back_populates="resource", lazy="raise"),
             "queue_records": relationship(
                 "Record",
                 back_populates="resource",
-                lazy="selectin",
-                primaryjoin="and_(Resource.name == Record.resource_name, Record.enqueue_date != None)",
+                lazy="raise",
+                primaryjoin="and_(Resource.resource_id == Record.resource_id, Record.enqueue_date != None)",
                 order_by="Record.enqueue_date.asc()",
             ),
-            "future_records": relationship(
-                "Record",
-                back_populates="resource",
-                lazy="selectin",
-                primaryjoin="and_(Resource.name == Record.resource_name, Record.take_date > func.now())",
-                order_by="Record.take_date.asc()",
-            ),
-            "take_record": relationship(
-                "Record",
-                back_populates="resource",
-                lazy="selectin",
-                primaryjoin="and_(Resource.name == Record.resource_name, Record.take_date <= func.now())",
-                uselist=False
-            ),
         }
     )
     record = get_record_table(mapper_registry.metadata)
@@ -178,9 +309,10 @@ def get_mapper_registry():
         Record,
         record,
         properties={
-            "resource": relationship("Resource", back_populates="records", lazy="joined", uselist=False,
+            **get_record_projections(record, resource, visitor),
+            "resource": relationship("Resource", back_populates="records", lazy="raise", uselist=False,
                                      single_parent=True),
-            "visitor": relationship("Visitor", back_populates="records", lazy="joined", uselist=False,
+            "visitor": relationship("Visitor", back_populates="records", lazy="raise", uselist=False,
                                     single_parent=True),
         }
     )
@@ -188,10 +320,13 @@ def get_mapper_registry():
     old_record_mapper = mapper_registry.map_imperatively(
         OldRecord,
         old_record,
+        # return_date в первичном ключе таблицы только из-за разделов, запись определяет record_id
+        primary_key=[old_record.c.record_id],
         properties={
-            "resource": relationship("Resource", back_populates="old_records", lazy="joined", uselist=False,
+            **get_record_projections(old_record, resource, visitor),
+            "resource": relationship("Resource", back_populates="old_records", lazy="raise", uselist=False,
                                      single_parent=True),
-            "visitor": relationship("Visitor", back_populates="old_records", lazy="joined", uselist=False,
+            "visitor": relationship("Visitor", back_populates="old_records", lazy="raise", uselist=False,
                                     single_parent=True),
         }
     )
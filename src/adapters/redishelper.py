@@ -0,0 +1,22 @@
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from configs.settings import RedisConfig
+
+_redis: Optional[Redis] = None
+
+
+def get_redis() -> Redis:
+    """Возвращает общий на процесс клиент Redis (с пулом соединений), создавая его при первом обращении"""
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(RedisConfig().get_connection_str())
+    return _redis
+
+
+async def close_redis() -> None:
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+    _redis = None
@@ -1,17 +1,131 @@
 import datetime
+import json
 from abc import ABC
 from abc import abstractmethod
 from datetime import datetime as dt
 from datetime import timedelta as td
 from datetime import timezone as tz
-from typing import Optional, List
+from collections import defaultdict
+from typing import Optional, List, Tuple, Dict, AsyncIterator
 
-from sqlalchemy import or_, select
+from sqlalchemy import or_, and_, select, delete, func, case, Row, Select, tuple_, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.sql.operators import ilike_op, and_
-
-from domain.models import Visitor, Resource, Record, Category, OldRecord
-from helpers.helpers import get_time_now
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.util import identity_key
+
+from adapters.loaders import LoadProfile, get_loader_options
+from adapters.mappings import RECORD_PERIOD_EXCLUDE_CONSTRAINT, get_record_period, get_resource_search_document, \
+    OLD_RECORD_DEFAULT_PARTITION, get_old_record_partition_name, parse_old_record_partition_name
+from domain.models import Visitor, Resource, Record, Category, OldRecord, Page, split_take_and_future, \
+    split_started_and_future
+from helpers.helpers import get_time_now, get_month_start
+
+
+# Больше параметров asyncpg в одном запросе не передаст
+MAX_IN_PARAMETERS = 30000
+# resource_id - integer, большее число не может быть айди
+MAX_INT4 = 2 ** 31 - 1
+# До стольких строк по оценке планировщика количество для пагинатора считается точно
+EXACT_COUNT_LIMIT = 10000
+# Столько строк выгрузки истории читается с серверного курсора за раз
+EXPORT_CHUNK_SIZE = 1000
+# Отметка в session.info: в транзакции менялись брони или ресурсы, после фиксации нужна новая версия расписания.
+# Изменения через ORM и DML-запросы отмечает UnitOfWork, а DML внутри CTE select-запроса - сам репозиторий
+SCHEDULE_CHANGED = "schedule_changed"
+
+
+async def _get_many(session: AsyncSession, entity: type, column, keys: list, by_primary_key: bool = True) -> list:
+    """
+    Загружает сущности по значениям column одним запросом с IN и возвращает их в порядке keys,
+    с None на месте ненайденных. При поиске по первичному ключу объекты, уже загруженные в сессию,
+    берутся из identity map без запроса - как в session.get
+    """
+    found = dict()
+    if by_primary_key:
+        for key in keys:
+            obj = session.identity_map.get(identity_key(entity, key))
+            if obj is not None:
+                found[key] = obj
+    missing = list(dict.fromkeys(key for key in keys if key not in found))
+    for start in range(0, len(missing), MAX_IN_PARAMETERS):
+        result = await session.execute(select(entity).where(column.in_(missing[start:start + MAX_IN_PARAMETERS])))
+        for obj in result.scalars().unique():
+            found[getattr(obj, column.key)] = obj
+    return [found.get(key) for key in keys]
+
+
+async def _get(session: AsyncSession, entity: type, column, key, profile: Optional[LoadProfile],
+               by_primary_key: bool = True):
+    """
+    session.get с профилем загрузки. Объект из identity map session.get вернул бы без опций,
+    поэтому с профилем идет запрос: он догрузит связи, которых у объекта в сессии еще нет.
+    По колонке, которая не первичный ключ, всегда идет запрос
+    """
+    options = get_loader_options(entity, profile)
+    if not options and by_primary_key:
+        return await session.get(entity, key)
+    result = await session.execute(select(entity).where(column == key).options(*options))
+    return result.scalars().unique().first()
+
+
+async def _get_keyset_page(session: AsyncSession, query: Select, keys: list, id_column, limit: int,
+                           after: Optional[int] = None, before: Optional[int] = None,
+                           descending: bool = False) -> Page:
+    """
+    Выбирает одну страницу query по ключу сортировки keys (keyset-пагинация): вместо OFFSET условие
+    (keys) > (ключ объекта after) или (keys) < (ключ объекта before), поэтому цена страницы не растет
+    с ее номером. Курсор - айди объекта (id_column), ключ сортировки по нему берется отдельным запросом.
+    Если объект-курсор уже удален, возвращается первая страница
+    """
+    forward = before is None
+    cursor = after if forward else before
+    cursor_key = None
+    if cursor is not None:
+        cursor_key = (await session.execute(select(*keys).where(id_column == cursor))).first()
+    if cursor_key is None:
+        forward = True
+    else:
+        key, cursor_value = tuple_(*keys), tuple_(*cursor_key)
+        query = query.where(key > cursor_value if forward != descending else key < cursor_value)
+    ascending = forward != descending
+    query = query.order_by(*[i.asc() if ascending else i.desc() for i in keys]).limit(limit + 1)
+    items = list((await session.execute(query)).scalars().unique().all())
+    has_more = len(items) > limit
+    items = items[:limit]
+    if not forward:
+        items.reverse()
+    return Page(
+        items=items,
+        has_previous=cursor_key is not None if forward else has_more,
+        has_next=has_more if forward else True,
+        first_key=getattr(items[0], id_column.key) if items else None,
+        last_key=getattr(items[-1], id_column.key) if items else None,
+    )
+
+
+async def _count_approximately(session: AsyncSession, query: Select) -> int:
+    """
+    Оценивает количество строк query по плану запроса (EXPLAIN) без его выполнения.
+    Если оценка не больше EXACT_COUNT_LIMIT, считает точно - на небольших выборках это дешево
+    """
+    compiled = query.order_by(None).compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True})
+    connection = await session.connection()
+    plan = (await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+    estimate = int((json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]["Plan Rows"])
+    if estimate > EXACT_COUNT_LIMIT:
+        return estimate
+    return await session.scalar(select(func.count()).select_from(query.order_by(None).subquery()))
+
+
+def _get_resource_id(name: str):
+    """resource_id по имени подзапросом: брони фильтруются по целочисленному ключу и его индексам"""
+    return select(Resource.resource_id).where(Resource.name == name).scalar_subquery()
+
+
+def _get_visitor_id(email: str):
+    """visitor_id по почте подзапросом: брони фильтруются по целочисленному ключу и его индексам"""
+    return select(Visitor.visitor_id).where(Visitor.email == email).scalar_subquery()
 
 
 class IRepository(ABC):
@@ -35,7 +149,7 @@ class IRepository(ABC):
 
 class AbstractOldRecordRepository(IRepository):
     @abstractmethod
-    async def get(self, record_primary_key) -> Optional[OldRecord]:
+    async def get(self, record_primary_key, profile: Optional[LoadProfile] = None) -> Optional[OldRecord]:
         raise NotImplemented
 
     @abstractmethod
@@ -50,22 +164,73 @@ class AbstractOldRecordRepository(IRepository):
     async def delete(self, record) -> None:
         raise NotImplemented
 
+    @abstractmethod
+    async def get_page_by_email(self, email: str, since: dt, limit: int, after: Optional[int] = None,
+                                before: Optional[int] = None) -> Page:
+        raise NotImplemented
+
+    @abstractmethod
+    async def count_by_email(self, email: str, since: dt) -> int:
+        raise NotImplemented
+
+    @abstractmethod
+    async def list_by_email(self, email: str, since: dt, profile: Optional[LoadProfile] = None) -> List[OldRecord]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def list_by_resource_name(self, resource_name: str, since: dt,
+                                    profile: Optional[LoadProfile] = None) -> List[OldRecord]:
+        raise NotImplemented
+
+    @abstractmethod
+    def stream_export(self, since: dt, until: dt, email: Optional[str] = None, resource_name: Optional[str] = None,
+                      chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[List[Row]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_partitions(self) -> Dict[str, Optional[dt]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def create_partition(self, month: dt) -> bool:
+        raise NotImplemented
+
+    @abstractmethod
+    async def detach_partitions_before(self, until: dt, drop: bool = False) -> List[str]:
+        raise NotImplemented
+
 
 class AbstractRecordRepository(IRepository):
     @abstractmethod
-    async def get(self, record_primary_key) -> Optional[Record]:
+    async def get(self, record_primary_key, profile: Optional[LoadProfile] = None) -> Optional[Record]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_expiring(self, days_before_now: int, profile: Optional[LoadProfile] = None) -> List[Record]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def archive_expired(self, as_of: dt) -> List[Row]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_expiring_notifications(self, expire_after_days: int) -> List[Row]:
         raise NotImplemented
 
     @abstractmethod
-    async def get_expiring(self, days_before_now: int) -> List[Record]:
+    async def add_if_free(self, record: Record) -> Optional[Record]:
         raise NotImplemented
 
     @abstractmethod
-    async def get_expired(self) -> List[Record]:
+    async def get_overlapping(self, resource_name: str, since: dt, until: dt) -> Optional[Record]:
         raise NotImplemented
 
     @abstractmethod
-    async def list(self) -> List[Record]:
+    async def get_expired(self, profile: Optional[LoadProfile] = None) -> List[Record]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def list(self, profile: Optional[LoadProfile] = None) -> List[Record]:
         raise NotImplemented
 
     @abstractmethod
@@ -76,18 +241,34 @@ class AbstractRecordRepository(IRepository):
     async def delete(self, record) -> None:
         raise NotImplemented
 
+    @abstractmethod
+    async def get_many(self, record_ids: List[int]) -> List[Optional[Record]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_take_and_future(self, resource_name: str, as_of: dt) -> Tuple[Optional[Record], List[Record]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_take_and_future_by_resource(self, as_of: dt) -> Dict[int, Tuple[Optional[Record], List[Record]]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_take_and_future_for_visitor(self, email: str, as_of: dt) -> Tuple[List[Record], List[Record]]:
+        raise NotImplemented
+
 
 class AbstractResourceRepository(IRepository):
     @abstractmethod
-    async def get(self, resource_primary_key) -> Optional[Resource]:
+    async def get(self, resource_primary_key, profile: Optional[LoadProfile] = None) -> Optional[Resource]:
         raise NotImplemented
 
     @abstractmethod
-    async def get_by_id(self, resource_id) -> Optional[Resource]:
+    async def get_by_id(self, resource_id, profile: Optional[LoadProfile] = None) -> Optional[Resource]:
         raise NotImplemented
 
     @abstractmethod
-    async def list(self) -> List[Resource]:
+    async def list(self, profile: Optional[LoadProfile] = None) -> List[Resource]:
         raise NotImplemented
 
     @abstractmethod
@@ -102,18 +283,52 @@ class AbstractResourceRepository(IRepository):
     async def search(self, search_key, limit: Optional[int] = None) -> List[Resource]:
         raise NotImplemented
 
+    @abstractmethod
+    async def get_schedule_summary(self, as_of: dt) -> List[Row]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_many(self, names: List[str]) -> List[Optional[Resource]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_many_by_ids(self, resource_ids: List[int]) -> List[Optional[Resource]]:
+        raise NotImplemented
+
+    @abstractmethod
+    async def get_page_in_category(self, category_name: str, limit: int, after: Optional[int] = None,
+                                   before: Optional[int] = None) -> Page:
+        raise NotImplemented
+
+    @abstractmethod
+    async def count_in_category(self, category_name: str) -> int:
+        raise NotImplemented
+
+    @abstractmethod
+    async def search_page(self, search_key: str, limit: int, after: Optional[int] = None,
+                          before: Optional[int] = None) -> Page:
+        raise NotImplemented
+
+    @abstractmethod
+    async def count_search(self, search_key: str) -> int:
+        raise NotImplemented
+
 
 class AbstractVisitorRepository(IRepository):
     @abstractmethod
-    async def get(self, visitor_primary_key) -> Optional[Visitor]:
+    async def get(self, visitor_primary_key, profile: Optional[LoadProfile] = None) -> Optional[Visitor]:
         raise NotImplemented
 
     @abstractmethod
-    async def get_by_external_id(self, visitor_external_id) -> Visitor:
+    async def get_by_external_id(self, visitor_external_id, profile: Optional[LoadProfile] = None) -> Visitor:
         raise NotImplemented
 
     @abstractmethod
-    async def list(self) -> List[Visitor]:
+    async def exists_by_external_id(self, visitor_external_id) -> bool:
+        raise NotImplemented
+
+    @abstractmethod
+    async def list(self, profile: Optional[LoadProfile] = None) -> List[Visitor]:
         raise NotImplemented
 
     @abstractmethod
@@ -124,6 +339,10 @@ class AbstractVisitorRepository(IRepository):
     async def delete(self, visitor) -> None:
         raise NotImplemented
 
+    @abstractmethod
+    async def get_many(self, emails: List[str]) -> List[Optional[Visitor]]:
+        raise NotImplemented
+
 
 class AbstractCategoryRepository(IRepository):
     @abstractmethod
@@ -142,6 +361,10 @@ class AbstractCategoryRepository(IRepository):
     async def delete(self, category) -> None:
         raise NotImplemented
 
+    @abstractmethod
+    async def get_many(self, names: List[str]) -> List[Optional[Category]]:
+        raise NotImplemented
+
 
 class OldRecordRepository(AbstractOldRecordRepository):
     def __init__(self, session: AsyncSession):
@@ -150,8 +373,8 @@ class OldRecordRepository(AbstractOldRecordRepository):
     def add(self, record: Record) -> None:
         old_record = OldRecord(
             record_id=record.record_id,
-            email=record.email,
-            resource_name=record.resource_name,
+            resource_id=record.resource_id,
+            visitor_id=record.visitor_id,
             take_date=record.take_date,
             return_date=record.return_date,
             enqueue_date=record.enqueue_date,
@@ -160,8 +383,8 @@ class OldRecordRepository(AbstractOldRecordRepository):
         )
         self.session.add(old_record)
 
-    async def get(self, record_id: int) -> Optional[OldRecord]:
-        return await self.session.get(OldRecord, record_id)
+    async def get(self, record_id: int, profile: Optional[LoadProfile] = None) -> Optional[OldRecord]:
+        return await _get(self.session, OldRecord, OldRecord.record_id, record_id, profile)
 
     async def list(self) -> List[OldRecord]:
         result = await self.session.execute(select(OldRecord))
@@ -170,6 +393,116 @@ class OldRecordRepository(AbstractOldRecordRepository):
     async def delete(self, record: OldRecord) -> None:
         await self.session.delete(record)
 
+    async def get_page_by_email(self, email: str, since: dt, limit: int, after: Optional[int] = None,
+                                before: Optional[int] = None) -> Page:
+        """История посетителя, возвращенная не раньше since, страницами от последних броней к первым"""
+        return await _get_keyset_page(
+            self.session,
+            select(OldRecord).where(OldRecord.visitor_id == _get_visitor_id(email), OldRecord.return_date >= since),
+            keys=[OldRecord.take_date, OldRecord.record_id], id_column=OldRecord.record_id,
+            limit=limit, after=after, before=before, descending=True
+        )
+
+    async def count_by_email(self, email: str, since: dt) -> int:
+        return await _count_approximately(
+            self.session,
+            select(OldRecord.record_id).where(OldRecord.visitor_id == _get_visitor_id(email),
+                                              OldRecord.return_date >= since)
+        )
+
+    async def list_by_email(self, email: str, since: dt, profile: Optional[LoadProfile] = None) -> List[OldRecord]:
+        return await self._list_since(OldRecord.visitor_id == _get_visitor_id(email), since, profile)
+
+    async def list_by_resource_name(self, resource_name: str, since: dt,
+                                    profile: Optional[LoadProfile] = None) -> List[OldRecord]:
+        return await self._list_since(OldRecord.resource_id == _get_resource_id(resource_name), since, profile)
+
+    async def _list_since(self, condition, since: dt, profile: Optional[LoadProfile]) -> List[OldRecord]:
+        """Брони, возвращенные не раньше since. По этой границе планировщик отбрасывает разделы старых месяцев"""
+        result = await self.session.execute(
+            select(OldRecord)
+            .where(condition, OldRecord.return_date >= since)
+            .order_by(OldRecord.take_date, OldRecord.record_id)
+            .options(*get_loader_options(OldRecord, profile))
+        )
+        return result.scalars().unique().all()
+
+    async def stream_export(self, since: dt, until: dt, email: Optional[str] = None,
+                            resource_name: Optional[str] = None,
+                            chunk_size: int = EXPORT_CHUNK_SIZE) -> AsyncIterator[List[Row]]:
+        """
+        История, возвращенная с since до until, пачками по chunk_size строк с серверного курсора:
+        в памяти одновременно только одна пачка. Это строки, а не ORM-объекты - они не копятся в сессии,
+        а имя ресурса и почта берутся соединением, а не подзапросом на каждую строку
+        """
+        query = (
+            select(
+                OldRecord.record_id,
+                Resource.name.label("resource_name"),
+                Visitor.email.label("email"),
+                OldRecord.take_date,
+                OldRecord.return_date,
+                OldRecord.enqueue_date,
+            )
+            .join(Resource, Resource.resource_id == OldRecord.resource_id)
+            .join(Visitor, Visitor.visitor_id == OldRecord.visitor_id)
+            .where(OldRecord.return_date >= since, OldRecord.return_date < until)
+            .order_by(OldRecord.return_date, OldRecord.record_id)
+        )
+        if email is not None:
+            query = query.where(OldRecord.visitor_id == _get_visitor_id(email))
+        if resource_name is not None:
+            query = query.where(OldRecord.resource_id == _get_resource_id(resource_name))
+        result = await self.session.stream(query.execution_options(yield_per=chunk_size))
+        async for rows in result.partitions():
+            yield rows
+
+    async def get_partitions(self) -> Dict[str, Optional[dt]]:
+        """Разделы old_record и начало их месяца. У раздела по умолчанию месяца нет"""
+        result = await self.session.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = 'old_record'::regclass"
+        ))
+        return {name: parse_old_record_partition_name(name) for name in result.scalars()}
+
+    async def create_partition(self, month: dt) -> bool:
+        """
+        Создает раздел истории за месяц, который начинается с month. Строки этого месяца, уже попавшие
+        в раздел по умолчанию, переносятся в новый раздел - иначе PostgreSQL не даст его подключить.
+        Возвращает False, если раздел уже есть
+        """
+        name = get_old_record_partition_name(month)
+        if name in await self.get_partitions():
+            return False
+        since, until = month.isoformat(), get_month_start(month, 1).isoformat()
+        await self.session.execute(text(f"CREATE TABLE {name} (LIKE old_record INCLUDING DEFAULTS)"))
+        await self.session.execute(text(
+            f"WITH moved AS ("
+            f"DELETE FROM {OLD_RECORD_DEFAULT_PARTITION} WHERE return_date >= :since AND return_date < :until "
+            f"RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ), {"since": month, "until": get_month_start(month, 1)})
+        await self.session.execute(text(
+            f"ALTER TABLE old_record ATTACH PARTITION {name} FOR VALUES FROM ('{since}') TO ('{until}')"
+        ))
+        return True
+
+    async def detach_partitions_before(self, until: dt, drop: bool = False) -> List[str]:
+        """
+        Отцепляет от old_record месячные разделы, которые целиком раньше until: они остаются отдельными
+        таблицами, а с drop=True удаляются. Возвращает их имена
+        """
+        partitions = await self.get_partitions()
+        names = sorted(name for name, month in partitions.items()
+                       if month is not None and get_month_start(month, 1) <= until)
+        for name in names:
+            if drop:
+                await self.session.execute(text(f"DROP TABLE {name}"))
+            else:
+                await self.session.execute(text(f"ALTER TABLE old_record DETACH PARTITION {name}"))
+        return names
+
 
 class RecordRepository(AbstractRecordRepository):
     def __init__(self, session: AsyncSession):
@@ -178,40 +511,180 @@ class RecordRepository(AbstractRecordRepository):
     def add(self, record: Record) -> None:
         self.session.add(record)
 
-    async def get(self, record_id: int) -> Optional[Record]:
-        return await self.session.get(Record, record_id)
+    async def get(self, record_id: int, profile: Optional[LoadProfile] = None) -> Optional[Record]:
+        return await _get(self.session, Record, Record.record_id, record_id, profile)
+
+    async def get_many(self, record_ids: List[int]) -> List[Optional[Record]]:
+        return await _get_many(self.session, Record, Record.record_id, record_ids)
+
+    async def add_if_free(self, record: Record) -> Optional[Record]:
+        """
+        Вставляет запись одним запросом. Если бронь пересекается с другой бронью ресурса,
+        exclusion constraint не дает ее вставить и метод возвращает None.
+        Запись читается из CTE вставки, чтобы в том же запросе подтянуть resource_name и email
+        """
+        inserted = (
+            insert(Record)
+            .values(
+                resource_id=record.resource_id,
+                visitor_id=record.visitor_id,
+                take_date=record.take_date,
+                return_date=record.return_date,
+                enqueue_date=record.enqueue_date,
+            )
+            .on_conflict_do_nothing(constraint=RECORD_PERIOD_EXCLUDE_CONSTRAINT)
+            .returning(*Record.__table__.c)
+            .cte("inserted")
+        )
+        result = await self.session.execute(select(aliased(Record, inserted)))
+        record = result.scalars().first()
+        if record is not None:
+            self.session.info[SCHEDULE_CHANGED] = True
+        return record
+
+    async def get_overlapping(self, resource_name: str, since: dt, until: dt) -> Optional[Record]:
+        """Ищет бронь ресурса, пересекающуюся с периодом. Запрос идет по gist-индексу exclusion constraint"""
+        result = await self.session.execute(
+            select(Record).filter(
+                Record.resource_id == _get_resource_id(resource_name),
+                Record.take_date.is_not(None),
+                get_record_period(Record.take_date, Record.return_date).op("&&")(get_record_period(since, until)),
+            ).limit(1)
+        )
+        return result.scalars().first()
 
-    async def get_expired(self) -> List[Record]:
-        result = await self.session.execute(select(Record).filter(Record.return_date <= get_time_now()))
+    async def get_expired(self, profile: Optional[LoadProfile] = None) -> List[Record]:
+        result = await self.session.execute(
+            select(Record).filter(Record.return_date <= get_time_now()).options(*get_loader_options(Record, profile))
+        )
         return result.scalars().unique().all()
 
-    async def get_expiring(self, expire_after_days: int) -> List[Record]:
-        result = await self.session.execute(select(Record).filter(
-            # Бронь заканчивается завтра
-            and_(
-                Record.return_date > get_time_now(),
-                Record.return_date <= dt.combine(get_time_now() + td(days=expire_after_days),
-                                                 datetime.time.max, tz.utc),
-            )
-        ))
+    async def get_expiring(self, expire_after_days: int, profile: Optional[LoadProfile] = None) -> List[Record]:
+        result = await self.session.execute(
+            select(Record).filter(_expiring_filter(expire_after_days)).options(*get_loader_options(Record, profile))
+        )
         return result.scalars().unique().all()
 
-    async def list(self) -> List[Record]:
-        result = await self.session.execute(select(Record))
+    async def archive_expired(self, as_of: dt) -> List[Row]:
+        """
+        Одним запросом переносит истекшие брони в old_record (DELETE ... RETURNING -> INSERT ... SELECT)
+        и возвращает перенесенные записи вместе с телеграмом посетителя для уведомлений
+        """
+        columns = ["record_id", "resource_id", "visitor_id", "take_date", "return_date", "enqueue_date",
+                   "created_at", "updated_at"]
+        moved = (
+            delete(Record)
+            .where(Record.return_date <= as_of)
+            .returning(*[getattr(Record, column) for column in columns])
+            .cte("moved")
+        )
+        archived = (
+            insert(OldRecord)
+            .from_select(columns, select(*[moved.c[column] for column in columns]))
+            .returning(OldRecord.record_id, OldRecord.resource_id, OldRecord.visitor_id, OldRecord.take_date,
+                       OldRecord.return_date)
+            .cte("archived")
+        )
+        result = await self.session.execute(
+            select(
+                archived.c.record_id,
+                Resource.name.label("resource_name"),
+                archived.c.take_date,
+                archived.c.return_date,
+                Visitor.external_id,
+            )
+            .join(Resource, Resource.resource_id == archived.c.resource_id)
+            .join(Visitor, Visitor.visitor_id == archived.c.visitor_id)
+            .order_by(archived.c.return_date)
+        )
+        rows = result.all()
+        if rows:
+            self.session.info[SCHEDULE_CHANGED] = True
+        return rows
+
+    async def get_expiring_notifications(self, expire_after_days: int) -> List[Row]:
+        """Брони, которые скоро закончатся, вместе с телеграмом посетителя - одним запросом"""
+        result = await self.session.execute(
+            _select_notifications().filter(_expiring_filter(expire_after_days))
+        )
+        return result.all()
+
+    async def get_take_and_future(self, resource_name: str, as_of: dt) -> Tuple[Optional[Record], List[Record]]:
+        """
+        Текущая и будущие брони ресурса на момент as_of - одним запросом по индексу (resource_id, take_date).
+        Делит их та же функция, что и загруженный список resource.records
+        """
+        result = await self.session.execute(
+            select(Record)
+            .where(Record.resource_id == _get_resource_id(resource_name), _current_and_future_filter(as_of))
+            .order_by(Record.take_date)
+        )
+        return split_take_and_future(result.scalars().all(), as_of)
+
+    async def get_take_and_future_by_resource(self, as_of: dt) -> Dict[int, Tuple[Optional[Record], List[Record]]]:
+        """То же для всех ресурсов сразу, одним запросом, по resource_id. Ресурсов без броней в словаре нет"""
+        result = await self.session.execute(
+            select(Record).where(_current_and_future_filter(as_of)).order_by(Record.resource_id, Record.take_date)
+        )
+        records_by_resource = defaultdict(list)
+        for record in result.scalars():
+            records_by_resource[record.resource_id].append(record)
+        return {name: split_take_and_future(records, as_of) for name, records in records_by_resource.items()}
+
+    async def get_take_and_future_for_visitor(self, email: str, as_of: dt) -> Tuple[List[Record], List[Record]]:
+        """Начатые и будущие брони посетителя на момент as_of - одним запросом по индексу (visitor_id, take_date)"""
+        result = await self.session.execute(
+            select(Record)
+            .where(Record.visitor_id == _get_visitor_id(email), Record.take_date.is_not(None))
+            .order_by(Record.take_date)
+        )
+        return split_started_and_future(result.scalars().all(), as_of)
+
+    async def list(self, profile: Optional[LoadProfile] = None) -> List[Record]:
+        result = await self.session.execute(select(Record).options(*get_loader_options(Record, profile)))
         return result.scalars().unique().all()
 
     async def delete(self, record: Record) -> None:
         await self.session.delete(record)
 
 
-def _prepare_filters_for_strings(fields: list[str], search_key: str, limit: Optional[int] = 1000) -> list:
-    """Готовит фильтры для поиска по тексту"""
-    search_filter = list()
-    for field in fields:
-        search_filter.append(ilike_op(field, f"%{search_key}%"))
-        search_filter.append(ilike_op(field, f"%{search_key.capitalize()}%"))
-        search_filter.append(ilike_op(field, f"%{search_key.upper()}%"))
-    return search_filter
+def _current_and_future_filter(as_of: dt):
+    """Брони ресурса, начиная с текущей на момент as_of: более ранние уже ни текущие, ни будущие"""
+    earlier = aliased(Record)
+    current_take_date = (
+        select(func.max(earlier.take_date))
+        .where(earlier.resource_id == Record.resource_id, earlier.take_date <= as_of)
+        .scalar_subquery()
+    )
+    return Record.take_date >= func.coalesce(current_take_date, as_of)
+
+
+def _expiring_filter(expire_after_days: int):
+    # Бронь заканчивается в ближайшие expire_after_days дней (до конца последнего дня)
+    return and_(
+        Record.return_date > get_time_now(),
+        Record.return_date <= dt.combine(get_time_now() + td(days=expire_after_days), datetime.time.max, tz.utc),
+    )
+
+
+def _select_notifications():
+    return (
+        select(
+            Record.record_id,
+            Resource.name.label("resource_name"),
+            Record.take_date,
+            Record.return_date,
+            Visitor.external_id,
+        )
+        .join(Resource, Resource.resource_id == Record.resource_id)
+        .join(Visitor, Visitor.visitor_id == Record.visitor_id)
+        .order_by(Record.return_date)
+    )
+
+
+def _escape_like(search_key: str) -> str:
+    """Экранирует спецсимволы LIKE, чтобы % и _ в запросе искались как обычные символы"""
+    return search_key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
 
 class ResourceRepository(AbstractResourceRepository):
@@ -221,39 +694,161 @@ class ResourceRepository(AbstractResourceRepository):
     def add(self, resource: Resource) -> None:
         self.session.add(resource)
 
-    async def get_by_id(self, resource_id: int) -> Optional[Resource]:
-        result = await self.session.execute(select(Resource).filter_by(resource_id=resource_id))
-        resources = result.scalars().unique().all()
-        if len(resources) == 0:
-            return None
-        else:
-            return resources[0]
+    async def get_by_id(self, resource_id: int, profile: Optional[LoadProfile] = None) -> Optional[Resource]:
+        return await _get(self.session, Resource, Resource.resource_id, resource_id, profile)
 
-    async def get(self, name: str) -> Optional[Resource]:
-        return await self.session.get(Resource, name)
+    async def get(self, name: str, profile: Optional[LoadProfile] = None) -> Optional[Resource]:
+        return await _get(self.session, Resource, Resource.name, name, profile, by_primary_key=False)
 
-    async def list(self) -> List[Resource]:
-        result = await self.session.execute(select(Resource))
+    async def list(self, profile: Optional[LoadProfile] = None) -> List[Resource]:
+        result = await self.session.execute(select(Resource).options(*get_loader_options(Resource, profile)))
         return result.scalars().unique().all()
 
     async def delete(self, resource: Resource) -> None:
         await self.session.delete(resource)
 
-    async def get_many(self, resources_ids: list):
-        """TODO: переписать с использованием query, чтобы отправлялся один запрос"""
-        return [await self.session.get(Resource, i) for i in resources_ids]
+    async def get_schedule_summary(self, as_of: dt) -> List[Row]:
+        """
+        Одним запросом возвращает для каждого ресурса только то, что нужно для дашборда:
+        текущую запись (take_email, take_date, return_date), дату начала первой будущей брони
+        и день, когда закончится непрерывная цепочка броней, начатая текущей записью.
+        Цепочка считается оконными функциями: запись продолжает ее, если начинается на следующий день
+        после окончания предыдущей (даты в UTC).
+        """
+        take_day = func.date(func.timezone("UTC", Record.take_date))
+        previous_return_day = func.date(func.timezone("UTC", func.lag(Record.return_date).over(
+            partition_by=Record.resource_id,
+            order_by=(Record.take_date, Record.record_id)
+        )))
+        ordered = select(
+            Record.record_id,
+            Record.resource_id,
+            Record.visitor_id,
+            Record.take_date,
+            Record.return_date,
+            case((take_day == previous_return_day + 1, 0), else_=1).label("starts_row"),
+        ).where(Record.take_date.is_not(None)).subquery()
+        numbered = select(
+            ordered,
+            func.sum(ordered.c.starts_row).over(
+                partition_by=ordered.c.resource_id,
+                order_by=(ordered.c.take_date, ordered.c.record_id)
+            ).label("row_number"),
+        ).subquery()
+        taken = select(
+            numbered.c.resource_id,
+            numbered.c.visitor_id,
+            numbered.c.take_date,
+            numbered.c.return_date,
+            func.last_value(numbered.c.return_date).over(
+                partition_by=(numbered.c.resource_id, numbered.c.row_number),
+                order_by=(numbered.c.take_date, numbered.c.record_id),
+                rows=(None, None)
+            ).label("last_booked_day_in_row"),
+            func.row_number().over(
+                partition_by=(numbered.c.resource_id, numbered.c.take_date <= as_of),
+                order_by=(numbered.c.take_date.desc(), numbered.c.record_id.desc())
+            ).label("take_rank"),
+        ).subquery()
+        future = select(
+            Record.resource_id,
+            func.min(Record.take_date).label("first_booked_day_in_future"),
+        ).where(Record.take_date > as_of).group_by(Record.resource_id).subquery()
+        result = await self.session.execute(
+            select(
+                Resource.resource_id,
+                Resource.name,
+                Visitor.email.label("take_email"),
+                taken.c.take_date,
+                taken.c.return_date,
+                taken.c.last_booked_day_in_row,
+                future.c.first_booked_day_in_future,
+            )
+            .outerjoin(taken, and_(
+                taken.c.resource_id == Resource.resource_id,
+                taken.c.take_date <= as_of,
+                taken.c.take_rank == 1
+            ))
+            .outerjoin(Visitor, Visitor.visitor_id == taken.c.visitor_id)
+            .outerjoin(future, future.c.resource_id == Resource.resource_id)
+            .order_by(Resource.name)
+        )
+        return result.all()
+
+    async def get_many(self, names: List[str]) -> List[Optional[Resource]]:
+        return await _get_many(self.session, Resource, Resource.name, names, by_primary_key=False)
+
+    async def get_many_by_ids(self, resource_ids: List[int]) -> List[Optional[Resource]]:
+        return await _get_many(self.session, Resource, Resource.resource_id, resource_ids)
+
+    async def search(self, search_key: str, limit: Optional[int] = 1000) -> List[Resource]:
+        """
+        Ищет ресурсы по name, external_id, comment и address, результаты отсортированы по похожести.
+        Условия поиска описаны в _get_search_condition
+        """
+        condition = await self._get_search_condition(search_key)
+        if condition is None:
+            return []
+        result = await self.session.execute(
+            select(Resource).where(condition).order_by(*self._get_search_order(search_key)).limit(limit)
+        )
+        return result.scalars().unique().all()
+
+    async def search_page(self, search_key: str, limit: int, after: Optional[int] = None,
+                          before: Optional[int] = None) -> Page:
+        condition = await self._get_search_condition(search_key)
+        if condition is None:
+            return Page(items=[], has_previous=False, has_next=False)
+        return await _get_keyset_page(
+            self.session, select(Resource).where(condition), keys=self._get_search_order(search_key),
+            id_column=Resource.resource_id, limit=limit, after=after, before=before
+        )
+
+    async def count_search(self, search_key: str) -> int:
+        condition = await self._get_search_condition(search_key)
+        if condition is None:
+            return 0
+        return await _count_approximately(self.session, select(Resource.resource_id).where(condition))
+
+    async def get_page_in_category(self, category_name: str, limit: int, after: Optional[int] = None,
+                                   before: Optional[int] = None) -> Page:
+        return await _get_keyset_page(
+            self.session, select(Resource).where(Resource.category_name == category_name),
+            keys=[Resource.name], id_column=Resource.resource_id, limit=limit, after=after, before=before
+        )
+
+    async def count_in_category(self, category_name: str) -> int:
+        return await _count_approximately(
+            self.session, select(Resource.resource_id).where(Resource.category_name == category_name)
+        )
+
+    async def _get_search_condition(self, search_key: str):
+        """
+        Число сначала ищется как resource_id. Текст ищется как подстрока (ILIKE), а если таких нет -
+        как похожее слово (оператор %> из pg_trgm), чтобы находить опечатки. Оба условия обслуживает
+        один триграммный GIN-индекс. Нечеткий поиск дороже, поэтому он только запасной.
+        Для пустого запроса возвращает None
+        """
+        search_key = search_key.strip()
+        if not search_key:
+            return None
+        if search_key.isdecimal() and int(search_key) <= MAX_INT4:
+            condition = Resource.resource_id == int(search_key)
+            if await self._exists(condition):
+                return condition
+        document = get_resource_search_document(Resource)
+        condition = document.ilike(f"%{_escape_like(search_key)}%", escape="\\")
+        if await self._exists(condition):
+            return condition
+        return document.op("%>")(search_key)
+
+    async def _exists(self, condition) -> bool:
+        return await self.session.scalar(select(select(Resource.resource_id).where(condition).exists()))
 
-    async def search(self, search_key, limit: Optional[int] = 1000) -> List[Resource]:
-        pass
-        # if search_key.isnumeric():
-        #     filters = [Resource.resource_id.in_([int(search_key)])]
-        # else:
-        #     filters = _prepare_filters_for_strings(
-        #         [Resource.name, Resource.external_id, Resource.comment, Resource.address],
-        #         search_key=search_key
-        #     )
-        # result = await self.session.execute(select(Resource).filter(or_(*filters)).limit(limit))
-        # return result.scalars().unique().all()
+    @staticmethod
+    def _get_search_order(search_key: str) -> list:
+        """Сначала самые похожие. Похожесть со знаком минус, чтобы весь ключ сортировался по возрастанию"""
+        return [-func.word_similarity(search_key.strip(), get_resource_search_document(Resource)), Resource.name]
 
 
 class VisitorRepository(AbstractVisitorRepository):
@@ -263,19 +858,29 @@ class VisitorRepository(AbstractVisitorRepository):
     def add(self, visitor: Visitor) -> None:
         self.session.add(visitor)
 
-    async def get_by_external_id(self, external_id) -> Optional[Visitor]:
-        result = await self.session.execute(select(Visitor).filter_by(external_id=external_id))
+    async def get_by_external_id(self, external_id, profile: Optional[LoadProfile] = None) -> Optional[Visitor]:
+        result = await self.session.execute(
+            select(Visitor).filter_by(external_id=external_id).options(*get_loader_options(Visitor, profile))
+        )
         visitors = result.scalars().unique().all()
         if len(visitors) == 0:
             return None
         else:
             return visitors[0]
 
-    async def get(self, email: str) -> Optional[Visitor]:
-        return await self.session.get(Visitor, email)
+    async def exists_by_external_id(self, external_id) -> bool:
+        """Проверяет наличие посетителя без загрузки его записей"""
+        result = await self.session.execute(select(Visitor.email).filter_by(external_id=external_id).limit(1))
+        return result.scalar() is not None
+
+    async def get(self, email: str, profile: Optional[LoadProfile] = None) -> Optional[Visitor]:
+        return await _get(self.session, Visitor, Visitor.email, email, profile, by_primary_key=False)
 
-    async def list(self) -> List[Visitor]:
-        result = await self.session.execute(select(Visitor))
+    async def get_many(self, emails: List[str]) -> List[Optional[Visitor]]:
+        return await _get_many(self.session, Visitor, Visitor.email, emails, by_primary_key=False)
+
+    async def list(self, profile: Optional[LoadProfile] = None) -> List[Visitor]:
+        result = await self.session.execute(select(Visitor).options(*get_loader_options(Visitor, profile)))
         return result.scalars().unique().all()
 
     async def delete(self, visitor: Visitor) -> None:
@@ -292,6 +897,9 @@ class CategoryRepository(AbstractCategoryRepository):
     async def get(self, name: str) -> Optional[Category]:
         return await self.session.get(Category, name)
 
+    async def get_many(self, names: List[str]) -> List[Optional[Category]]:
+        return await _get_many(self.session, Category, Category.name, names)
+
     async def list(self) -> List[Category]:
         result = await self.session.execute(select(Category))
         return result.scalars().unique().all()
@@ -1,9 +1,10 @@
 import os
 import re
-from typing import Optional
+from typing import Literal, Optional
 
+from aiogram.fsm.storage.redis import RedisStorage
 from arq.connections import RedisSettings
-from pydantic import field_validator
+from pydantic import field_validator, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -22,6 +23,10 @@ class CommonSettings(BaseSettings):
     TEST_DATA: bool
     STAFF_CLIENT_ID: str
     STAFF_CLIENT_SECRET: str
+    STAFF_TIMEOUT: float = 10
+    STAFF_RETRIES: int = 2
+    STAFF_HTTP2: bool = True
+    FSM_USE_REDIS: bool = False
 
     @field_validator("ADMINS")
     def check_admin_emails(cls, emails: str) -> str:
@@ -39,6 +44,8 @@ class RedisConfig(BaseSettings):
     REDIS_DB: int
     REDIS_HOST: str
     REDIS_PORT: int
+    FSM_STATE_TTL: int = 24 * 60 * 60
+    FSM_DATA_TTL: int = 24 * 60 * 60
 
     model_config = SettingsConfigDict(
         env_file='.env',
@@ -57,6 +64,101 @@ class RedisConfig(BaseSettings):
             database=self.REDIS_DB,
         )
 
+    def get_fsm_storage(self) -> RedisStorage:
+        """Хранилище состояний бота, общее для реплик и переживающее рестарт. Брошенные сценарии истекают по TTL"""
+        return RedisStorage.from_url(
+            self.get_connection_str(),
+            state_ttl=self.FSM_STATE_TTL,
+            data_ttl=self.FSM_DATA_TTL,
+        )
+
+
+class WebhookSettings(BaseSettings):
+    """Настройки способа получения апдейтов: long polling или вебхук на aiohttp-сервере"""
+    model_config = SettingsConfigDict(
+        env_file='.env',
+        env_file_encoding='utf-8',
+        secrets_dir=os.getenv("SECRETS_ADDRESS"),
+        extra="allow"
+    )
+
+    BOT_MODE: Literal["polling", "webhook"] = "polling"
+    WEBHOOK_URL: Optional[str] = None
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: Optional[str] = None
+    WEB_SERVER_HOST: str = "0.0.0.0"
+    WEB_SERVER_PORT: int = 8080
+    WEBHOOK_DRAIN_TIMEOUT: float = 10
+    BOT_SHARDS: int = 1
+    SHARD_QUEUE_SIZE: int = 1000
+    SHARD_PUT_TIMEOUT: float = 5
+    SHARD_MAX_IN_FLIGHT: int = 100
+
+    @field_validator("WEBHOOK_SECRET")
+    def check_secret(cls, secret: Optional[str]) -> Optional[str]:
+        if secret is not None and not re.search(r"^[A-Za-z0-9_-]{1,256}$", secret):
+            raise ValueError("WEBHOOK_SECRET должен состоять из 1-256 символов A-Z, a-z, 0-9, _ и -")
+        return secret
+
+    @model_validator(mode="after")
+    def check_webhook_mode(self) -> "WebhookSettings":
+        if self.BOT_MODE == "webhook" and (not self.WEBHOOK_URL or not self.WEBHOOK_SECRET):
+            raise ValueError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+        if self.BOT_SHARDS < 1 or (self.BOT_SHARDS > 1 and self.BOT_MODE != "webhook"):
+            raise ValueError("BOT_SHARDS должен быть положительным, а несколько шардов работают только в режиме webhook")
+        return self
+
+    def get_webhook_url(self) -> str:
+        return f"{self.WEBHOOK_URL.rstrip('/')}{self.WEBHOOK_PATH}"
+
+
+class CacheSettings(BaseSettings):
+    """Настройки кэшей. Redis нужен, чтобы кэш был общим для нескольких реплик бота"""
+    model_config = SettingsConfigDict(
+        env_file='.env',
+        env_file_encoding='utf-8',
+        secrets_dir=os.getenv("SECRETS_ADDRESS"),
+        extra="allow"
+    )
+
+    CACHE_USE_REDIS: bool = False
+    CACHE_INVALIDATION_BUS: bool = True
+    CACHE_INVALIDATION_RECONNECT_DELAY: float = 1
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: int = 24 * 60 * 60
+    STAFF_CACHE_SIZE: int = 10000
+    STAFF_CACHE_FOUND_TTL: int = 24 * 60 * 60
+    STAFF_CACHE_EMPTY_TTL: int = 10 * 60
+    STAFF_CACHE_ERROR_TTL: int = 30
+    DASHBOARD_CACHE_SIZE: int = 10000
+    DASHBOARD_CACHE_TTL: int = 24 * 60 * 60
+    SCHEDULE_CACHE_TTL: int = 60
+    PAGE_COUNT_CACHE_SIZE: int = 10000
+    PAGE_COUNT_CACHE_TTL: int = 5 * 60
+
+
+class HistorySettings(BaseSettings):
+    """
+    Настройки истории броней (old_record). Она разбита на месячные разделы по return_date:
+    воркер создает их заранее и отцепляет те, что старше срока хранения
+    """
+    model_config = SettingsConfigDict(
+        env_file='.env',
+        env_file_encoding='utf-8',
+        secrets_dir=os.getenv("SECRETS_ADDRESS"),
+        extra="allow"
+    )
+
+    # Сколько месяцев вперед создавать разделы, кроме текущего
+    HISTORY_PARTITIONS_AHEAD: int = 2
+    # Срок хранения в месяцах. Разделы целиком старше него отцепляются от old_record, 0 - хранить все
+    HISTORY_RETENTION_MONTHS: int = 0
+    # Удалять отцепленные разделы, а не оставлять их отдельными таблицами
+    HISTORY_DROP_DETACHED: bool = False
+    # За сколько последних месяцев показывать историю посетителя и ресурса
+    HISTORY_QUERY_MONTHS: int = 12
+
+
 class PGSettings(BaseSettings):
     """Настройки для подключения к БД"""
     model_config = SettingsConfigDict(
@@ -70,9 +172,17 @@ class PGSettings(BaseSettings):
     PG_PASS: str
     POSTGRES_URL: str
     PG_DB_NAME: str
+    PG_POOL_SIZE: int = 5
+    PG_MAX_OVERFLOW: int = 10
+    PG_POOL_RECYCLE: int = 1800
+    PG_POOL_PRE_PING: bool = True
 
     def db_connection_sync(self) -> str:
         return f"postgresql+psycopg2://{self.PG_USER}:{self.PG_PASS}@{self.POSTGRES_URL}/{self.PG_DB_NAME}"
 
     def db_connection_async(self) -> str:
         return f"postgresql+asyncpg://{self.PG_USER}:{self.PG_PASS}@{self.POSTGRES_URL}/{self.PG_DB_NAME}"
+
+    def db_connection_dsn(self) -> str:
+        """Строка подключения для asyncpg без SQLAlchemy - для LISTEN"""
+        return f"postgresql://{self.PG_USER}:{self.PG_PASS}@{self.POSTGRES_URL}/{self.PG_DB_NAME}"
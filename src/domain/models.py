@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from datetime import datetime, datetime as dt
 from enum import StrEnum
-from typing import Optional, List
+from typing import Optional, List, Tuple, Iterable
 
 import emoji
 
@@ -10,10 +10,9 @@ class Resource:
     resource_id: int
     name: str
     category_name: str
+    records: 'List[Record]'
     old_records: 'List[OldRecord]'
     queue_records: 'List[Record]'
-    future_records: 'List[Record]'
-    take_record: 'Optional[Record]'
 
     def __init__(
             self,
@@ -46,17 +45,19 @@ class Resource:
         return f"<Resource(" \
                f"resource_id={self.resource_id}, " \
                f"name={self.name}, " \
-               f"category={self.category}, " \
+               f"category={self.category_name}, " \
                f"external_id={self.external_id or 'None'}" \
                f")>"
 
+    def get_take_and_future_records(self, as_of: dt) -> 'Tuple[Optional[Record], List[Record]]':
+        """Текущая и будущие брони ресурса на момент as_of - из загруженного списка records"""
+        return split_take_and_future(self.records, as_of)
+
 
 class Visitor:
     visitor_id: int
     records: "List[Record]"
     old_records: 'List[OldRecord]'
-    future_records: 'List[Record]'
-    take_records: 'List[Record]'
     queue_records: 'List[Record]'
 
     def __init__(
@@ -94,9 +95,16 @@ class Visitor:
                f"external_id={self.external_id or 'None'}" \
                f")>"
 
+    def get_take_and_future_records(self, as_of: dt) -> 'Tuple[List[Record], List[Record]]':
+        """Начатые и будущие брони посетителя на момент as_of - из загруженного списка records"""
+        return split_started_and_future(self.records, as_of)
+
 
 class OldRecord:
     record_id: int
+    resource_id: int
+    visitor_id: int
+    # Только для чтения: подгружаются из ресурса и посетителя
     email: str
     resource_name: str
     take_date: Optional[datetime]
@@ -110,8 +118,8 @@ class OldRecord:
     def __init__(
             self,
             record_id: int,
-            email: str,
-            resource_name: str,
+            resource_id: int,
+            visitor_id: int,
             take_date: Optional[datetime] = None,
             return_date: Optional[datetime] = None,
             enqueue_date: Optional[datetime] = None,
@@ -120,8 +128,8 @@ class OldRecord:
 
     ):
         self.record_id = record_id
-        self.email = email
-        self.resource_name = resource_name
+        self.resource_id = resource_id
+        self.visitor_id = visitor_id
         self.take_date = take_date
         self.return_date = return_date
         self.enqueue_date = enqueue_date
@@ -143,8 +151,8 @@ class OldRecord:
     def __repr__(self) -> str:
         return f"<OldRecord(" \
                f"record_id={self.record_id}, " \
-               f"email={self.email}, " \
-               f"resource_name={self.resource_name}, " \
+               f"resource_id={self.resource_id}, " \
+               f"visitor_id={self.visitor_id}, " \
                f")>"
 
 
@@ -152,6 +160,9 @@ class Record:
     record_id: int
     resource: Optional[Resource]
     visitor: Optional[Visitor]
+    resource_id: int
+    visitor_id: int
+    # Только для чтения: подгружаются из ресурса и посетителя
     email: str
     resource_name: str
     take_date: Optional[datetime]
@@ -162,8 +173,8 @@ class Record:
 
     def __init__(
             self,
-            email: str,
-            resource_name: str,
+            resource_id: int,
+            visitor_id: int,
             take_date: Optional[datetime] = None,
             return_date: Optional[datetime] = None,
             enqueue_date: Optional[datetime] = None,
@@ -171,8 +182,8 @@ class Record:
             updated_at: Optional[datetime] = None,
 
     ):
-        self.email = email
-        self.resource_name = resource_name
+        self.resource_id = resource_id
+        self.visitor_id = visitor_id
         self.take_date = take_date
         self.return_date = return_date
         self.enqueue_date = enqueue_date
@@ -194,8 +205,8 @@ class Record:
     def __repr__(self):
         return f"<Record(" \
                f"record_id={self.record_id}, " \
-               f"email={self.email}, " \
-               f"resource_name={self.resource_name}, " \
+               f"resource_id={self.resource_id}, " \
+               f"visitor_id={self.visitor_id}, " \
                f")>"
 
 
@@ -244,3 +255,32 @@ class StageInfo:
         if not isinstance(other, StageInfo):
             return False
         return other.resource_id == self.resource_id
+
+
+@dataclass
+class Page:
+    """
+    Страница выборки из БД при keyset-пагинации. first_key и last_key - айди крайних объектов,
+    от них листается назад и вперед. total - приблизительное количество объектов во всей выборке
+    """
+    items: list
+    has_previous: bool
+    has_next: bool
+    first_key: Optional[int] = None
+    last_key: Optional[int] = None
+    total: Optional[int] = None
+
+
+def split_started_and_future(records: 'Iterable[Record]', as_of: dt) -> Tuple[List['Record'], List['Record']]:
+    """
+    Делит брони на начатые к моменту as_of и будущие, обе части по возрастанию даты начала.
+    Записи без даты начала (очередь) не учитываются
+    """
+    taken = sorted((i for i in records if i.take_date is not None), key=lambda i: (i.take_date, i.record_id or 0))
+    return [i for i in taken if i.take_date <= as_of], [i for i in taken if i.take_date > as_of]
+
+
+def split_take_and_future(records: 'Iterable[Record]', as_of: dt) -> Tuple[Optional['Record'], List['Record']]:
+    """Текущая бронь ресурса (последняя начатая к моменту as_of) и будущие брони"""
+    started, future = split_started_and_future(records, as_of)
+    return (started[-1] if started else None), future
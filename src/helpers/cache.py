@@ -0,0 +1,104 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+
+class TTLCache:
+    """LRU-кэш в памяти процесса: у каждой записи есть время жизни, при переполнении вытесняются самые старые"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"TTLCache(maxsize={self.maxsize}, ttl={self.ttl}, len={len(self._data)})"
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+MISSING = object()
+
+
+class TieredCache:
+    """
+    Двухуровневый кэш: TTLCache в памяти процесса и, если передан redis, Redis, общий для реплик.
+    В Redis значения хранятся как JSON с тем же временем жизни. Ошибки Redis не ломают работу - это просто промах.
+    """
+
+    def __init__(self, prefix: str, maxsize: int, ttl: float, redis: Optional[Callable[[], Redis]] = None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._redis = redis
+
+    def __repr__(self) -> str:
+        return f"TieredCache(prefix={self.prefix}, local={self.local}, redis={self._redis is not None})"
+
+    async def get(self, key: Hashable) -> Any:
+        """Возвращает значение или MISSING, если его нет ни в одном уровне"""
+        value = self.local.get(key, MISSING)
+        if value is not MISSING or self._redis is None:
+            return value
+        try:
+            async with self._redis().pipeline(transaction=False) as pipe:
+                raw, ttl_ms = await pipe.get(f"{self.prefix}{key}").pttl(f"{self.prefix}{key}").execute()
+        except RedisError as e:
+            logging.warning(f"Не удалось прочитать {self.prefix}{key} из Redis: {e}")
+            return MISSING
+        if raw is None:
+            return MISSING
+        value = json.loads(raw)
+        self.local.set(key, value, ttl=ttl_ms / 1000 if ttl_ms > 0 else None)
+        return value
+
+    async def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl=ttl)
+        if self._redis is None:
+            return
+        try:
+            await self._redis().set(f"{self.prefix}{key}", json.dumps(value), px=int(ttl * 1000))
+        except RedisError as e:
+            logging.warning(f"Не удалось записать {self.prefix}{key} в Redis: {e}")
+
+    async def delete(self, key: Hashable) -> None:
+        self.local.delete(key)
+        if self._redis is None:
+            return
+        try:
+            await self._redis().delete(f"{self.prefix}{key}")
+        except RedisError as e:
+            logging.warning(f"Не удалось удалить {self.prefix}{key} из Redis: {e}")
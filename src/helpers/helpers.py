@@ -7,6 +7,13 @@ def get_time_now() -> dt:
     return dt.now(tz=tz.utc)
 
 
+def get_month_start(moment: dt, months: int = 0) -> dt:
+    """Начало месяца moment в UTC, сдвинутого на months месяцев"""
+    moment = moment.astimezone(tz.utc)
+    index = moment.year * 12 + moment.month - 1 + months
+    return dt(year=index // 12, month=index % 12 + 1, day=1, tzinfo=tz.utc)
+
+
 def reduce_datetime_to_date_utc(datetime: dt) -> dt:
     return dt(year=datetime.year, month=datetime.month, day=datetime.day, tzinfo=tz.utc)
 
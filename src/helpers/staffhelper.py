@@ -1,49 +1,185 @@
+import asyncio
 import logging
+import time
 from typing import Optional
 
 import httpx
 
-from configs.settings import CommonSettings
+from adapters.redishelper import get_redis
+from configs.settings import CommonSettings, CacheSettings
+from helpers.cache import TieredCache, MISSING
 
-CONFIG = CommonSettings()
 PASSPORT_URL = "https://passport.skbkontur.ru"
 STAFF_URL = "https://staff.skbkontur.ru"
+# Время жизни токена, если паспорт не прислал expires_in
+DEFAULT_TOKEN_LIFETIME = 300
 
 
-async def get_staff_token() -> Optional[str]:
-    """Получает в паспорте токен для запросов в АПИ Стаффа"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{PASSPORT_URL}/connect/token",
-            data={
-                "grant_type": "client_credentials",
-                "scope": "profiles",
-            },
-            auth=httpx.BasicAuth(CONFIG.STAFF_CLIENT_ID, CONFIG.STAFF_CLIENT_SECRET),
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
+class StaffClient:
+    """
+    Долгоживущий клиент АПИ Стаффа: один пул соединений (HTTP/2, если доступен) и кэш токена из паспорта.
+    Токен обновляется заранее, за refresh_margin секунд до истечения expires_in (но не раньше середины
+    его жизни, чтобы короткоживущий токен тоже переиспользовался), а одновременные запросы ждут одно
+    обновление вместо того, чтобы запрашивать токен каждый сам.
+    """
+
+    def __init__(
+            self,
+            client_id: str,
+            client_secret: str,
+            passport_url: str = PASSPORT_URL,
+            staff_url: str = STAFF_URL,
+            timeout: float = 10,
+            retries: int = 2,
+            http2: bool = True,
+            refresh_margin: float = 60
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.passport_url = passport_url
+        self.staff_url = staff_url
+        self.refresh_margin = refresh_margin
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(timeout),
+            transport=httpx.AsyncHTTPTransport(http2=http2, retries=retries),
         )
-    if response.status_code == 200:
-        return response.json()["access_token"]
-    else:
-        logging.error(f"Ошибка при запросе токена: {response.status_code}")
-        return None
+        self._token: Optional[str] = None
+        self._token_refresh_at = 0.0
+        self._token_lock = asyncio.Lock()
 
+    def __repr__(self) -> str:
+        return f"StaffClient(staff_url={self.staff_url}, passport_url={self.passport_url})"
 
-async def search_emails(query: str) -> Optional[list[str]]:
-    """Ищет по всей инфе о сотруднике в Стаффе и возвращает почты действующих сотрудников"""
-    token = await get_staff_token()
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f"{STAFF_URL}/api/Suggest/bytype",
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    def _token_is_fresh(self) -> bool:
+        return self._token is not None and time.monotonic() < self._token_refresh_at
+
+    async def get_token(self, force: bool = False) -> Optional[str]:
+        """Получает в паспорте токен для запросов в АПИ Стаффа или берет его из кэша"""
+        if not force and self._token_is_fresh():
+            return self._token
+        stale_token = self._token
+        async with self._token_lock:
+            # Пока ждали блокировку, токен мог обновить другой запрос
+            if self._token_is_fresh() and (not force or self._token != stale_token):
+                return self._token
+            try:
+                response = await self._client.post(
+                    f"{self.passport_url}/connect/token",
+                    data={
+                        "grant_type": "client_credentials",
+                        "scope": "profiles",
+                    },
+                    auth=httpx.BasicAuth(self.client_id, self.client_secret),
+                    headers={"Content-Type": "application/x-www-form-urlencoded"},
+                )
+            except httpx.HTTPError as e:
+                logging.error(f"Ошибка при запросе токена: {e!r}")
+                return None
+            if response.status_code != 200:
+                logging.error(f"Ошибка при запросе токена: {response.status_code}")
+                return None
+            data = response.json()
+            self._token = data["access_token"]
+            expires_in = float(data.get("expires_in") or DEFAULT_TOKEN_LIFETIME)
+            self._token_refresh_at = time.monotonic() + expires_in - min(self.refresh_margin, expires_in / 2)
+            return self._token
+
+    async def search_emails(self, query: str) -> Optional[list[str]]:
+        """Ищет по всей инфе о сотруднике в Стаффе и возвращает почты действующих сотрудников"""
+        token = await self.get_token()
+        if token is None:
+            return None
+        try:
+            response = await self._search(query, token)
+            if response.status_code == 401:
+                token = await self.get_token(force=True)
+                if token is None:
+                    return None
+                response = await self._search(query, token)
+        except httpx.HTTPError as e:
+            logging.error(f"Ошибка при поиске пользователей: {e!r}")
+            return None
+        if response.status_code == 200:
+            data = response.json()["items"]
+            if len(data) == 0:
+                return []
+            else:
+                return [item["email"] for item in data if item["status"] != "dismissed"]
+        else:
+            logging.error(f"Ошибка при поиске пользователей: {response.status_code}")
+            return None
+
+    async def _search(self, query: str, token: str) -> httpx.Response:
+        return await self._client.get(
+            f"{self.staff_url}/api/Suggest/bytype",
             params={"Q": query, "Types": 7},
             headers={"Authorization": f"Bearer {token}"},
         )
-    if response.status_code == 200:
-        data = response.json()["items"]
-        if len(data) == 0:
-            return []
-        else:
-            return [item["email"] for item in data if item["status"] != "dismissed"]
+
+
+_staff_client: Optional[StaffClient] = None
+
+
+def get_staff_client() -> StaffClient:
+    """Возвращает общий на процесс клиент Стаффа, создавая его при первом обращении"""
+    global _staff_client
+    if _staff_client is None:
+        config = CommonSettings()
+        _staff_client = StaffClient(
+            config.STAFF_CLIENT_ID,
+            config.STAFF_CLIENT_SECRET,
+            timeout=config.STAFF_TIMEOUT,
+            retries=config.STAFF_RETRIES,
+            http2=config.STAFF_HTTP2,
+        )
+    return _staff_client
+
+
+async def close_staff_client() -> None:
+    global _staff_client
+    if _staff_client is not None:
+        await _staff_client.close()
+    _staff_client = None
+
+
+_search_cache: Optional[TieredCache] = None
+
+
+def _get_search_cache() -> TieredCache:
+    global _search_cache
+    if _search_cache is None:
+        settings = CacheSettings()
+        _search_cache = TieredCache(
+            prefix="staff:",
+            maxsize=settings.STAFF_CACHE_SIZE,
+            ttl=settings.STAFF_CACHE_FOUND_TTL,
+            redis=get_redis if settings.CACHE_USE_REDIS else None,
+        )
+    return _search_cache
+
+
+async def search_emails(query: str) -> Optional[list[str]]:
+    """
+    Ищет по всей инфе о сотруднике в Стаффе и возвращает почты действующих сотрудников.
+    Результат кэшируется: найденные почты надолго, пустой ответ и ошибка - на короткое время,
+    чтобы повторные сообщения от незарегистрированных в Стаффе не вызывали запрос в Стафф каждый раз
+    """
+    key = query.lower()
+    cache = _get_search_cache()
+    emails = await cache.get(key)
+    if emails is not MISSING:
+        return emails
+    emails = await get_staff_client().search_emails(query)
+    settings = CacheSettings()
+    if emails is None:
+        ttl = settings.STAFF_CACHE_ERROR_TTL
+    elif len(emails) == 0:
+        ttl = settings.STAFF_CACHE_EMPTY_TTL
     else:
-        logging.error(f"Ошибка при поиске пользователей: {response.status_code}")
-        return None
+        ttl = settings.STAFF_CACHE_FOUND_TTL
+    await cache.set(key, emails, ttl=ttl)
+    return emails
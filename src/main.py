@@ -1,32 +1,134 @@
 import asyncio
 import logging
+import multiprocessing
+import signal
 
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
 
-from adapters import dbhelper
-from configs.settings import CommonSettings
+from adapters import dbhelper, redishelper
+from configs.settings import CommonSettings, WebhookSettings, RedisConfig
+from helpers import staffhelper
+from service_layer import invalidation
 from tg import auth, main_screen
+from tg.middlewares.middlewares import UnitOfWorkMiddleware, CallbackThrottleMiddleware
+from tg.sharding import consume, create_front_app, watch_shards
+from tg.webhook import run_webhook, serve
 
 
-async def start_bot(token: str) -> None:
-    bot = Bot(token=token)
-    dp = Dispatcher(storage=MemoryStorage())
+def create_storage(settings: CommonSettings) -> BaseStorage:
+    return RedisConfig().get_fsm_storage() if settings.FSM_USE_REDIS else MemoryStorage()
+
+
+def create_dispatcher(storage: BaseStorage) -> Dispatcher:
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(UnitOfWorkMiddleware())
+    dp.callback_query.outer_middleware(CallbackThrottleMiddleware(prefixes=("change_take_date_",)))
     dp.include_routers(auth.router, main_screen.router)
+    dp.startup.register(invalidation.start_listener)
+    dp.shutdown.register(invalidation.stop_listener)
+    dp.shutdown.register(dbhelper.dispose_engine_async)
+    dp.shutdown.register(redishelper.close_redis)
+    dp.shutdown.register(staffhelper.close_staff_client)
+    dp.shutdown.register(storage.close)
+    return dp
+
+
+def get_stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def start_bot(settings: CommonSettings, webhook_settings: WebhookSettings) -> None:
+    bot = Bot(token=settings.TOKEN)
+    dp = create_dispatcher(create_storage(settings))
     await bot.set_my_commands([BotCommand(command="/all", description="Весь список устройств")])
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    if webhook_settings.BOT_MODE == "webhook":
+        await run_webhook(bot, dp, webhook_settings, get_stop_event())
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+
+
+async def start_shard(index: int, queue: multiprocessing.Queue) -> None:
+    dbhelper.start_mappers()
+    settings = CommonSettings()
+    bot = Bot(token=settings.TOKEN)
+    dp = create_dispatcher(create_storage(settings))
+    await dp.emit_startup(bot=bot)
+    logging.info(f"Шард {index} запущен")
+    try:
+        await consume(queue, bot, dp, WebhookSettings().SHARD_MAX_IN_FLIGHT)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        logging.info(f"Шард {index} остановлен")
+
+
+def run_shard(index: int, queue: multiprocessing.Queue) -> None:
+    """Точка входа процесса-шарда. Сигналы остановки обрабатывает фронт, шард завершается по None из очереди"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging()
+    asyncio.run(start_shard(index, queue))
+
+
+async def start_sharded_bot(settings: CommonSettings, webhook_settings: WebhookSettings) -> None:
+    """Запускает BOT_SHARDS процессов-шардов и фронт, который раздает им апдейты вебхука по chat_id"""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=webhook_settings.SHARD_QUEUE_SIZE) for _ in range(webhook_settings.BOT_SHARDS)]
+    shards = [context.Process(target=run_shard, args=(i, queue), name=f"shard-{i}") for i, queue in enumerate(queues)]
+    for shard in shards:
+        shard.start()
+    bot = Bot(token=settings.TOKEN)
+    stop = get_stop_event()
+    watcher = asyncio.create_task(watch_shards(shards, stop))
+    try:
+        await bot.set_my_commands([BotCommand(command="/all", description="Весь список устройств")])
+        await bot.set_webhook(
+            url=webhook_settings.get_webhook_url(),
+            secret_token=webhook_settings.WEBHOOK_SECRET,
+            allowed_updates=create_dispatcher(MemoryStorage()).resolve_used_update_types(),
+        )
+        await serve(create_front_app(queues, webhook_settings, shards), webhook_settings, stop)
+    finally:
+        stop.set()
+        dead = await watcher
+        for queue, shard in zip(queues, shards):
+            if shard.is_alive():
+                queue.put(None)
+            else:
+                # Очередь упавшего шарда никто не дочитает - не ждем ее при выходе
+                queue.cancel_join_thread()
+        for shard in shards:
+            await asyncio.get_running_loop().run_in_executor(None, shard.join)
+        await bot.session.close()
+        await dbhelper.dispose_engine_async()
+    if dead:
+        raise SystemExit(f"Шарды {dead} остановились")
 
 
 async def main() -> None:
-    await dbhelper.start_db_async()
-    await start_bot(CommonSettings().TOKEN)
+    dbhelper.start_mappers()
+    settings, webhook_settings = CommonSettings(), WebhookSettings()
+    if webhook_settings.BOT_SHARDS > 1:
+        await start_sharded_bot(settings, webhook_settings)
+    else:
+        await start_bot(settings, webhook_settings)
 
 
-if __name__ == "__main__":
+def setup_logging() -> None:
     logging.basicConfig(
         level=logging.DEBUG,
-        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+        format="%(asctime)s - %(processName)s - %(levelname)s - %(name)s - %(message)s"
     )
+
+
+if __name__ == "__main__":
+    setup_logging()
     asyncio.run(main())
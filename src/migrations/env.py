@@ -0,0 +1,62 @@
+"""
+Окружение alembic. Строку подключения берем из тех же настроек, что и бот, схему - из adapters.mappings.
+Миграции применяются из корня репозитория: python -m alembic upgrade head.
+Схему создают и обновляют только миграции: их запускают перед стартом и бота, и воркера.
+"""
+import asyncio
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import pool, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from adapters.mappings import get_metadata, is_old_record_partition
+from configs.settings import PGSettings
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = get_metadata()
+MIGRATION_LOCK_KEY = 3_481_275_001
+
+
+def include_name(name, type_, parent_names) -> bool:
+    """Разделы old_record создает воркер, в схеме их нет - autogenerate не должен их удалять"""
+    return not (type_ == "table" and is_old_record_partition(name))
+
+
+def run_migrations_offline() -> None:
+    """Генерирует SQL без подключения к БД: python -m alembic upgrade head --sql"""
+    context.configure(
+        url=PGSettings().db_connection_async(),
+        target_metadata=target_metadata,
+        include_name=include_name,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection: Connection) -> None:
+    context.configure(connection=connection, target_metadata=target_metadata, include_name=include_name)
+    with context.begin_transaction():
+        # Бот и воркер стартуют одновременно: второй ждет, пока первый применит миграции, и видит новую версию
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        context.run_migrations()
+
+
+async def run_async_migrations() -> None:
+    engine = create_async_engine(PGSettings().db_connection_async(), poolclass=pool.NullPool)
+    async with engine.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    asyncio.run(run_async_migrations())
@@ -0,0 +1,89 @@
+"""initial
+
+Схема, которую раньше создавал metadata.create_all при старте бота.
+На существующей БД (таблицы уже созданы create_all) миграция ничего не делает.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+UTC_NOW = sa.text("TIMEZONE('utc', now())")
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table("resource"):
+        return
+    op.create_table(
+        "category",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.PrimaryKeyConstraint("name", name="category_pkey"),
+    )
+    op.create_table(
+        "visitor",
+        sa.Column("visitor_id", sa.Integer(), sa.Identity(start=1, increment=1), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("is_admin", sa.Boolean()),
+        sa.Column("external_id", sa.Integer()),
+        sa.Column("chat_id", sa.Integer()),
+        sa.Column("full_name", sa.String()),
+        sa.Column("username", sa.String()),
+        sa.Column("comment", sa.String()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.PrimaryKeyConstraint("email", name="visitor_pkey"),
+        sa.UniqueConstraint("external_id", name="visitor_external_id_key"),
+        sa.UniqueConstraint("chat_id", name="visitor_chat_id_key"),
+    )
+    op.create_table(
+        "resource",
+        sa.Column("resource_id", sa.Integer(), sa.Identity(start=1, increment=1), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("category_name", sa.String(), nullable=False),
+        sa.Column("external_id", sa.String()),
+        sa.Column("comment", sa.String()),
+        sa.Column("address", sa.String()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column("updated_at", sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.PrimaryKeyConstraint("name", name="resource_pkey"),
+        sa.ForeignKeyConstraint(["category_name"], ["category.name"], name="resource_category_name_category_fkey",
+                                onupdate="cascade", ondelete="cascade"),
+    )
+    for table in ("record", "old_record"):
+        op.create_table(
+            table,
+            sa.Column("record_id", sa.Integer(), sa.Identity(start=1, increment=1), nullable=False)
+            if table == "record" else sa.Column("record_id", sa.Integer(), nullable=False),
+            sa.Column("resource_name", sa.String(), nullable=False),
+            sa.Column("email", sa.String(), nullable=False),
+            sa.Column("take_date", sa.DateTime(timezone=True)),
+            sa.Column("return_date", sa.DateTime(timezone=True)),
+            sa.Column("enqueue_date", sa.DateTime(timezone=True)),
+            sa.Column("created_at", sa.DateTime(timezone=True), server_default=UTC_NOW if table == "record" else None),
+            sa.Column("updated_at", sa.DateTime(timezone=True), server_default=UTC_NOW if table == "record" else None),
+            sa.PrimaryKeyConstraint("record_id", name=f"{table}_pkey"),
+            sa.ForeignKeyConstraint(["resource_name"], ["resource.name"], name=f"{table}_resource_name_resource_fkey",
+                                    onupdate="cascade", ondelete="cascade"),
+            sa.ForeignKeyConstraint(["email"], ["visitor.email"], name=f"{table}_email_visitor_fkey",
+                                    onupdate="cascade", ondelete="cascade"),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("old_record")
+    op.drop_table("record")
+    op.drop_table("resource")
+    op.drop_table("visitor")
+    op.drop_table("category")
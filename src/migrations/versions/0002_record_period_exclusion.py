@@ -0,0 +1,35 @@
+"""record period exclusion
+
+Брони одного ресурса не пересекаются по времени - проверяет БД.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    op.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'record_resource_name_period_excl') THEN
+                ALTER TABLE record ADD CONSTRAINT record_resource_name_period_excl
+                    EXCLUDE USING gist (resource_name WITH =, tstzrange(take_date, return_date, '[]') WITH &&)
+                    WHERE (take_date IS NOT NULL);
+            END IF;
+        END $$
+    """)
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE record DROP CONSTRAINT IF EXISTS record_resource_name_period_excl")
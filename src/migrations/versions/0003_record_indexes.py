@@ -0,0 +1,37 @@
+"""record indexes
+
+Индексы под фильтры репозиториев: брони ресурса и посетителя по времени, истекающие брони,
+ресурсы категории и история.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ("resource_category_name_idx", "resource", ["category_name"]),
+    ("record_resource_name_take_date_idx", "record", ["resource_name", "take_date"]),
+    ("record_email_take_date_idx", "record", ["email", "take_date"]),
+    ("record_return_date_idx", "record", ["return_date"]),
+    ("old_record_resource_name_take_date_idx", "old_record", ["resource_name", "take_date"]),
+    ("old_record_email_take_date_idx", "old_record", ["email", "take_date"]),
+]
+
+
+def upgrade() -> None:
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade() -> None:
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
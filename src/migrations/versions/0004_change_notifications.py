@@ -0,0 +1,57 @@
+"""change notifications
+
+Триггеры на record, resource и visitor сообщают об изменениях в канал cache_invalidation (LISTEN/NOTIFY),
+чтобы процессы бота и воркера сбрасывали свои кэши.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+STATEMENT_TABLES = ["record", "resource"]
+ROW_TABLES = [("visitor", "external_id")]
+
+
+def upgrade() -> None:
+    op.execute("CREATE SEQUENCE IF NOT EXISTS change_event_version_seq")
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+        DECLARE
+            payload jsonb := jsonb_build_object(
+                'table', TG_TABLE_NAME, 'op', TG_OP, 'version', nextval('change_event_version_seq')
+            );
+        BEGIN
+            IF TG_LEVEL = 'ROW' AND TG_NARGS > 0 THEN
+                payload := payload || jsonb_build_object(
+                    'key', (CASE WHEN TG_OP = 'DELETE' THEN to_jsonb(OLD) ELSE to_jsonb(NEW) END) ->> TG_ARGV[0]
+                );
+            END IF;
+            PERFORM pg_notify('cache_invalidation', payload::text);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    for table in STATEMENT_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_change ON {table}")
+        op.execute(f"CREATE TRIGGER {table}_notify_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                   f"ON {table} FOR EACH STATEMENT EXECUTE FUNCTION notify_change()")
+    for table, key_column in ROW_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_change ON {table}")
+        op.execute(f"CREATE TRIGGER {table}_notify_change AFTER INSERT OR UPDATE OR DELETE "
+                   f"ON {table} FOR EACH ROW EXECUTE FUNCTION notify_change('{key_column}')")
+
+
+def downgrade() -> None:
+    for table in STATEMENT_TABLES + [table for table, _ in ROW_TABLES]:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_change ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS notify_change()")
+    op.execute("DROP SEQUENCE IF EXISTS change_event_version_seq")
@@ -0,0 +1,35 @@
+"""resource search indexes
+
+Триграммный GIN-индекс (pg_trgm) для поиска ресурсов по склейке name, external_id, comment и address
+и индекс по resource_id для поиска по числу.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0005"
+down_revision: Union[str, Sequence[str], None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index("resource_resource_id_idx", "resource", ["resource_id"], if_not_exists=True)
+    # Выражение должно совпадать с get_resource_search_document из adapters/mappings.py
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS resource_search_trgm_idx ON resource USING gin ((
+            coalesce(name, '') || ' ' || coalesce(external_id, '') || ' ' ||
+            coalesce(comment, '') || ' ' || coalesce(address, '')
+        ) gin_trgm_ops)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index("resource_search_trgm_idx", table_name="resource", if_exists=True)
+    op.drop_index("resource_resource_id_idx", table_name="resource", if_exists=True)
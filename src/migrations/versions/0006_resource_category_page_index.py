@@ -0,0 +1,28 @@
+"""resource category page index
+
+Индекс по категории ресурса заменен составным (category_name, name): страница ресурсов категории
+выбирается по ключу name (keyset-пагинация) и читается из индекса уже в нужном порядке.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0006"
+down_revision: Union[str, Sequence[str], None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("resource_category_name_name_idx", "resource", ["category_name", "name"], if_not_exists=True)
+    op.drop_index("resource_category_name_idx", table_name="resource", if_exists=True)
+
+
+def downgrade() -> None:
+    op.create_index("resource_category_name_idx", "resource", ["category_name"], if_not_exists=True)
+    op.drop_index("resource_category_name_name_idx", table_name="resource", if_exists=True)
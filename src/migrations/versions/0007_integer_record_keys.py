@@ -0,0 +1,80 @@
+"""integer record keys
+
+Первичные ключи ресурса и посетителя - resource_id и visitor_id, name и email остаются уникальными.
+Брони и история ссылаются на них целыми числами вместо имени ресурса и почты: строки и индексы
+меньше, соединения по числу, а переименование ресурса не переписывает его историю.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+revision: str = "0007"
+down_revision: Union[str, Sequence[str], None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+RECORD_TABLES = ("record", "old_record")
+# Таблица, ее суррогатный ключ, натуральный ключ и колонка броней, которая на него ссылалась
+REFERENCED = [
+    ("resource", "resource_id", "name", "resource_name"),
+    ("visitor", "visitor_id", "email", "email"),
+]
+
+
+def upgrade() -> None:
+    for table in RECORD_TABLES:
+        for referenced, key, natural_key, column in REFERENCED:
+            op.add_column(table, sa.Column(key, sa.Integer()))
+            op.execute(f"UPDATE {table} SET {key} = {referenced}.{key} "
+                       f"FROM {referenced} WHERE {referenced}.{natural_key} = {table}.{column}")
+            op.alter_column(table, key, nullable=False)
+        # Вместе со строковыми колонками удаляются их внешние ключи, индексы и exclusion constraint
+        for _, _, _, column in REFERENCED:
+            op.drop_column(table, column)
+    op.drop_index("resource_resource_id_idx", table_name="resource", if_exists=True)
+    for referenced, key, natural_key, _ in REFERENCED:
+        op.drop_constraint(f"{referenced}_pkey", referenced, type_="primary")
+        op.create_primary_key(f"{referenced}_pkey", referenced, [key])
+        op.create_unique_constraint(f"{referenced}_{natural_key}_key", referenced, [natural_key])
+    for table in RECORD_TABLES:
+        for referenced, key, _, _ in REFERENCED:
+            op.create_foreign_key(f"{table}_{key}_{referenced}_fkey", table, referenced, [key], [key],
+                                  ondelete="cascade")
+            op.create_index(f"{table}_{key}_take_date_idx", table, [key, "take_date"])
+    op.execute("""
+        ALTER TABLE record ADD CONSTRAINT record_resource_id_period_excl
+            EXCLUDE USING gist (resource_id WITH =, tstzrange(take_date, return_date, '[]') WITH &&)
+            WHERE (take_date IS NOT NULL)
+    """)
+
+
+def downgrade() -> None:
+    for table in RECORD_TABLES:
+        for referenced, key, natural_key, column in REFERENCED:
+            op.add_column(table, sa.Column(column, sa.String()))
+            op.execute(f"UPDATE {table} SET {column} = {referenced}.{natural_key} "
+                       f"FROM {referenced} WHERE {referenced}.{key} = {table}.{key}")
+            op.alter_column(table, column, nullable=False)
+        for _, key, _, _ in REFERENCED:
+            op.drop_column(table, key)
+    for referenced, key, natural_key, _ in REFERENCED:
+        op.drop_constraint(f"{referenced}_{natural_key}_key", referenced, type_="unique")
+        op.drop_constraint(f"{referenced}_pkey", referenced, type_="primary")
+        op.create_primary_key(f"{referenced}_pkey", referenced, [natural_key])
+    op.create_index("resource_resource_id_idx", "resource", ["resource_id"])
+    for table in RECORD_TABLES:
+        for referenced, _, natural_key, column in REFERENCED:
+            op.create_foreign_key(f"{table}_{column}_{referenced}_fkey", table, referenced, [column], [natural_key],
+                                  onupdate="cascade", ondelete="cascade")
+            op.create_index(f"{table}_{column}_take_date_idx", table, [column, "take_date"])
+    op.execute("""
+        ALTER TABLE record ADD CONSTRAINT record_resource_name_period_excl
+            EXCLUDE USING gist (resource_name WITH =, tstzrange(take_date, return_date, '[]') WITH &&)
+            WHERE (take_date IS NOT NULL)
+    """)
@@ -0,0 +1,86 @@
+"""old record partitions
+
+История броней (old_record) становится секционированной по месяцам return_date таблицей.
+Разделы создаются на каждый месяц, который уже есть в истории, остальное попадает в раздел по умолчанию.
+Дальше разделы создает и отцепляет воркер. return_date входит в первичный ключ и не может быть пустым.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+
+"""
+from datetime import datetime as dt, timezone as tz
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+revision: str = "0008"
+down_revision: Union[str, Sequence[str], None] = "0007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = "record_id, resource_id, visitor_id, take_date, return_date, enqueue_date, created_at, updated_at"
+INDEXES = [
+    ("old_record_resource_id_take_date_idx", ["resource_id", "take_date"]),
+    ("old_record_visitor_id_take_date_idx", ["visitor_id", "take_date"]),
+]
+
+
+def create_old_record_table(partitioned: bool) -> None:
+    op.create_table(
+        "old_record",
+        sa.Column("record_id", sa.Integer(), nullable=False, autoincrement=False),
+        sa.Column("resource_id", sa.Integer(), nullable=False),
+        sa.Column("visitor_id", sa.Integer(), nullable=False),
+        sa.Column("take_date", sa.DateTime(timezone=True)),
+        sa.Column("return_date", sa.DateTime(timezone=True), nullable=not partitioned),
+        sa.Column("enqueue_date", sa.DateTime(timezone=True)),
+        sa.Column("created_at", sa.DateTime(timezone=True)),
+        sa.Column("updated_at", sa.DateTime(timezone=True)),
+        sa.PrimaryKeyConstraint(*(["record_id", "return_date"] if partitioned else ["record_id"]),
+                                name="old_record_pkey"),
+        sa.ForeignKeyConstraint(["resource_id"], ["resource.resource_id"], name="old_record_resource_id_resource_fkey",
+                                ondelete="cascade"),
+        sa.ForeignKeyConstraint(["visitor_id"], ["visitor.visitor_id"], name="old_record_visitor_id_visitor_fkey",
+                                ondelete="cascade"),
+        **({"postgresql_partition_by": "RANGE (return_date)"} if partitioned else {}),
+    )
+    for name, columns in INDEXES:
+        op.create_index(name, "old_record", columns)
+
+
+def replace_old_record_table(partitioned: bool) -> None:
+    """Переименовывает старую таблицу, снимает с нее занятые имена ограничений и индексов и создает новую"""
+    op.rename_table("old_record", "old_record_previous")
+    op.drop_constraint("old_record_pkey", "old_record_previous", type_="primary")
+    op.drop_constraint("old_record_resource_id_resource_fkey", "old_record_previous", type_="foreignkey")
+    op.drop_constraint("old_record_visitor_id_visitor_fkey", "old_record_previous", type_="foreignkey")
+    for name, _ in INDEXES:
+        op.drop_index(name, table_name="old_record_previous")
+    create_old_record_table(partitioned)
+
+
+def upgrade() -> None:
+    op.execute("UPDATE old_record SET return_date = coalesce(updated_at, created_at, take_date, now()) "
+               "WHERE return_date IS NULL")
+    replace_old_record_table(partitioned=True)
+    op.execute("CREATE TABLE old_record_default PARTITION OF old_record DEFAULT")
+    months = op.get_bind().execute(sa.text(
+        "SELECT DISTINCT date_trunc('month', return_date AT TIME ZONE 'UTC') FROM old_record_previous"
+    )).scalars()
+    for month in months:
+        since = month.replace(tzinfo=tz.utc)
+        until = dt(since.year + since.month // 12, since.month % 12 + 1, 1, tzinfo=tz.utc)
+        # Имя должно совпадать с get_old_record_partition_name из adapters/mappings.py
+        op.execute(f"CREATE TABLE old_record_y{since.year:04d}m{since.month:02d} PARTITION OF old_record "
+                   f"FOR VALUES FROM ('{since.isoformat()}') TO ('{until.isoformat()}')")
+    op.execute(f"INSERT INTO old_record ({COLUMNS}) SELECT {COLUMNS} FROM old_record_previous")
+    op.drop_table("old_record_previous")
+
+
+def downgrade() -> None:
+    # Отцепленные воркером разделы в old_record не возвращаются
+    replace_old_record_table(partitioned=False)
+    op.execute(f"INSERT INTO old_record ({COLUMNS}) SELECT {COLUMNS} FROM old_record_previous")
+    op.drop_table("old_record_previous")
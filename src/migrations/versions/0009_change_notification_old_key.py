@@ -0,0 +1,49 @@
+"""change notification old key
+
+Если UPDATE меняет ключ строки (телеграм-айди посетителя), событие об изменении передает и прежнее значение
+в old_key, чтобы процессы убрали из кэша авторизации и его.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "0009"
+down_revision: Union[str, Sequence[str], None] = "0008"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+NOTIFY_CHANGE_FUNCTION = """
+    CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+    DECLARE
+        payload jsonb := jsonb_build_object(
+            'table', TG_TABLE_NAME, 'op', TG_OP, 'version', nextval('change_event_version_seq')
+        );
+    BEGIN
+        IF TG_LEVEL = 'ROW' AND TG_NARGS > 0 THEN
+            payload := payload || jsonb_build_object(
+                'key', (CASE WHEN TG_OP = 'DELETE' THEN to_jsonb(OLD) ELSE to_jsonb(NEW) END) ->> TG_ARGV[0]
+            );{old_key}
+        END IF;
+        PERFORM pg_notify('cache_invalidation', payload::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+OLD_KEY = """
+            IF TG_OP = 'UPDATE' AND (to_jsonb(OLD) ->> TG_ARGV[0]) IS DISTINCT FROM (to_jsonb(NEW) ->> TG_ARGV[0]) THEN
+                payload := payload || jsonb_build_object('old_key', to_jsonb(OLD) ->> TG_ARGV[0]);
+            END IF;"""
+
+
+def upgrade() -> None:
+    # Функция должна совпадать с CREATE_NOTIFY_CHANGE_FUNCTION из adapters/mappings.py
+    op.execute(NOTIFY_CHANGE_FUNCTION.format(old_key=OLD_KEY))
+
+
+def downgrade() -> None:
+    op.execute(NOTIFY_CHANGE_FUNCTION.format(old_key=""))
@@ -0,0 +1,41 @@
+"""
+Кэш телеграм-айди авторизованных посетителей, чтобы NotAuthFilter не ходил в БД на каждое сообщение.
+Первый уровень - память процесса, второй (если включен CACHE_USE_REDIS) - Redis, общий для реплик.
+"""
+from typing import Optional
+
+from adapters.redishelper import get_redis
+from configs.settings import CacheSettings
+from helpers.cache import TieredCache, MISSING
+
+_cache: Optional[TieredCache] = None
+
+
+def _get_cache() -> TieredCache:
+    global _cache
+    if _cache is None:
+        settings = CacheSettings()
+        _cache = TieredCache(
+            prefix="auth:",
+            maxsize=settings.AUTH_CACHE_SIZE,
+            ttl=settings.AUTH_CACHE_TTL,
+            redis=get_redis if settings.CACHE_USE_REDIS else None,
+        )
+    return _cache
+
+
+async def is_authenticated(external_id: int) -> bool:
+    return await _get_cache().get(external_id) is not MISSING
+
+
+async def add(external_id: int) -> None:
+    await _get_cache().set(external_id, True)
+
+
+async def discard(external_id: int) -> None:
+    await _get_cache().delete(external_id)
+
+
+def clear_local() -> None:
+    if _cache is not None:
+        _cache.local.clear()
@@ -0,0 +1,39 @@
+"""
+Кэш приблизительного количества объектов в постраничных выборках (ресурсы категории, поиск, история).
+Количество нужно только для подписи "страница N из ~M", поэтому оно живет до PAGE_COUNT_CACHE_TTL
+и не сбрасывается при изменениях. Первый уровень - память процесса, второй (если включен CACHE_USE_REDIS) - Redis.
+"""
+from typing import Optional
+
+from adapters.redishelper import get_redis
+from configs.settings import CacheSettings
+from helpers.cache import TieredCache, MISSING
+
+_cache: Optional[TieredCache] = None
+
+
+def _get_cache() -> TieredCache:
+    global _cache
+    if _cache is None:
+        settings = CacheSettings()
+        _cache = TieredCache(
+            prefix="count:",
+            maxsize=settings.PAGE_COUNT_CACHE_SIZE,
+            ttl=settings.PAGE_COUNT_CACHE_TTL,
+            redis=get_redis if settings.CACHE_USE_REDIS else None,
+        )
+    return _cache
+
+
+async def get(key: str) -> Optional[int]:
+    count = await _get_cache().get(key)
+    return None if count is MISSING else count
+
+
+async def put(key: str, count: int) -> None:
+    await _get_cache().set(key, count)
+
+
+def clear_local() -> None:
+    if _cache is not None:
+        _cache.local.clear()
@@ -0,0 +1,95 @@
+"""
+Выгрузка истории броней (old_record) в CSV или JSON Lines. Строки читаются с серверного курсора пачками
+и каждая пачка сразу пишется в файл, поэтому выгрузка за год не держит всю историю в памяти.
+"""
+import csv
+import io
+import json
+from datetime import datetime as dt
+from enum import StrEnum
+from typing import AsyncIterator, BinaryIO, List, Optional
+
+from sqlalchemy import Row
+
+from adapters.repository import EXPORT_CHUNK_SIZE
+from service_layer.unit_of_work import UnitOfWork
+
+EXPORT_COLUMNS = ("record_id", "resource_name", "email", "take_date", "return_date", "enqueue_date")
+
+
+class ExportFormat(StrEnum):
+    csv = "csv"
+    jsonl = "jsonl"
+
+
+def _format_value(value):
+    return value.isoformat() if isinstance(value, dt) else value
+
+
+def get_header(export_format: ExportFormat) -> bytes:
+    """Заголовок файла. У JSON Lines его нет: каждая строка - самостоятельный объект"""
+    if export_format == ExportFormat.jsonl:
+        return b""
+    return format_chunk([EXPORT_COLUMNS], export_format)
+
+
+def format_chunk(rows: List[Row], export_format: ExportFormat) -> bytes:
+    """Пачка строк в формате выгрузки"""
+    if export_format == ExportFormat.jsonl:
+        lines = [json.dumps(dict(zip(EXPORT_COLUMNS, map(_format_value, row))), ensure_ascii=False) + "\n"
+                 for row in rows]
+        return "".join(lines).encode()
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([[_format_value(value) for value in row] for row in rows])
+    return buffer.getvalue().encode()
+
+
+async def stream_old_record_rows(
+        since: dt,
+        until: dt,
+        email: Optional[str] = None,
+        resource_name: Optional[str] = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE
+) -> AsyncIterator[List[Row]]:
+    """
+    История, возвращенная с since до until, пачками строк с серверного курсора.
+    Пока генератор не дочитан, его UnitOfWork остается окружающим - другие UnitOfWork
+    в том же контексте присоединятся к нему, поэтому генератор лучше дочитывать сразу
+    """
+    async with UnitOfWork() as uow:
+        async for rows in uow.old_records.stream_export(since, until, email, resource_name, chunk_size):
+            yield rows
+        await uow.commit()
+
+
+async def stream_old_records(
+        export_format: ExportFormat,
+        since: dt,
+        until: dt,
+        email: Optional[str] = None,
+        resource_name: Optional[str] = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """Выгрузка истории кусками байтов: заголовок, затем по куску на пачку строк"""
+    header = get_header(export_format)
+    if header:
+        yield header
+    async for rows in stream_old_record_rows(since, until, email, resource_name, chunk_size):
+        yield format_chunk(rows, export_format)
+
+
+async def write_old_records(
+        file: BinaryIO,
+        export_format: ExportFormat,
+        since: dt,
+        until: dt,
+        email: Optional[str] = None,
+        resource_name: Optional[str] = None
+) -> int:
+    """Пишет выгрузку истории в файл по мере чтения и возвращает количество выгруженных броней"""
+    file.write(get_header(export_format))
+    count = 0
+    async for rows in stream_old_record_rows(since, until, email, resource_name):
+        file.write(format_chunk(rows, export_format))
+        count += len(rows)
+    return count
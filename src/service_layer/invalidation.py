@@ -0,0 +1,59 @@
+"""
+Шина инвалидации кэшей: события об изменениях record, resource и visitor из БД (LISTEN/NOTIFY)
+сбрасывают кэши процесса. Запускается и останавливается вместе с ботом и воркером.
+"""
+import logging
+from typing import Optional
+
+from adapters.change_listener import ChangeListener, ChangeEvent
+from configs.settings import CacheSettings, PGSettings
+from service_layer import auth_cache, schedule_cache
+
+_listener: Optional[ChangeListener] = None
+
+
+async def on_schedule_change(change: ChangeEvent) -> None:
+    schedule_cache.invalidate()
+
+
+async def on_visitor_change(change: ChangeEvent) -> None:
+    """
+    Новых посетителей кэш авторизации добавляет сам, а измененных или удаленных надо из него убрать.
+    Если у посетителя сменился телеграм-айди, убираются и прежний, и новый
+    """
+    if change.op != "INSERT":
+        for key in change.keys:
+            await auth_cache.discard(int(key))
+
+
+async def on_reset() -> None:
+    schedule_cache.invalidate()
+    auth_cache.clear_local()
+
+
+def get_listener() -> Optional[ChangeListener]:
+    return _listener
+
+
+async def start_listener() -> None:
+    global _listener
+    settings = CacheSettings()
+    if not settings.CACHE_INVALIDATION_BUS or _listener is not None:
+        return
+    _listener = ChangeListener(
+        PGSettings().db_connection_dsn(),
+        reconnect_delay=settings.CACHE_INVALIDATION_RECONNECT_DELAY,
+    )
+    _listener.subscribe("record", on_schedule_change)
+    _listener.subscribe("resource", on_schedule_change)
+    _listener.subscribe("visitor", on_visitor_change)
+    _listener.on_reset(on_reset)
+    _listener.start()
+    logging.info("Шина инвалидации кэшей запущена")
+
+
+async def stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        await _listener.stop()
+        _listener = None
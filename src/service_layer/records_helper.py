@@ -1,19 +1,36 @@
-from typing import List, Optional, Tuple
-
-from domain.models import Record, Resource, Visitor
+from datetime import datetime as dt
+from typing import List, Optional, Tuple, Callable, Awaitable
+
+from adapters.loaders import LoadProfile
+from configs.settings import HistorySettings
+from domain.models import Record, Resource, Visitor, Page, OldRecord
+from helpers.helpers import get_time_now, get_month_start
+from service_layer import count_cache
 from service_layer.unit_of_work import UnitOfWork
 
+PAGE_SIZE = 5
+
+_history_settings: Optional[HistorySettings] = None
+
 
-async def get_take_and_future_records(resource_name: str) -> Tuple[Optional[Record], List[Record]]:
-    records = list()
-    take_record = None
+async def _get_total(key: str, count: Callable[[], Awaitable[int]]) -> int:
+    """Приблизительное количество объектов выборки - из кэша или через count"""
+    total = await count_cache.get(key)
+    if total is None:
+        total = await count()
+        await count_cache.put(key, total)
+    return total
+
+
+async def get_take_and_future_records(
+        resource_name: str,
+        as_of: Optional[dt] = None
+) -> Tuple[Optional[Record], List[Record]]:
+    """Текущая и будущие брони ресурса на момент as_of (по умолчанию - сейчас)"""
     async with UnitOfWork() as uow:
-        resource = await uow.resources.get(resource_name)
-        if resource.take_record:
-            take_record = resource.take_record
-        records += resource.future_records
+        take_record, future_records = await uow.records.get_take_and_future(resource_name, as_of or get_time_now())
         await uow.commit()
-    return take_record, sorted(records)
+    return take_record, future_records
 
 
 async def get_resource_by_id(resource_id: int) -> Resource:
@@ -32,7 +49,7 @@ async def get_resource_by_name(name: str) -> Resource:
 
 async def get_record(record_id: int) -> Tuple[Record, Visitor, Resource]:
     async with UnitOfWork() as uow:
-        record = await uow.records.get(record_id)
+        record = await uow.records.get(record_id, LoadProfile.booking)
         visitor = record.visitor
         resource = record.resource
         await uow.commit()
@@ -53,17 +70,15 @@ async def get_visitor(email: str) -> Visitor:
     return visitor
 
 
-async def get_future_reservations_for_resource(resource_name: str) -> List[Record]:
+async def get_future_reservations_for_resource(resource_name: str, as_of: Optional[dt] = None) -> List[Record]:
     async with UnitOfWork() as uow:
-        resource = await uow.resources.get(resource_name)
-        future_records = resource.future_records
+        _, future_records = await uow.records.get_take_and_future(resource_name, as_of or get_time_now())
         await uow.commit()
     return future_records
 
-async def get_future_reservations_for_visitor(email: str) -> List[Record]:
+async def get_future_reservations_for_visitor(email: str, as_of: Optional[dt] = None) -> List[Record]:
     async with UnitOfWork() as uow:
-        visitor = await uow.visitors.get(email)
-        future_records = visitor.future_records
+        _, future_records = await uow.records.get_take_and_future_for_visitor(email, as_of or get_time_now())
         await uow.commit()
     return future_records
 
@@ -74,24 +89,64 @@ async def get_categories() -> List[str]:
     return [i.name for i in categories]
 
 
-async def get_resources_in_category(category: str) -> List[Resource]:
+async def get_resources_in_category(category: str, after: Optional[int] = None, before: Optional[int] = None,
+                                    limit: int = PAGE_SIZE) -> Page:
     async with UnitOfWork() as uow:
-        category = await uow.categories.get(category)
-        resources = category.resources
+        page = await uow.resources.get_page_in_category(category, limit, after, before)
+        page.total = await _get_total(f"category:{category}", lambda: uow.resources.count_in_category(category))
+        await uow.commit()
+    return page
+
+
+async def search_resources(search_key: str) -> List[Resource]:
+    async with UnitOfWork() as uow:
+        resources = await uow.resources.search(search_key)
         await uow.commit()
     return resources
 
-async def get_old_records_by_email(email: str):
+
+async def search_resources_page(search_key: str, after: Optional[int] = None, before: Optional[int] = None,
+                                limit: int = PAGE_SIZE) -> Page:
     async with UnitOfWork() as uow:
-        visitor = await uow.visitors.get(email)
-        old_records = visitor.old_records
+        page = await uow.resources.search_page(search_key, limit, after, before)
+        page.total = await _get_total(f"search:{search_key}", lambda: uow.resources.count_search(search_key))
+        await uow.commit()
+    return page
+
+
+def get_history_since() -> dt:
+    """Начало окна истории: HISTORY_QUERY_MONTHS последних месяцев, включая текущий"""
+    global _history_settings
+    if _history_settings is None:
+        _history_settings = HistorySettings()
+    return get_month_start(get_time_now(), 1 - _history_settings.HISTORY_QUERY_MONTHS)
+
+
+async def get_old_records_by_email(email: str, since: Optional[dt] = None) -> List[OldRecord]:
+    """История посетителя, возвращенная не раньше since (по умолчанию - за окно истории)"""
+    async with UnitOfWork() as uow:
+        old_records = await uow.old_records.list_by_email(email, since or get_history_since(), LoadProfile.history)
         await uow.commit()
     return old_records
 
-async def get_old_records_by_resource_name(resource_name: str):
+
+async def get_old_records_page(email: str, after: Optional[int] = None, before: Optional[int] = None,
+                               limit: int = PAGE_SIZE, since: Optional[dt] = None) -> Page:
+    """Страница истории посетителя, возвращенной не раньше since (по умолчанию - за окно истории)"""
+    since = since or get_history_since()
+    async with UnitOfWork() as uow:
+        page = await uow.old_records.get_page_by_email(email, since, limit, after, before)
+        page.total = await _get_total(f"history:{email}:{since.isoformat()}",
+                                      lambda: uow.old_records.count_by_email(email, since))
+        await uow.commit()
+    return page
+
+async def get_old_records_by_resource_name(resource_name: str, since: Optional[dt] = None) -> List[OldRecord]:
+    """История ресурса, возвращенная не раньше since (по умолчанию - за окно истории)"""
     async with UnitOfWork() as uow:
-        resource = await uow.resources.get(resource_name)
-        old_records = resource.old_records
+        old_records = await uow.old_records.list_by_resource_name(
+            resource_name, since or get_history_since(), LoadProfile.history
+        )
         await uow.commit()
     return old_records
 
@@ -0,0 +1,97 @@
+"""
+Кэш снимка расписания для дашборда. Снимок один для всех посетителей, различаются только их собственные брони.
+Снимок действителен, пока не сменилась версия расписания и не наступил ближайший момент смены статусов
+(окончание текущей брони или начало будущей). Версию увеличивает UnitOfWork после фиксации транзакции,
+которая меняла брони или ресурсы. При CACHE_USE_REDIS версия хранится в Redis и общая для реплик.
+Изменения из других процессов (воркер, ручные правки в БД) приходят через шину service_layer.invalidation
+и сбрасывают локальную часть версии. SCHEDULE_CACHE_TTL ограничивает устаревание, если не работает ни то, ни другое.
+"""
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime as dt
+from typing import Any, Hashable, List, Optional
+
+from redis.exceptions import RedisError
+from sqlalchemy import Row
+
+from adapters.redishelper import get_redis
+from configs.settings import CacheSettings
+from domain.models import StageInfo
+from helpers.cache import TTLCache
+
+VERSION_KEY = "schedule:version"
+
+_settings: Optional[CacheSettings] = None
+_snapshots: Optional[TTLCache] = None
+_local_version = 0
+
+
+@dataclass
+class ScheduleSnapshot:
+    version: Optional[Hashable]
+    rows: List[Row]
+    valid_until: Optional[dt]
+    base_infos: List[StageInfo]
+    rendered: dict[str, Any] = field(default_factory=dict)
+
+    def is_valid(self, now: dt) -> bool:
+        return self.valid_until is None or now < self.valid_until
+
+
+def _get_settings() -> CacheSettings:
+    global _settings
+    if _settings is None:
+        _settings = CacheSettings()
+    return _settings
+
+
+def _get_snapshots() -> TTLCache:
+    global _snapshots
+    if _snapshots is None:
+        _snapshots = TTLCache(maxsize=4, ttl=_get_settings().SCHEDULE_CACHE_TTL)
+    return _snapshots
+
+
+async def get_version() -> Optional[Hashable]:
+    """Текущая версия расписания. None, если ее не удалось узнать - тогда кэшем пользоваться нельзя"""
+    if not _get_settings().CACHE_USE_REDIS:
+        return _local_version
+    try:
+        return int(await get_redis().get(VERSION_KEY) or 0), _local_version
+    except RedisError as e:
+        logging.warning(f"Не удалось прочитать версию расписания из Redis: {e}")
+        return None
+
+
+def invalidate() -> None:
+    """Сбрасывает снимки этого процесса: следующий запрос прочитает расписание из БД"""
+    global _local_version
+    _local_version += 1
+    _get_snapshots().clear()
+
+
+async def bump_version() -> None:
+    invalidate()
+    if not _get_settings().CACHE_USE_REDIS:
+        return
+    try:
+        await get_redis().incr(VERSION_KEY)
+    except RedisError as e:
+        logging.warning(f"Не удалось увеличить версию расписания в Redis: {e}")
+
+
+def get_snapshot(version: Optional[Hashable], now: dt) -> Optional[ScheduleSnapshot]:
+    if version is None:
+        return None
+    snapshot = _get_snapshots().get(version)
+    return snapshot if snapshot is not None and snapshot.is_valid(now) else None
+
+
+def put_snapshot(snapshot: ScheduleSnapshot) -> None:
+    if snapshot.version is not None:
+        _get_snapshots().set(snapshot.version, snapshot)
+
+
+def clear_local() -> None:
+    if _snapshots is not None:
+        _snapshots.clear()
@@ -2,16 +2,27 @@ import copy
 from datetime import datetime as dt, timedelta as td
 from typing import List, Optional, Tuple
 
+from sqlalchemy import Row
+
+from adapters.loaders import LoadProfile
+from adapters.mappings import get_old_record_partition_name
+from configs.settings import HistorySettings
 from domain.models import Record, Resource, Visitor, Status, StageInfo
-from helpers.helpers import get_time_now
+from helpers.helpers import get_time_now, get_month_start
+from service_layer import auth_cache, schedule_cache
 from service_layer.records_helper import get_visitor_by_external_id, get_record
-from service_layer.unit_of_work import UnitOfWork
+from service_layer.schedule_cache import ScheduleSnapshot
+from service_layer.unit_of_work import UnitOfWork, has_pending_schedule_changes
 
 
-async def get_resources_take_and_future_records() -> List[Tuple[Resource, Optional[Record], List[Record]]]:
+async def get_resources_take_and_future_records(
+        as_of: Optional[dt] = None
+) -> List[Tuple[Resource, Optional[Record], List[Record]]]:
+    """Текущая и будущие брони каждого ресурса на момент as_of (по умолчанию - сейчас)"""
     async with UnitOfWork() as uow:
         resources = await uow.resources.list()
-        result = [(i, i.take_record, i.future_records) for i in resources]
+        records_by_resource = await uow.records.get_take_and_future_by_resource(as_of or get_time_now())
+        result = [(i, *records_by_resource.get(i.resource_id, (None, []))) for i in resources]
         await uow.commit()
     return result
 
@@ -29,30 +40,28 @@ def get_last_booked_day_in_row(records: List[Record]) -> dt:
     return last_record.return_date
 
 
-async def get_stage_info_for_visitor(email: str) -> List[StageInfo]:
+def build_stage_infos(rows: List[Row], email: Optional[str]) -> List[StageInfo]:
+    """Статусы стейджей для посетителя. Без email все занятые стейджи считаются чужими"""
     stage_infos = list()
-    for resource, take_record, future_records in await get_resources_take_and_future_records():
+    for row in rows:
         first_booked_day_in_future = None
         last_booked_day_in_row = None
-        if take_record is not None:
-            if take_record.email == email:
+        if row.take_email is not None:
+            if row.take_email == email:
                 status = Status.Yours
             else:
                 status = Status.Others
-                records = list()
-                records.append(take_record)
-                records += future_records
-                last_booked_day_in_row = get_last_booked_day_in_row(records)
-        elif len(future_records) == 0:
+                last_booked_day_in_row = row.last_booked_day_in_row
+        elif row.first_booked_day_in_future is None:
             status = Status.NoOne
         else:
             status = Status.WillBeTaken
-            first_booked_day_in_future = future_records[0].take_date
+            first_booked_day_in_future = row.first_booked_day_in_future
         stage_info = StageInfo(
-            resource_id=resource.resource_id,
-            name=resource.name,
-            current_take_date=None if take_record is None else take_record.take_date,
-            current_return_date=None if take_record is None else take_record.return_date,
+            resource_id=row.resource_id,
+            name=row.name,
+            current_take_date=row.take_date,
+            current_return_date=row.return_date,
             status=status,
             first_booked_day_in_future=first_booked_day_in_future,
             last_booked_day_in_row=last_booked_day_in_row
@@ -61,24 +70,66 @@ async def get_stage_info_for_visitor(email: str) -> List[StageInfo]:
     return stage_infos
 
 
+def get_schedule_valid_until(rows: List[Row], now: dt) -> Optional[dt]:
+    """Ближайший момент, когда сменится чей-то статус: закончится текущая бронь или начнется будущая"""
+    moments = [row.return_date for row in rows if row.take_email is not None]
+    moments += [row.first_booked_day_in_future for row in rows
+                if row.first_booked_day_in_future is not None and row.first_booked_day_in_future > now]
+    return min(moments, default=None)
+
+
+async def get_schedule_snapshot() -> ScheduleSnapshot:
+    """
+    Снимок расписания из кэша, а если он устарел - из БД. Если в незафиксированной транзакции
+    окружающего UnitOfWork менялись брони, снимок читается из нее и в кэш не попадает
+    """
+    now = get_time_now()
+    version = None if has_pending_schedule_changes() else await schedule_cache.get_version()
+    snapshot = schedule_cache.get_snapshot(version, now)
+    if snapshot is not None:
+        return snapshot
+    async with UnitOfWork() as uow:
+        rows = await uow.resources.get_schedule_summary(now)
+        await uow.commit()
+    snapshot = ScheduleSnapshot(
+        version=version,
+        rows=rows,
+        valid_until=get_schedule_valid_until(rows, now),
+        base_infos=build_stage_infos(rows, None),
+    )
+    schedule_cache.put_snapshot(snapshot)
+    return snapshot
+
+
+async def get_stage_snapshot_for_visitor(email: str) -> Tuple[ScheduleSnapshot, List[StageInfo]]:
+    snapshot = await get_schedule_snapshot()
+    return snapshot, build_stage_infos(snapshot.rows, email)
+
+
+async def get_stage_info_for_visitor(email: str) -> List[StageInfo]:
+    _, stage_infos = await get_stage_snapshot_for_visitor(email)
+    return stage_infos
+
+
 async def take_resource(
         resource_name: str,
         visitor_external_id: int,
         since: dt,
         until: dt) -> Tuple[Optional[Resource], Optional[Record], Optional[Record]]:
-    """Возвращает информацию про успешную запись, ресурс и конфликтующую запись"""
+    """
+    Возвращает информацию про успешную запись, ресурс и конфликтующую запись.
+    Пересечение броней проверяет БД (exclusion constraint), поэтому одновременные брони не пройдут обе
+    """
     async with UnitOfWork() as uow:
         resource = await uow.resources.get(resource_name)
         visitor = await uow.visitors.get_by_external_id(visitor_external_id)
-        for record in [i for i in resource.records]:
-            reservation_conflict = record.take_date <= since <= record.return_date \
-                                   or record.take_date <= until <= record.return_date \
-                                   or since <= record.take_date <= until
-            if reservation_conflict:
-                await uow.commit()
-                return resource, None, record
-        record = Record(resource_name=resource_name, email=visitor.email, take_date=since, return_date=until)
-        uow.records.add(record)
+        record = await uow.records.add_if_free(
+            Record(resource.resource_id, visitor.visitor_id, take_date=since, return_date=until)
+        )
+        if record is None:
+            conflict_record = await uow.records.get_overlapping(resource_name, since, until)
+            await uow.commit()
+            return resource, None, conflict_record
         await uow.commit()
     return resource, record, None
 
@@ -99,10 +150,15 @@ async def return_resource(record_id: int, visitor_external_id: int) -> Tuple[Opt
 
 
 async def should_auth(external_id: int) -> bool:
+    """Известных посетителей проверяем по кэшу, без запроса в БД"""
+    if await auth_cache.is_authenticated(external_id):
+        return False
     async with UnitOfWork() as uow:
-        visitor = await uow.visitors.get_by_external_id(external_id)
+        is_known = await uow.visitors.exists_by_external_id(external_id)
         await uow.commit()
-    return visitor is None
+    if is_known:
+        await auth_cache.add(external_id)
+    return not is_known
 
 
 async def auth(
@@ -123,29 +179,60 @@ async def auth(
         visitor.comment = comment
         uow.visitors.add(visitor)
         await uow.commit()
+    # commit фиксирует транзакцию и внутри middleware, поэтому в кэш попадает уже сохраненный посетитель
+    await auth_cache.add(external_id)
     return visitor
 
 
 async def get_all_expired_records() -> List[Record]:
     async with UnitOfWork() as uow:
-        records = await uow.records.get_expired()
+        records = await uow.records.get_expired(LoadProfile.notification)
         await uow.commit()
     return records
 
 
 async def get_all_expiring_records(expire_after_days: int = 2) -> List[Record]:
     async with UnitOfWork() as uow:
-        records = await uow.records.get_expiring(expire_after_days)
+        records = await uow.records.get_expiring(expire_after_days, LoadProfile.notification)
         await uow.commit()
     return records
 
 
-async def delete_records(records):
+async def archive_expired_records() -> List[Row]:
+    """Переносит истекшие брони в историю и возвращает их для уведомлений"""
     async with UnitOfWork() as uow:
-        for record in records:
-            await uow.records.delete(record)
+        rows = await uow.records.archive_expired(get_time_now())
         await uow.commit()
-    return records
+    return rows
+
+
+async def maintain_history_partitions(as_of: Optional[dt] = None) -> Tuple[List[str], List[str]]:
+    """
+    Создает разделы истории на текущий месяц и HISTORY_PARTITIONS_AHEAD месяцев вперед, а разделы
+    старше HISTORY_RETENTION_MONTHS отцепляет (или удаляет). Возвращает созданные и отцепленные разделы
+    """
+    settings = HistorySettings()
+    month = get_month_start(as_of or get_time_now())
+    async with UnitOfWork() as uow:
+        created = list()
+        for i in range(settings.HISTORY_PARTITIONS_AHEAD + 1):
+            if await uow.old_records.create_partition(get_month_start(month, i)):
+                created.append(get_old_record_partition_name(get_month_start(month, i)))
+        detached = []
+        if settings.HISTORY_RETENTION_MONTHS > 0:
+            detached = await uow.old_records.detach_partitions_before(
+                get_month_start(month, -settings.HISTORY_RETENTION_MONTHS), settings.HISTORY_DROP_DETACHED
+            )
+        await uow.commit()
+    return created, detached
+
+
+async def get_expiring_notifications(expire_after_days: int = 2) -> List[Row]:
+    async with UnitOfWork() as uow:
+        rows = await uow.records.get_expiring_notifications(expire_after_days)
+        await uow.commit()
+    return rows
+
 
 # async def change_record(
 #         record_id: int,
@@ -1,9 +1,12 @@
 # pylint: disable=attribute-defined-outside-init
 from abc import ABC, abstractmethod
+from contextvars import ContextVar, Token
+from typing import Optional
 
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState, Session
 
-from adapters.dbhelper import get_engine_async
+from adapters.dbhelper import get_session_factory
 from adapters.repository import (
     VisitorRepository,
     ResourceRepository,
@@ -12,8 +15,11 @@ from adapters.repository import (
     AbstractRecordRepository,
     AbstractCategoryRepository,
     AbstractResourceRepository,
-    AbstractVisitorRepository, OldRecordRepository, AbstractOldRecordRepository
+    AbstractVisitorRepository, OldRecordRepository, AbstractOldRecordRepository,
+    SCHEDULE_CHANGED
 )
+from domain.models import Record, Resource
+from service_layer import schedule_cache
 
 
 class IUnitOfWork(ABC):
@@ -53,15 +59,79 @@ class IUnitOfWork(ABC):
         raise NotImplementedError
 
 
+_ambient_uow: ContextVar[Optional['UnitOfWork']] = ContextVar("ambient_uow", default=None)
+
+
+def _populate_existing(orm_execute_state: ORMExecuteState) -> None:
+    """Сессия живет дольше одного запроса, поэтому объекты из identity map перечитываем из БД"""
+    if orm_execute_state.is_select:
+        orm_execute_state.update_execution_options(populate_existing=True)
+
+
+_SCHEDULE_CLASSES = (Record, Resource)
+
+
+def _track_schedule_statements(orm_execute_state: ORMExecuteState) -> None:
+    """
+    Отмечает сессию, если в ней выполнялся insert/update/delete броней или ресурсов.
+    DML внутри CTE select-запроса (add_if_free, archive_expired) отмечают сами репозитории
+    """
+    is_dml = orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete
+    mapper = orm_execute_state.bind_mapper
+    if is_dml and mapper is not None and issubclass(mapper.class_, _SCHEDULE_CLASSES):
+        orm_execute_state.session.info[SCHEDULE_CHANGED] = True
+
+
+def _has_changed_schedule_objects(session: Session) -> bool:
+    changed = (*session.new, *session.dirty, *session.deleted)
+    return any(isinstance(obj, _SCHEDULE_CLASSES) for obj in changed)
+
+
+def _track_schedule_objects(session: Session, flush_context) -> None:
+    """Отмечает сессию, если при flush менялись брони или ресурсы"""
+    if _has_changed_schedule_objects(session):
+        session.info[SCHEDULE_CHANGED] = True
+
+
+def has_pending_schedule_changes() -> bool:
+    """Менялись ли брони или ресурсы в еще не зафиксированной транзакции окружающего UnitOfWork"""
+    uow = _ambient_uow.get()
+    if uow is None:
+        return False
+    session = uow.session.sync_session
+    return session.info.get(SCHEDULE_CHANGED, False) or _has_changed_schedule_objects(session)
+
+
 class UnitOfWork(IUnitOfWork):
+    """
+    Внешний UnitOfWork открывает сессию и становится окружающим для текущего контекста.
+    Вложенные UnitOfWork (например, сервисные функции внутри middleware) присоединяются к нему
+    и используют ту же сессию. Commit любого из них фиксирует текущую транзакцию сессии: сервисная функция
+    сохраняет изменения до того, как хэндлер ответит пользователю или пойдет в сеть, и не держит блокировки
+    на время этих ожиданий. Следующие запросы открывают в той же сессии новую транзакцию, а владелец сессии
+    откатывает то, что осталось незафиксированным. Если в транзакции менялись брони или ресурсы,
+    после фиксации увеличивается версия расписания, и закэшированный дашборд перестраивается.
+    """
+
     def __init__(self):
-        self.session_factory = async_sessionmaker(
-            bind=get_engine_async(),
-            expire_on_commit=False,
-        )
+        self.session_factory = get_session_factory()
+        self._parent: Optional[UnitOfWork] = None
+        self._token: Optional[Token] = None
+
+    @property
+    def is_joined(self) -> bool:
+        return self._parent is not None
 
     async def __aenter__(self) -> 'UnitOfWork':
-        self.session = self.session_factory()
+        self._parent = _ambient_uow.get()
+        if self.is_joined:
+            self.session = self._parent.session
+        else:
+            self.session = self.session_factory()
+            event.listen(self.session.sync_session, "do_orm_execute", _populate_existing)
+            event.listen(self.session.sync_session, "do_orm_execute", _track_schedule_statements)
+            event.listen(self.session.sync_session, "after_flush", _track_schedule_objects)
+            self._token = _ambient_uow.set(self)
         self.visitors = VisitorRepository(self.session)
         self.resources = ResourceRepository(self.session)
         self.records = RecordRepository(self.session)
@@ -70,14 +140,22 @@ class UnitOfWork(IUnitOfWork):
         return await super().__aenter__()
 
     async def __aexit__(self, *args):
-        await super().__aexit__(*args)
-        await self.session.close()
+        if self.is_joined:
+            return
+        try:
+            await super().__aexit__(*args)
+            await self.session.close()
+        finally:
+            _ambient_uow.reset(self._token)
 
     async def _commit(self):
         await self.session.commit()
+        if self.session.info.pop(SCHEDULE_CHANGED, False):
+            await schedule_cache.bump_version()
 
     async def rollback(self):
         await self.session.rollback()
+        self.session.info.pop(SCHEDULE_CHANGED, None)
 
     async def merge(self, obj):
         await self.session.merge(obj)
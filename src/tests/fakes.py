@@ -26,7 +26,7 @@ class FakeVisitorRepository(AbstractVisitorRepository):
         self.visitors.remove(visitor)
 
     def get_many(self, ids: list) -> 'list[Visitor]':
-        raise NotImplemented
+        return [next((i for i in self.visitors if i.email == key), None) for key in ids]
 
 
 class FakeResourceRepository(AbstractResourceRepository):
@@ -46,7 +46,10 @@ class FakeResourceRepository(AbstractResourceRepository):
         self.resources.remove(resource)
 
     def get_many(self, ids: list) -> 'list[Resource]':
-        raise NotImplemented
+        return [next((i for i in self.resources if i.name == key), None) for key in ids]
+
+    def get_many_by_ids(self, ids: list) -> 'list[Resource]':
+        return [next((i for i in self.resources if i.resource_id == key), None) for key in ids]
 
 
 class FakeRecordRepository(AbstractRecordRepository):
@@ -66,7 +69,7 @@ class FakeRecordRepository(AbstractRecordRepository):
         self.records.remove(record)
 
     def get_many(self, ids: list) -> 'list[Record]':
-        raise NotImplemented
+        return [next((i for i in self.records if i.record_id == key), None) for key in ids]
 
 
 class FakeCategoryRepository(AbstractCategoryRepository):
@@ -86,7 +89,7 @@ class FakeCategoryRepository(AbstractCategoryRepository):
         self.categories.remove(category)
 
     def get_many(self, ids: list) -> 'list[Category]':
-        raise NotImplemented
+        return [next((i for i in self.categories if i.name == key), None) for key in ids]
 
 
 class FakeUnitOfWork(IUnitOfWork):
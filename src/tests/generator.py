@@ -34,13 +34,16 @@ async def gen_record(
 ) -> Record:
     async with UnitOfWork() as uow:
         record = Record(
-            resource_name=resource.name,
-            email=visitor.email,
+            resource_id=resource.resource_id,
+            visitor_id=visitor.visitor_id,
             enqueue_date=enqueue_date,
             take_date=take_date,
             return_date=return_date
         )
         uow.records.add(record)
+        await uow.session.flush()
+        # resource_name и email - подзапросы, после вставки их нужно перечитать
+        await uow.session.refresh(record)
         await uow.commit()
     return record
 
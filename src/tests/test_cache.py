@@ -0,0 +1,32 @@
+import time
+
+from helpers.cache import TTLCache
+
+
+def test_ttl_cache_returns_value_until_expired():
+    cache = TTLCache(maxsize=10, ttl=0.05)
+    cache.set(1, "value")
+    assert cache.get(1) == "value"
+    time.sleep(0.06)
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "one")
+    cache.set(2, "two")
+    cache.get(1)
+    cache.set(3, "three")
+    assert 1 in cache
+    assert 2 not in cache
+    assert 3 in cache
+
+
+def test_ttl_cache_custom_ttl_per_key():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set(1, "short", ttl=0.01)
+    cache.set(2, "long")
+    time.sleep(0.02)
+    assert cache.get(1) is None
+    assert cache.get(2) == "long"
@@ -0,0 +1,68 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import EditMessageReplyMarkup
+
+from domain.models import StageInfo, Status
+from service_layer.schedule_cache import ScheduleSnapshot
+from tg import main_screen, dashboards, tghelper
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = []
+        self.fail = False
+
+    async def edit_message_reply_markup(self, chat_id: int, message_id: int, reply_markup) -> None:
+        if self.fail:
+            raise TelegramBadRequest(EditMessageReplyMarkup(), "message to edit not found")
+        self.edits.append(message_id)
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self.sent = 0
+
+    async def answer(self, text: str, reply_markup=None) -> SimpleNamespace:
+        self.sent += 1
+        return SimpleNamespace(chat=SimpleNamespace(id=1), message_id=100 + self.sent)
+
+
+@pytest.mark.asyncio
+async def test_dashboard_is_edited_in_place_only_when_changed(monkeypatch):
+    infos = [StageInfo(1, "stage1", None, None, Status.NoOne)]
+
+    async def get_visitor(external_id):
+        return SimpleNamespace(email="user@skbkontur.ru")
+
+    async def get_snapshot_and_infos(email):
+        base_infos = [StageInfo(1, "stage1", None, None, Status.NoOne)]
+        return ScheduleSnapshot(version=1, rows=[], valid_until=None, base_infos=base_infos), infos
+
+    monkeypatch.setattr(main_screen, "get_visitor_by_external_id", get_visitor)
+    monkeypatch.setattr(main_screen, "get_stage_snapshot_for_visitor", get_snapshot_and_infos)
+    dashboards.clear_local()
+    bot = FakeBot()
+    message = FakeMessage(bot)
+
+    await main_screen.get_all(message, 1)
+    await main_screen.get_all(message, 1, refresh=True)
+    assert (message.sent, bot.edits) == (1, [])
+
+    now = datetime.now(timezone.utc)
+    infos = [StageInfo(1, "stage1", now, now, Status.Yours)]
+    await main_screen.get_all(message, 1, refresh=True)
+    await main_screen.get_all(message, 1, refresh=True)
+    assert (message.sent, bot.edits) == (1, [101])
+
+    infos = [StageInfo(1, "stage1", None, None, Status.NoOne)]
+    bot.fail = True
+    await main_screen.get_all(message, 1, refresh=True)
+    assert message.sent == 2
+    assert await dashboards.get_last(1) == (1, 102, dashboards.get_digest(tghelper.get_stages_dashboard(infos)))
+
+    await main_screen.get_all(message, 1)
+    assert message.sent == 3
@@ -0,0 +1,22 @@
+import pytest
+from aiogram.fsm.storage.redis import RedisStorage
+
+from configs.settings import RedisConfig
+
+
+def test_fsm_storage_reuses_redis_config():
+    config = RedisConfig(REDIS_HOST="redis", REDIS_PORT=6379, REDIS_DB=11, FSM_STATE_TTL=60, FSM_DATA_TTL=120)
+    storage = config.get_fsm_storage()
+    assert isinstance(storage, RedisStorage)
+    assert storage.state_ttl == 60
+    assert storage.data_ttl == 120
+    kwargs = storage.redis.connection_pool.connection_kwargs
+    assert (kwargs["host"], kwargs["port"], kwargs["db"]) == ("redis", 6379, 11)
+
+
+@pytest.mark.asyncio
+async def test_reservation_data_is_json_serializable():
+    storage = RedisConfig(REDIS_HOST="redis", REDIS_PORT=6379, REDIS_DB=11).get_fsm_storage()
+    data = {"resource_name": "stage", "take_date": "2024-05-01T00:00:00+00:00"}
+    assert storage.json_loads(storage.json_dumps(data)) == data
+    await storage.close()
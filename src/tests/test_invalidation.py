@@ -0,0 +1,125 @@
+import asyncio
+from datetime import timedelta as td
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import text
+
+import adapters.dbhelper
+from adapters.change_listener import ChangeListener
+from configs.settings import PGSettings
+from helpers.helpers import get_time_now
+from service_layer import auth_cache, schedule_cache, invalidation
+from service_layer.service import take_resource, get_schedule_snapshot, should_auth
+from service_layer.unit_of_work import UnitOfWork
+from tests.generator import gen_resource, gen_visitor
+
+
+@pytest_asyncio.fixture(loop_scope="function")
+async def listener():
+    auth_cache.clear_local()
+    schedule_cache.clear_local()
+    await adapters.dbhelper.drop_db_async()
+    await adapters.dbhelper.start_db_async()
+    changes, resets = [], []
+    listener = ChangeListener(PGSettings().db_connection_dsn(), reconnect_delay=0.1)
+
+    async def on_change(change):
+        changes.append(change)
+
+    async def on_reset():
+        resets.append(True)
+
+    for table in ("record", "resource", "visitor"):
+        listener.subscribe(table, on_change)
+    listener.on_reset(on_reset)
+    listener.start()
+    await asyncio.wait_for(listener.connected.wait(), timeout=5)
+    yield listener, changes, resets
+    await listener.stop()
+    adapters.dbhelper.clear_all_mappers()
+    await adapters.dbhelper.drop_db_async()
+    await adapters.dbhelper.dispose_engine_async()
+
+
+async def wait_for(condition, timeout: float = 5) -> None:
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout=timeout)
+
+
+@pytest.mark.asyncio
+async def test_changes_are_broadcast_with_versions(listener):
+    listener, changes, _ = listener
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    await take_resource(resource.name, visitor.external_id, get_time_now(), get_time_now() + td(days=1))
+    async with UnitOfWork() as uow:
+        await uow.execute(text("UPDATE visitor SET external_id = 2 WHERE external_id = 1"))
+        await uow.commit()
+    await wait_for(lambda: len(changes) >= 4)
+    assert [(change.table, change.op) for change in changes[-2:]] == [("record", "INSERT"), ("visitor", "UPDATE")]
+    assert changes[-1].key == "2"
+    versions = [change.version for change in changes]
+    assert versions == sorted(versions) and len(set(versions)) == len(versions)
+    assert listener.version == versions[-1]
+
+
+@pytest.mark.asyncio
+async def test_listener_reconnects_and_resets(listener):
+    listener, changes, resets = listener
+    assert resets == [True]
+    async with adapters.dbhelper.get_engine_async().begin() as conn:
+        await conn.execute(text(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            "WHERE query LIKE 'LISTEN%' AND pid <> pg_backend_pid()"
+        ))
+    await wait_for(lambda: len(resets) == 2)
+    await wait_for(lambda: listener.connected.is_set())
+    await gen_resource(1, name="Стейдж1")
+    await wait_for(lambda: any(change.table == "resource" for change in changes))
+
+
+@pytest.mark.asyncio
+async def test_external_changes_invalidate_process_caches(listener):
+    listener, changes, _ = listener
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    listener.subscribe("record", invalidation.on_schedule_change)
+    listener.subscribe("visitor", invalidation.on_visitor_change)
+    snapshot = await get_schedule_snapshot()
+    assert not await should_auth(visitor.external_id)
+
+    async with adapters.dbhelper.get_engine_async().begin() as conn:
+        await conn.execute(text(
+            "INSERT INTO record (resource_id, visitor_id, take_date, return_date) "
+            "VALUES (:resource_id, :visitor_id, now() - interval '1 day', now() + interval '1 day')"
+        ), {"resource_id": resource.resource_id, "visitor_id": visitor.visitor_id})
+        await conn.execute(text("DELETE FROM visitor WHERE external_id = 1"))
+    await wait_for(lambda: any(change.table == "visitor" and change.op == "DELETE" for change in changes))
+    assert await get_schedule_snapshot() is not snapshot
+    assert await should_auth(visitor.external_id)
+
+
+@pytest.mark.asyncio
+async def test_changed_external_id_is_removed_from_auth_cache(listener):
+    listener, changes, _ = listener
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    handled = asyncio.Event()
+
+    async def on_handled(change):
+        if change.op == "UPDATE":
+            handled.set()
+
+    listener.subscribe("visitor", invalidation.on_visitor_change)
+    listener.subscribe("visitor", on_handled)
+    assert not await should_auth(visitor.external_id)
+
+    async with adapters.dbhelper.get_engine_async().begin() as conn:
+        await conn.execute(text("UPDATE visitor SET external_id = 2 WHERE external_id = 1"))
+    await asyncio.wait_for(handled.wait(), timeout=5)
+    assert [(change.key, change.old_key) for change in changes if change.op == "UPDATE"] == [("2", "1")]
+    assert not await auth_cache.is_authenticated(1)
+    assert await should_auth(1)
@@ -0,0 +1,56 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from tg.middlewares.middlewares import CallbackThrottleMiddleware
+
+
+class FakeCall:
+    def __init__(self, data: str, user_id: int = 1, message_id: int = 10):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=user_id), message_id=message_id)
+        self.answered = False
+
+    async def answer(self) -> None:
+        self.answered = True
+
+
+@pytest.mark.asyncio
+async def test_taps_are_coalesced_to_latest():
+    middleware = CallbackThrottleMiddleware(prefixes=("change_take_date_",), interval=0.2)
+    handled = []
+
+    async def handler(event, data):
+        assert data["event"] is event
+        handled.append((event.data, time.monotonic()))
+
+    first = FakeCall("change_take_date_stage_2")
+    await middleware(handler, first, {"event": first})
+    stale = FakeCall("change_take_date_stage_2")
+    await middleware(handler, stale, {"event": stale})
+    assert stale.answered
+    calls = [FakeCall(f"change_take_date_stage_{i}") for i in (3, 4, 5)]
+    await asyncio.gather(*[middleware(handler, call, {"event": call}) for call in calls])
+    assert [data for data, _ in handled] == ["change_take_date_stage_2", "change_take_date_stage_5"]
+    assert handled[1][1] - handled[0][1] >= 0.19
+    assert calls[0].answered and calls[1].answered and not calls[2].answered
+
+
+@pytest.mark.asyncio
+async def test_other_callbacks_and_users_are_not_throttled():
+    middleware = CallbackThrottleMiddleware(prefixes=("change_take_date_",), interval=10)
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.data)
+
+    await asyncio.wait_for(asyncio.gather(
+        middleware(handler, FakeCall("change_take_date_stage_2", user_id=1), {}),
+        middleware(handler, FakeCall("change_take_date_stage_2", user_id=2), {}),
+        middleware(handler, FakeCall("records_stage", user_id=1), {}),
+        middleware(handler, FakeCall("records_stage", user_id=1), {}),
+    ), timeout=1)
+    assert len(handled) == 4
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramServerError, TelegramNetworkError
+from aiogram.methods import SendMessage
+
+from workers.sender import send_messages, RateLimiter
+
+
+class FakeBot:
+    def __init__(self, retry_after_chats: set = frozenset(), forbidden_chats: set = frozenset(),
+                 server_error_chats: set = frozenset(), network_error_chats: set = frozenset(), retry_after: int = 0):
+        self.sent = list()
+        self.sent_at = dict()
+        self.retry_after = retry_after
+        self.retry_after_chats = set(retry_after_chats)
+        self.forbidden_chats = set(forbidden_chats)
+        self.server_error_chats = set(server_error_chats)
+        self.network_error_chats = set(network_error_chats)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send_message(self, chat_id: int, text: str):
+        method = SendMessage(chat_id=chat_id, text=text)
+        if chat_id in self.forbidden_chats:
+            raise TelegramForbiddenError(method, "bot was blocked by the user")
+        if chat_id in self.retry_after_chats:
+            self.retry_after_chats.remove(chat_id)
+            raise TelegramRetryAfter(method, "Too Many Requests", self.retry_after)
+        if chat_id in self.server_error_chats:
+            self.server_error_chats.remove(chat_id)
+            raise TelegramServerError(method, "Bad Gateway")
+        if chat_id in self.network_error_chats:
+            raise TelegramNetworkError(method, "Request timeout error")
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        self.sent.append((chat_id, text))
+        self.sent_at[chat_id] = asyncio.get_running_loop().time()
+
+
+@pytest.mark.asyncio
+async def test_send_messages_concurrently_with_limit():
+    bot = FakeBot()
+    messages = [(i, f"text {i}") for i in range(20)]
+    sent = await send_messages(bot, messages, concurrency=5, global_rate=1000)
+    assert sent == 20
+    assert sorted(bot.sent) == messages
+    assert 1 < bot.max_in_flight <= 5
+
+
+@pytest.mark.asyncio
+async def test_send_messages_retries_after_retry_after_and_skips_forbidden():
+    bot = FakeBot(retry_after_chats={1}, forbidden_chats={2})
+    sent = await send_messages(bot, [(1, "one"), (2, "two"), (3, "three")], global_rate=1000)
+    assert sent == 2
+    assert sorted(bot.sent) == [(1, "one"), (3, "three")]
+
+
+@pytest.mark.asyncio
+async def test_send_messages_retries_telegram_errors_without_aborting():
+    bot = FakeBot(server_error_chats={1}, network_error_chats={2})
+    sent = await send_messages(bot, [(1, "one"), (2, "two"), (3, "three")], global_rate=1000, chat_rate=1000,
+                               backoff=0.01)
+    assert sent == 2
+    assert sorted(bot.sent) == [(1, "one"), (3, "three")]
+
+
+@pytest.mark.asyncio
+async def test_send_messages_does_not_hold_slot_while_waiting_for_chat():
+    bot = FakeBot()
+    sent = await send_messages(bot, [(1, "first"), (1, "second"), (2, "other")], concurrency=1,
+                               global_rate=1000, chat_rate=5)
+    assert sent == 3
+    assert bot.sent == [(1, "first"), (2, "other"), (1, "second")]
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_all_sends():
+    bot = FakeBot(retry_after_chats={1}, retry_after=1)
+    start = asyncio.get_running_loop().time()
+    sent = await send_messages(bot, [(i, f"text {i}") for i in range(1, 6)], global_rate=1000)
+    assert sent == 5
+    assert all(sent_at - start >= 0.9 for sent_at in bot.sent_at.values())
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spreads_calls():
+    limiter = RateLimiter(rate=100)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*[limiter.acquire() for _ in range(6)])
+    assert loop.time() - start >= 0.05
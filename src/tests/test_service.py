@@ -1,28 +1,46 @@
+import asyncio
+import io
+import json
 from datetime import timedelta as td
 
 import pytest
 import pytest_asyncio
+from sqlalchemy import event, text, select, or_
+from sqlalchemy.exc import InvalidRequestError
 
 import adapters.dbhelper
-from domain.models import Status
+import adapters.repository
+from adapters.loaders import LoadProfile
+from adapters.mappings import get_resource_search_document, is_old_record_partition, get_old_record_partition_name
+from domain.models import Status, Resource, OldRecord, Visitor
 # from datetime import datetime as dt, timezone as tz
-from helpers.helpers import get_time_now
+from helpers.helpers import get_time_now, get_month_start
 from service_layer.records_helper import get_future_reservations_for_resource, \
     get_future_reservations_for_visitor, get_resources_in_category, get_categories, get_old_records_by_email, \
-    get_old_records_by_resource_name
+    get_old_records_by_resource_name, search_resources, search_resources_page, get_old_records_page, get_visitor, \
+    get_visitor_by_external_id
 from service_layer.service import take_resource, return_resource, should_auth, auth, get_all_expired_records, \
     get_all_expiring_records, get_last_booked_day_in_row, get_resources_take_and_future_records, \
-    get_stage_info_for_visitor
+    get_stage_info_for_visitor, archive_expired_records, get_expiring_notifications, get_schedule_snapshot, \
+    get_stage_snapshot_for_visitor, maintain_history_partitions
+from service_layer.export import EXPORT_COLUMNS, ExportFormat, stream_old_records, write_old_records
+from service_layer import auth_cache, schedule_cache, count_cache
+from service_layer.unit_of_work import UnitOfWork
 from tests.generator import gen_resource, gen_visitor, gen_past_time, gen_future_time, gen_record
+from tg.tghelper import get_stages_dashboard, get_stages_dashboard_for_visitor
 
 
 @pytest_asyncio.fixture(loop_scope="function")
 async def db_fixture():
+    auth_cache.clear_local()
+    schedule_cache.clear_local()
+    count_cache.clear_local()
     await adapters.dbhelper.drop_db_async()
     await adapters.dbhelper.start_db_async()
     yield
     adapters.dbhelper.clear_all_mappers()
     await adapters.dbhelper.drop_db_async()
+    await adapters.dbhelper.dispose_engine_async()
 
 
 @pytest.mark.asyncio
@@ -68,13 +86,33 @@ async def test_take_resource_few_times_without_conflict(db_fixture):
     assert records_for_visitor == [record, record2]
 
 
+@pytest.mark.asyncio
+async def test_take_resource_concurrently(db_fixture):
+    resource = await gen_resource(1, name="resource")
+    visitor = await gen_visitor("mnoskov@skbkontur.ru", 1)
+    visitor2 = await gen_visitor("test@skbkontur.ru", 2)
+    since = gen_past_time()
+    until = gen_future_time()
+    results = await asyncio.gather(
+        take_resource(resource.name, visitor.external_id, since, until),
+        take_resource(resource.name, visitor2.external_id, since + td(days=1), until),
+    )
+    records = [record for _, record, _ in results if record is not None]
+    conflict_records = [conflict_record for _, _, conflict_record in results if conflict_record is not None]
+    assert len(records) == 1
+    assert conflict_records == records
+    async with UnitOfWork() as uow:
+        assert len(await uow.records.list()) == 1
+        await uow.commit()
+
+
 @pytest.mark.asyncio
 async def test_get_resources_in_category(db_fixture):
     resource1 = await gen_resource(1, category_name="Принтер", name="1")
     resource2 = await gen_resource(2, category_name="Принтер", name="2")
     resource3 = await gen_resource(3, category_name="ККТ", name="3")
 
-    resources = await get_resources_in_category("Принтер")
+    resources = (await get_resources_in_category("Принтер")).items
     assert len(resources) == 2
     assert resource1 in resources
     assert resource2 in resources
@@ -104,6 +142,33 @@ async def test_auth_new_user(db_fixture):
     assert visitor.external_id == 55
 
 
+@pytest.mark.asyncio
+async def test_should_auth_known_user_without_db(db_fixture):
+    await auth("test@skbkontur.ru", 55, False, 100500, "voyager", "comment")
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = adapters.dbhelper.get_engine_async()
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        assert (await should_auth(55)) is False
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", capture)
+    assert statements == []
+
+
+@pytest.mark.asyncio
+async def test_auth_inside_ambient_unit_of_work_survives_rollback(db_fixture):
+    async with UnitOfWork() as uow:
+        assert await should_auth(55)
+        await auth("test@skbkontur.ru", 55, False, 100500, "voyager", "comment")
+        await uow.rollback()
+    assert (await should_auth(55)) is False
+    assert (await get_visitor_by_external_id(55)).email == "test@skbkontur.ru"
+
+
 @pytest.mark.asyncio
 async def test_auth_user_without_extra_info(db_fixture):
     email = "test@skbkontur.ru"
@@ -145,6 +210,28 @@ async def test_get_all_expiring_records(db_fixture):
     assert records == [record2, record3]
 
 
+@pytest.mark.asyncio
+async def test_archive_expired_records_and_expiring_notifications(db_fixture):
+    resource = await gen_resource(1, name="1")
+    visitor = await gen_visitor("test@skbkontur.ru", 10)
+    expired = await gen_record(resource, visitor, take_date=gen_past_time(), return_date=get_time_now())
+    expiring = await gen_record(await gen_resource(2, name="2"), visitor, take_date=gen_past_time(),
+                                return_date=get_time_now() + td(days=1))
+    expiring_notifications = await get_expiring_notifications(2)
+    assert [(i.record_id, i.resource_name, i.external_id) for i in expiring_notifications] == \
+           [(expiring.record_id, "2", 10)]
+
+    version = await schedule_cache.get_version()
+    archived = await archive_expired_records()
+    assert [(i.record_id, i.resource_name, i.external_id) for i in archived] == [(expired.record_id, "1", 10)]
+    assert await schedule_cache.get_version() != version
+    assert await get_all_expired_records() == []
+    old_records = await get_old_records_by_email(visitor.email)
+    assert [(i.record_id, i.take_date, i.return_date) for i in old_records] == \
+           [(expired.record_id, expired.take_date, expired.return_date)]
+    assert await archive_expired_records() == []
+
+
 @pytest.mark.asyncio
 async def test_old_record_by_visitor(db_fixture):
     resource = await gen_resource(1)
@@ -321,11 +408,504 @@ async def test_get_stage_info_for_visitor(db_fixture):
     assert stage_infos[4].last_booked_day_in_row is None
 
 
+@pytest.mark.asyncio
+async def test_get_stage_info_for_visitor_last_booked_day_in_row(db_fixture):
+    resource = await gen_resource(1, name="Стейдж1")
+    resource2 = await gen_resource(2, name="Стейдж2")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    await gen_visitor("test2@skbkontur.ru", 2)
+    _, record1, _ = await take_resource(resource.name, 1, since=get_time_now() - td(days=1),
+                                        until=get_time_now() + td(days=1))
+    _, record2, _ = await take_resource(resource.name, 2, since=get_time_now() + td(days=2),
+                                        until=get_time_now() + td(days=3))
+    await take_resource(resource.name, 1, since=get_time_now() + td(days=5), until=get_time_now() + td(days=6))
+    _, record4, _ = await take_resource(resource2.name, 1, since=get_time_now() + td(days=2),
+                                        until=get_time_now() + td(days=3))
+
+    stage_infos = await get_stage_info_for_visitor("test2@skbkontur.ru")
+
+    assert stage_infos[0].status == Status.Others
+    assert stage_infos[0].current_take_date == record1.take_date
+    assert stage_infos[0].last_booked_day_in_row == record2.return_date
+    assert stage_infos[1].status == Status.WillBeTaken
+    assert stage_infos[1].first_booked_day_in_future == record4.take_date
+    assert (await get_stage_info_for_visitor(visitor.email))[0].status == Status.Yours
+
+
+@pytest.mark.asyncio
+async def test_repository_queries_use_indexes(db_fixture):
+    resource = await gen_resource(1)
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    _, take_record, _ = await take_resource(resource.name, visitor.external_id, gen_past_time(), gen_future_time())
+    await return_resource(take_record.record_id, visitor.external_id)
+    await take_resource(resource.name, visitor.external_id, gen_past_time(), get_time_now())
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    engine = adapters.dbhelper.get_engine_async()
+    event.listen(engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        await should_auth(visitor.external_id)
+        await get_all_expired_records()
+        await get_all_expiring_records()
+        await get_future_reservations_for_visitor(visitor.email)
+        await get_old_records_by_email(visitor.email)
+        await get_old_records_by_resource_name(resource.name)
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", capture)
+
+    assert len(statements) > 0
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("SET enable_seqscan = off")
+        for statement, parameters in statements:
+            result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            plan = result.scalar()[0]["Plan"]
+            for node in _get_plan_nodes(plan):
+                # Фильтр по таблице должен идти через индекс, а не проверкой каждой строки
+                relation = node.get("Relation Name", "")
+                is_filtered_table = relation in ["record", "old_record", "visitor"] or is_old_record_partition(relation)
+                if is_filtered_table and "Filter" in node:
+                    assert "Index Cond" in node or "Recheck Cond" in node, (statement, plan)
+
+
+@pytest.mark.asyncio
+async def test_get_many_preserves_order_in_one_query(db_fixture):
+    resources = [await gen_resource(i, name=f"Стейдж{i}") for i in range(1, 4)]
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    _, record, _ = await take_resource(resources[0].name, visitor.external_id, gen_past_time(), gen_future_time())
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = adapters.dbhelper.get_engine_async()
+    async with UnitOfWork() as uow:
+        event.listen(engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            names = ["Стейдж3", "нет такого", "Стейдж1", "Стейдж3"]
+            found = await uow.resources.get_many(names)
+            assert [i.name if i else None for i in found] == names[:1] + [None] + names[2:]
+            # Связи без профиля загрузки не подгружаются - ресурсы читаются одним запросом
+            assert len(statements) == 1
+            assert "WHERE resource.name IN" in statements[0]
+            # По первичному ключу уже загруженные ресурсы берутся из identity map, без запроса
+            statements_count = len(statements)
+            await uow.resources.get_many_by_ids([found[0].resource_id, found[2].resource_id])
+            assert len(statements) == statements_count
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", capture)
+        found = await uow.resources.get_many_by_ids([3, 2])
+        assert [i.name for i in found] == ["Стейдж3", "Стейдж2"]
+        assert [i.record_id for i in await uow.records.get_many([record.record_id])] == [record.record_id]
+        assert await uow.visitors.get_many([visitor.email, "nobody@skbkontur.ru"]) == [visitor, None]
+        assert [i.name for i in await uow.categories.get_many(["cat1"])] == ["cat1"]
+        assert await uow.records.get_many([]) == []
+        await uow.commit()
+
+
+def _get_plan_nodes(plan: dict) -> list[dict]:
+    """Все узлы плана запроса из EXPLAIN (FORMAT JSON)"""
+    nodes = [plan]
+    for child in plan.get("Plans", []):
+        nodes += _get_plan_nodes(child)
+    return nodes
+
+
+@pytest.mark.asyncio
+async def test_engine_and_session_factory_are_shared(db_fixture):
+    assert adapters.dbhelper.get_engine_async() is adapters.dbhelper.get_engine_async()
+    async with UnitOfWork() as uow1:
+        pass
+    async with UnitOfWork() as uow2:
+        pass
+    assert uow1.session_factory is uow2.session_factory
+    assert uow1.session is not uow2.session
+
+
+@pytest.mark.asyncio
+async def test_nested_unit_of_work_joins_ambient(db_fixture):
+    resource = await gen_resource(1, name="resource")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    async with UnitOfWork() as uow:
+        async with UnitOfWork() as nested_uow:
+            assert nested_uow.session is uow.session
+        _, record, _ = await take_resource(resource.name, visitor.external_id, gen_past_time(), gen_future_time())
+        record_id = record.record_id
+        assert record_id is not None
+        uow.add(Visitor("rolled_back@skbkontur.ru"))
+        await uow.session.flush()
+        await uow.rollback()
+    # Бронь зафиксировала сервисная функция, а незафиксированное откатил владелец сессии
+    assert (await get_resources_take_and_future_records())[0][1].record_id == record_id
+    assert await get_visitor("rolled_back@skbkontur.ru") is None
+
+
+@pytest.mark.asyncio
+async def test_schedule_snapshot_is_cached_until_bookings_change(db_fixture):
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    snapshot = await get_schedule_snapshot()
+    assert await get_schedule_snapshot() is snapshot
+    await should_auth(visitor.external_id)
+    assert await get_schedule_snapshot() is snapshot
+
+    _, record, _ = await take_resource(resource.name, visitor.external_id, get_time_now() - td(days=1),
+                                       get_time_now() + td(days=1))
+    snapshot = await get_schedule_snapshot()
+    assert snapshot.rows[0].take_email == visitor.email
+    assert snapshot.valid_until == record.return_date
+    assert await get_schedule_snapshot() is snapshot
+
+    async with UnitOfWork() as uow:
+        await uow.records.delete(await uow.records.get(record.record_id))
+        await uow.session.flush()
+        await uow.rollback()
+    assert await get_schedule_snapshot() is snapshot
+
+    await return_resource(record.record_id, visitor.external_id)
+    assert (await get_schedule_snapshot()).rows[0].take_email is None
+
+    await gen_resource(2, name="Стейдж2")
+    assert len((await get_schedule_snapshot()).rows) == 2
+
+
+@pytest.mark.asyncio
+async def test_schedule_snapshot_inside_ambient_unit_of_work(db_fixture):
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    async with UnitOfWork() as uow:
+        snapshot = await get_schedule_snapshot()
+        assert await get_schedule_snapshot() is snapshot
+        await take_resource(resource.name, visitor.external_id, get_time_now() - td(days=1),
+                            get_time_now() + td(days=1))
+        assert (await get_schedule_snapshot()).rows[0].take_email == visitor.email
+        record = (await get_resources_take_and_future_records())[0][1]
+        booked = await get_schedule_snapshot()
+        await uow.records.delete(record)
+        # Снимок, прочитанный до незафиксированного удаления, из кэша уже не отдается
+        snapshot = await get_schedule_snapshot()
+        assert snapshot is not booked and snapshot.rows[0].take_email is None
+    assert (await get_schedule_snapshot()).rows[0].take_email is None
+
+
+@pytest.mark.asyncio
+async def test_cached_dashboard_is_patched_for_visitor(db_fixture):
+    resources = [await gen_resource(i, name=f"Стейдж{i}") for i in range(1, 4)]
+    await gen_visitor("test@skbkontur.ru", 1)
+    await gen_visitor("test2@skbkontur.ru", 2)
+    await take_resource(resources[0].name, 1, get_time_now() - td(days=1), get_time_now() + td(days=1))
+    await take_resource(resources[2].name, 2, get_time_now() - td(days=1), get_time_now() + td(days=3))
+    for email in ("test@skbkontur.ru", "test2@skbkontur.ru", "nobody@skbkontur.ru"):
+        snapshot, infos = await get_stage_snapshot_for_visitor(email)
+        assert get_stages_dashboard_for_visitor(snapshot, infos) == get_stages_dashboard(infos)
+    assert snapshot.rendered["dashboard"] == get_stages_dashboard(infos)
+
+
+@pytest.mark.asyncio
+async def test_search_resources(db_fixture):
+    stage = await gen_resource(1, name="Стейдж-Маркет", comment="Стенд для проверки оплаты")
+    printer = await gen_resource(2, name="Принтер 100%", comment="Стоит у окна")
+    await gen_resource(12, name="Сканер")
+    # Число ищется как айди, а подстрока - без учета регистра по любой из колонок
+    assert await search_resources("2") == [printer]
+    assert await search_resources("маркет") == [stage]
+    assert await search_resources("ОПЛАТ") == [stage]
+    # % в запросе - обычный символ, а не шаблон LIKE
+    assert await search_resources("100%") == [printer]
+    assert await search_resources("1_0") == []
+    # Опечатка находится по похожести слов
+    assert await search_resources("Принтр") == [printer]
+    # Числа, которого нет среди айди, ищется как текст
+    assert await search_resources("100") == [printer]
+    assert await search_resources("  ") == []
+
+
+@pytest.mark.asyncio
+async def test_search_resources_uses_trigram_index(db_fixture):
+    await gen_resource(1, name="Стейдж-Маркет")
+    async with UnitOfWork() as uow:
+        # На пустой таблице планировщику проще прочитать все подряд - запрещаем ему это
+        await uow.session.execute(text("SET LOCAL enable_seqscan = off"))
+        await uow.session.execute(text("SET LOCAL enable_indexscan = off"))
+        document = get_resource_search_document(Resource)
+        query = select(Resource).where(or_(document.ilike("%маркет%"), document.op("%>")("маркет")))
+        plan = await uow.session.execute(text(
+            "EXPLAIN " + str(query.compile(dialect=uow.session.bind.dialect, compile_kwargs={"literal_binds": True}))
+        ))
+        assert "resource_search_trgm_idx" in "\n".join(plan.scalars().all())
+        await uow.commit()
+
+
+@pytest.mark.asyncio
+async def test_get_resources_in_category_by_keyset_pages(db_fixture):
+    for i in range(1, 13):
+        await gen_resource(i, category_name="Принтер", name=f"Принтер{i:02}")
+    await gen_resource(13, category_name="ККТ", name="ККТ")
+
+    pages = [await get_resources_in_category("Принтер", limit=5)]
+    while pages[-1].has_next:
+        pages.append(await get_resources_in_category("Принтер", after=pages[-1].last_key, limit=5))
+    assert [[i.resource_id for i in page.items] for page in pages] == [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10], [11, 12]]
+    assert [(page.has_previous, page.has_next, page.total) for page in pages] == \
+           [(False, True, 12), (True, True, 12), (True, False, 12)]
+
+    back = await get_resources_in_category("Принтер", before=pages[-1].first_key, limit=5)
+    assert [i.resource_id for i in back.items] == [6, 7, 8, 9, 10]
+    assert (back.has_previous, back.has_next) == (True, True)
+    first = await get_resources_in_category("Принтер", before=back.first_key, limit=5)
+    assert [i.resource_id for i in first.items] == [1, 2, 3, 4, 5]
+    assert (first.has_previous, first.has_next) == (False, True)
+    # Курсор на удаленный объект возвращает к первой странице
+    assert [i.resource_id for i in (await get_resources_in_category("Принтер", after=100, limit=5)).items] == \
+           [1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_page_count_is_cached_and_estimated_for_large_results(db_fixture, monkeypatch):
+    for i in range(1, 4):
+        await gen_resource(i, name=f"Стейдж{i}")
+    assert (await search_resources_page("стейдж")).total == 3
+    await gen_resource(4, name="Стейдж4")
+    assert (await search_resources_page("стейдж")).total == 3
+    count_cache.clear_local()
+    assert (await search_resources_page("стейдж")).total == 4
+    # Большие выборки не считаются - количество берется из оценки планировщика
+    monkeypatch.setattr(adapters.repository, "EXACT_COUNT_LIMIT", 0)
+    count_cache.clear_local()
+    assert (await search_resources_page("стейдж")).total >= 1
+    assert (await search_resources_page("it's :key %")).total >= 0
+
+
+@pytest.mark.asyncio
+async def test_search_and_history_by_keyset_pages(db_fixture):
+    for i in range(1, 8):
+        await gen_resource(i, name=f"Стейдж{i}")
+    await gen_resource(8, name="Принтер")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    async with UnitOfWork() as uow:
+        for i in range(1, 8):
+            uow.session.add(OldRecord(record_id=i, resource_id=i, visitor_id=visitor.visitor_id,
+                                      take_date=gen_past_time().replace(year=2000 + i), return_date=get_time_now()))
+        await uow.commit()
+
+    first = await search_resources_page("стейдж", limit=4)
+    second = await search_resources_page("стейдж", after=first.last_key, limit=4)
+    assert [i.name for i in first.items + second.items] == [f"Стейдж{i}" for i in range(1, 8)]
+    assert (second.has_previous, second.has_next, second.total) == (True, False, 7)
+    assert [i.name for i in (await search_resources_page("Стейдж5", limit=4)).items][0] == "Стейдж5"
+
+    history = await get_old_records_page(visitor.email, limit=4)
+    older = await get_old_records_page(visitor.email, after=history.last_key, limit=4)
+    assert [i.record_id for i in history.items] == [7, 6, 5, 4]
+    assert [i.record_id for i in older.items] == [3, 2, 1]
+    assert (older.has_next, older.total) == (False, 7)
+    newer = await get_old_records_page(visitor.email, before=older.first_key, limit=4)
+    assert [i.record_id for i in newer.items] == [7, 6, 5, 4]
+
+
+@pytest.mark.asyncio
+async def test_relationships_are_loaded_only_by_profile(db_fixture):
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    _, record, _ = await take_resource(resource.name, visitor.external_id, gen_past_time(), gen_future_time())
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = adapters.dbhelper.get_engine_async()
+    async with UnitOfWork() as uow:
+        event.listen(engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            plain = await uow.records.get(record.record_id)
+            assert len(statements) == 1
+            with pytest.raises(InvalidRequestError):
+                plain.resource
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", capture)
+        await uow.commit()
+
+    async with UnitOfWork() as uow:
+        booking = await uow.records.get(record.record_id, LoadProfile.booking)
+        assert (booking.resource.name, booking.visitor.email) == (resource.name, visitor.email)
+        with pytest.raises(InvalidRequestError):
+            booking.resource.records
+        dashboard = await uow.resources.get(resource.name, LoadProfile.dashboard)
+        assert dashboard.get_take_and_future_records(get_time_now()) == (record, [])
+        await uow.commit()
+
+
+@pytest.mark.asyncio
+async def test_take_and_future_records_as_of(db_fixture):
+    resource = await gen_resource(1, name="Стейдж1")
+    empty = await gen_resource(2, name="Стейдж2")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    as_of = gen_past_time().replace(microsecond=0)
+    days = [(-20, -15), (-10, -5), (-2, 3), (5, 8), (10, 12)]
+    ids = [(await gen_record(resource, visitor, None, as_of + td(days=i), as_of + td(days=j))).record_id
+           for i, j in days]
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = adapters.dbhelper.get_engine_async()
+    async with UnitOfWork() as uow:
+        event.listen(engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            take_record, future_records = await uow.records.get_take_and_future(resource.name, as_of)
+            assert len(statements) == 1
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", capture)
+        assert (take_record.record_id, [i.record_id for i in future_records]) == (ids[2], ids[3:])
+
+        loaded = await uow.resources.get(resource.name, LoadProfile.dashboard)
+        visitor_loaded = await uow.visitors.get(visitor.email, LoadProfile.dashboard)
+        for moment in [as_of - td(days=30), as_of, as_of + td(days=6), as_of + td(days=30)]:
+            assert await uow.records.get_take_and_future(resource.name, moment) == \
+                   loaded.get_take_and_future_records(moment)
+            assert await uow.records.get_take_and_future_for_visitor(visitor.email, moment) == \
+                   visitor_loaded.get_take_and_future_records(moment)
+        await uow.commit()
+
+    result = {i.name: (take, future) for i, take, future in await get_resources_take_and_future_records(as_of)}
+    assert (result[resource.name][0].record_id, [i.record_id for i in result[resource.name][1]]) == (ids[2], ids[3:])
+    assert result[empty.name] == (None, [])
+    assert [i.record_id for i in await get_future_reservations_for_resource(resource.name, as_of)] == ids[3:]
+    assert [i.record_id for i in await get_future_reservations_for_visitor(visitor.email, as_of)] == ids[3:]
+
+
+@pytest.mark.asyncio
+async def test_records_reference_resource_and_visitor_by_id(db_fixture):
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    _, record, _ = await take_resource(resource.name, visitor.external_id, gen_past_time(), gen_future_time())
+    assert (record.resource_id, record.visitor_id) == (resource.resource_id, visitor.visitor_id)
+    assert (record.resource_name, record.email) == (resource.name, visitor.email)
+
+    async with UnitOfWork() as uow:
+        (await uow.resources.get(resource.name)).name = "Стейдж2"
+        await uow.commit()
+    async with UnitOfWork() as uow:
+        renamed = await uow.records.get(record.record_id)
+        assert (renamed.resource_id, renamed.resource_name) == (resource.resource_id, "Стейдж2")
+        assert (await uow.records.get_take_and_future("Стейдж2", get_time_now()))[0] == record
+        await uow.commit()
+
+    await return_resource(record.record_id, visitor.external_id)
+    history = await get_old_records_page(visitor.email)
+    assert [(i.record_id, i.resource_name, i.email) for i in history.items] == \
+           [(record.record_id, "Стейдж2", visitor.email)]
+
+
+@pytest.mark.asyncio
+async def test_history_partitions_are_created_pruned_and_detached(db_fixture, monkeypatch):
+    monkeypatch.setenv("HISTORY_PARTITIONS_AHEAD", "1")
+    monkeypatch.setenv("HISTORY_RETENTION_MONTHS", "6")
+    monkeypatch.setenv("HISTORY_DROP_DETACHED", "true")
+    resource = await gen_resource(1, name="Стейдж1")
+    visitor = await gen_visitor("test@skbkontur.ru", 1)
+    now = get_time_now()
+    old_month, last_month, this_month = get_month_start(now, -12), get_month_start(now, -1), get_month_start(now)
+    async with UnitOfWork() as uow:
+        for record_id, return_date in [(1, old_month + td(days=3)), (2, now), (3, last_month + td(days=3))]:
+            uow.session.add(OldRecord(record_id=record_id, resource_id=resource.resource_id,
+                                      visitor_id=visitor.visitor_id, take_date=return_date - td(days=1),
+                                      return_date=return_date))
+        await uow.commit()
+    async with UnitOfWork() as uow:
+        # Разделы прошлых месяцев создаются, когда в разделе по умолчанию уже есть их строки
+        assert await uow.old_records.create_partition(old_month)
+        assert await uow.old_records.create_partition(last_month)
+        assert not await uow.old_records.create_partition(old_month)
+        await uow.commit()
+    # Страницы /history тоже ограничены окном истории
+    history = await get_old_records_page(visitor.email)
+    assert ([i.record_id for i in history.items], history.total) == ([2, 3], 2)
+
+    created, detached = await maintain_history_partitions(now)
+    assert created == [get_old_record_partition_name(this_month), get_old_record_partition_name(
+        get_month_start(now, 1))]
+    assert detached == [get_old_record_partition_name(old_month)]
+    assert await maintain_history_partitions(now) == ([], [])
+    async with UnitOfWork() as uow:
+        partitions = await uow.old_records.get_partitions()
+        assert partitions == {"old_record_default": None, get_old_record_partition_name(last_month): last_month,
+                              created[0]: this_month, created[1]: get_month_start(now, 1)}
+        rows = await uow.session.execute(text("SELECT record_id, tableoid::regclass::text FROM old_record"))
+        assert dict(rows.all()) == {2: created[0], 3: get_old_record_partition_name(last_month)}
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        engine = adapters.dbhelper.get_engine_async()
+        event.listen(engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            recent = await uow.old_records.list_by_email(visitor.email, this_month)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", capture)
+        assert [i.record_id for i in recent] == [2]
+        plan = (await uow.session.connection()).exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statements[0][0]}",
+                                                               statements[0][1])
+        relations = {i.get("Relation Name") for i in _get_plan_nodes((await plan).scalar()[0]["Plan"])}
+        # Разделы прошлых месяцев отброшены планировщиком по границе return_date
+        assert created[0] in relations and get_old_record_partition_name(last_month) not in relations
+        await uow.commit()
+    assert [i.record_id for i in await get_old_records_by_email(visitor.email)] == [3, 2]
+    assert [i.record_id for i in await get_old_records_by_resource_name(resource.name, this_month)] == [2]
+
+
+@pytest.mark.asyncio
+async def test_export_old_records_by_chunks(db_fixture):
+    first, second = await gen_resource(1, name="Стейдж1"), await gen_resource(2, name="Стейдж2")
+    visitor, other = await gen_visitor("test@skbkontur.ru", 1), await gen_visitor("other@skbkontur.ru", 2)
+    now = get_time_now()
+    async with UnitOfWork() as uow:
+        for record_id, resource, owner, days in [(1, first, visitor, 3), (2, second, visitor, 2),
+                                                 (3, first, other, 1), (4, first, visitor, 40)]:
+            uow.session.add(OldRecord(record_id=record_id, resource_id=resource.resource_id,
+                                      visitor_id=owner.visitor_id, take_date=now - td(days=days + 1),
+                                      return_date=now - td(days=days)))
+        await uow.commit()
+    since = now - td(days=30)
+
+    chunks = [i async for i in stream_old_records(ExportFormat.csv, since, now, chunk_size=2)]
+    # Заголовок и две пачки по chunk_size строк
+    assert len(chunks) == 3
+    lines = b"".join(chunks).decode().splitlines()
+    assert lines[0] == ",".join(EXPORT_COLUMNS)
+    assert [i.split(",")[:3] for i in lines[1:]] == [["1", "Стейдж1", "test@skbkontur.ru"],
+                                                     ["2", "Стейдж2", "test@skbkontur.ru"],
+                                                     ["3", "Стейдж1", "other@skbkontur.ru"]]
+
+    chunks = [i async for i in stream_old_records(ExportFormat.jsonl, since, now, visitor.email, chunk_size=1)]
+    rows = [json.loads(i) for i in b"".join(chunks).decode().splitlines()]
+    assert len(chunks) == 2 and [i["record_id"] for i in rows] == [1, 2]
+    assert rows[0]["return_date"] == (now - td(days=3)).isoformat()
+
+    file = io.BytesIO()
+    assert await write_old_records(file, ExportFormat.csv, since, now, resource_name=first.name) == 2
+    assert [i.split(",")[0] for i in file.getvalue().decode().splitlines()[1:]] == ["1", "3"]
+    file = io.BytesIO()
+    assert await write_old_records(file, ExportFormat.jsonl, since, now, "missing@skbkontur.ru") == 0
+    assert file.getvalue() == b""
+
+
 #
 @pytest.mark.asyncio
 @pytest.mark.manual
 async def test_drop_db():
     await adapters.dbhelper.drop_db_async()
+    await adapters.dbhelper.dispose_engine_async()
 
 
 @pytest.mark.asyncio
@@ -358,3 +938,5 @@ async def test_create_test_date():
 
     # Status.WillBeTaken
     await take_resource(resource5.name, 1, since=get_time_now() + td(days=11), until=get_time_now() + td(days=30))
+    await adapters.dbhelper.dispose_engine_async()
+
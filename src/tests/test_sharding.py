@@ -0,0 +1,177 @@
+import asyncio
+import multiprocessing
+from contextlib import asynccontextmanager
+
+import pytest
+import pytest_asyncio
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp import ClientSession, web
+
+from configs.settings import WebhookSettings
+from tg.sharding import get_shard, consume, create_front_app, watch_shards
+
+SECRET = "test_secret-1"
+
+
+def get_message_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+def get_callback_update(update_id: int, chat_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "1",
+            "data": "change_take_date_stage",
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "message": get_message_update(update_id, chat_id, "keyboard")["message"],
+        },
+    }
+
+
+def test_updates_of_one_chat_go_to_one_shard():
+    shards = 4
+    assert get_shard(get_message_update(1, 1001, "a"), shards) == get_shard(get_callback_update(2, 1001), shards)
+    assert {get_shard(get_message_update(i, i, "a"), shards) for i in range(100)} == set(range(shards))
+
+
+@pytest.mark.asyncio
+async def test_consume_keeps_order_within_chat():
+    handled = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message) -> None:
+        await asyncio.sleep(0.01 * (5 - int(message.text)))
+        handled.append((message.chat.id, int(message.text)))
+
+    queue = multiprocessing.Queue()
+    for i in range(5):
+        for chat_id in (1, 2, 3):
+            queue.put(get_message_update(i * 3 + chat_id, chat_id, str(i)))
+    queue.put(None)
+    bot = Bot(token="42:TEST")
+    await asyncio.wait_for(consume(queue, bot, dp, max_in_flight=100), timeout=5)
+    await bot.session.close()
+    assert len(handled) == 15
+    for chat_id in (1, 2, 3):
+        assert [i for chat, i in handled if chat == chat_id] == list(range(5))
+    assert handled[:3] != [(1, 0), (1, 1), (1, 2)]
+
+
+@asynccontextmanager
+async def serve_front(queues, processes=(), **settings):
+    settings = WebhookSettings(BOT_MODE="webhook", WEBHOOK_URL="https://example.com", WEBHOOK_SECRET=SECRET,
+                               BOT_SHARDS=len(queues), **settings)
+    runner = web.AppRunner(create_front_app(queues, settings, processes), handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with ClientSession(f"http://127.0.0.1:{port}") as session:
+            yield session
+    finally:
+        await runner.cleanup()
+
+
+@pytest_asyncio.fixture(loop_scope="function")
+async def front():
+    queues = [multiprocessing.Queue() for _ in range(3)]
+    async with serve_front(queues) as session:
+        yield session, queues
+
+
+@pytest.mark.asyncio
+async def test_front_routes_updates_to_shard_queues(front):
+    session, queues = front
+    update = get_message_update(1, 1001, "hello")
+    response = await session.post("/webhook", json=update)
+    assert response.status == 401
+    response = await session.post("/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+    assert response.status == 200
+    assert queues[1001 % 3].get(timeout=1) == update
+    assert all(queue.empty() for queue in queues)
+
+
+class FakeProcess:
+    def __init__(self, alive: bool = True):
+        self.alive = alive
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+
+@pytest.mark.asyncio
+async def test_front_rejects_updates_for_full_queue_and_dead_shard():
+    queues = [multiprocessing.Queue(maxsize=1) for _ in range(2)]
+    processes = [FakeProcess(), FakeProcess()]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    async with serve_front(queues, processes, SHARD_PUT_TIMEOUT=0.1) as session:
+        assert (await session.post("/webhook", json=get_message_update(1, 2, "a"), headers=headers)).status == 200
+        # Очередь шарда заполнена: телеграм получит 503 и повторит апдейт позже
+        assert (await session.post("/webhook", json=get_message_update(2, 2, "b"), headers=headers)).status == 503
+        processes[1].alive = False
+        assert (await session.post("/webhook", json=get_message_update(3, 1, "c"), headers=headers)).status == 503
+        response = await session.get("/health/ready")
+        assert response.status == 503 and (await response.json())["shards"] == [1]
+    assert queues[0].get(timeout=1)["update_id"] == 1
+    assert queues[1].empty()
+
+
+@pytest.mark.asyncio
+async def test_slow_shard_fills_queue_and_front_answers_503():
+    release = asyncio.Event()
+    handled = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message) -> None:
+        await release.wait()
+        handled.append(message.message_id)
+
+    queues = [multiprocessing.Queue(maxsize=1)]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    bot = Bot(token="42:TEST")
+    consumer = asyncio.create_task(consume(queues[0], bot, dp, max_in_flight=1))
+    async with serve_front(queues, SHARD_PUT_TIMEOUT=0.1) as session:
+        statuses = []
+        for i in range(1, 4):
+            response = await session.post("/webhook", json=get_message_update(i, i, "a"), headers=headers)
+            statuses.append(response.status)
+            await asyncio.sleep(0.2)
+        # Первый апдейт обрабатывается, второй ждет в очереди, третьему места нет
+        assert statuses == [200, 200, 503]
+    release.set()
+    await asyncio.get_running_loop().run_in_executor(None, queues[0].put, None)
+    await asyncio.wait_for(consumer, timeout=5)
+    await bot.session.close()
+    assert handled == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_watch_shards_stops_front_when_shard_dies():
+    processes = [FakeProcess(), FakeProcess()]
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_shards(processes, stop, interval=0.01))
+    await asyncio.sleep(0.05)
+    assert not stop.is_set()
+    processes[0].alive = False
+    assert await asyncio.wait_for(watcher, timeout=1) == [0]
+    assert stop.is_set()
+
+
+def test_several_shards_require_webhook_mode():
+    with pytest.raises(ValueError):
+        WebhookSettings(BOT_SHARDS=2)
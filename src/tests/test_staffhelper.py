@@ -0,0 +1,113 @@
+import asyncio
+from typing import Optional
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from helpers import staffhelper
+from helpers.staffhelper import StaffClient
+
+
+class StaffStandIn:
+    """Локальная замена паспорта и Стаффа"""
+
+    def __init__(self, expires_in: Optional[float] = 3600):
+        self.expires_in = expires_in
+        self.token_requests = 0
+        self.search_requests = 0
+        self.valid_tokens = set()
+        self.app = web.Application()
+        self.app.router.add_post("/connect/token", self.token)
+        self.app.router.add_get("/api/Suggest/bytype", self.suggest)
+
+    async def token(self, request: web.Request) -> web.Response:
+        self.token_requests += 1
+        await asyncio.sleep(0.05)
+        token = f"token{self.token_requests}"
+        self.valid_tokens.add(token)
+        if self.expires_in is None:
+            return web.json_response({"access_token": token})
+        return web.json_response({"access_token": token, "expires_in": self.expires_in})
+
+    async def suggest(self, request: web.Request) -> web.Response:
+        self.search_requests += 1
+        if request.headers["Authorization"].removeprefix("Bearer ") not in self.valid_tokens:
+            return web.Response(status=401)
+        if request.query["Q"].startswith("nobody"):
+            return web.json_response({"items": []})
+        return web.json_response({"items": [
+            {"email": f"{request.query['Q']}@skbkontur.ru", "status": "active"},
+            {"email": "old@skbkontur.ru", "status": "dismissed"},
+        ]})
+
+
+@pytest_asyncio.fixture(loop_scope="function")
+async def staff():
+    stand_in = StaffStandIn()
+    runner = web.AppRunner(stand_in.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    client = StaffClient("id", "secret", passport_url=f"http://127.0.0.1:{port}",
+                         staff_url=f"http://127.0.0.1:{port}", http2=False)
+    yield stand_in, client
+    await client.close()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_searches_fetch_token_once(staff):
+    stand_in, client = staff
+    results = await asyncio.gather(*[client.search_emails(f"user{i}") for i in range(50)])
+    assert results[7] == ["user7@skbkontur.ru"]
+    assert stand_in.token_requests == 1
+    assert stand_in.search_requests == 50
+
+
+@pytest.mark.asyncio
+async def test_token_is_refreshed_before_expiration(staff):
+    stand_in, client = staff
+    stand_in.expires_in = 0.2
+    client.refresh_margin = 60
+    await client.search_emails("user")
+    await client.search_emails("user")
+    assert stand_in.token_requests == 1
+    await asyncio.sleep(0.15)
+    await client.search_emails("user")
+    assert stand_in.token_requests == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("expires_in", [None, 30])
+async def test_short_or_missing_lifetime_token_is_reused(staff, expires_in):
+    stand_in, client = staff
+    stand_in.expires_in = expires_in
+    for _ in range(3):
+        await client.search_emails("user")
+    assert stand_in.token_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_revoked_token_is_refreshed_once(staff):
+    stand_in, client = staff
+    await client.search_emails("user")
+    stand_in.valid_tokens.clear()
+    assert await client.search_emails("user") == ["user@skbkontur.ru"]
+    assert stand_in.token_requests == 2
+
+
+@pytest.mark.asyncio
+async def test_search_results_are_cached_including_empty(staff, monkeypatch):
+    stand_in, client = staff
+    monkeypatch.setattr(staffhelper, "_staff_client", client)
+    monkeypatch.setattr(staffhelper, "_search_cache", None)
+    for _ in range(5):
+        assert await staffhelper.search_emails("nobody") == []
+        assert await staffhelper.search_emails("User") == ["User@skbkontur.ru"]
+    assert await staffhelper.search_emails("user") == ["User@skbkontur.ru"]
+    assert stand_in.search_requests == 2
+    staffhelper._get_search_cache().local.clear()
+    assert await staffhelper.search_emails("nobody") == []
+    assert stand_in.search_requests == 3
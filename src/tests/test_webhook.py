@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp import ClientSession, web
+
+from adapters import dbhelper
+from configs.settings import WebhookSettings
+from tg.webhook import create_app
+
+SECRET = "test_secret-1"
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "text": "hello",
+    },
+}
+
+
+@pytest_asyncio.fixture(loop_scope="function")
+async def webhook():
+    handled = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message) -> None:
+        await asyncio.sleep(0.2)
+        handled.append(message.text)
+
+    settings = WebhookSettings(BOT_MODE="webhook", WEBHOOK_URL="https://example.com", WEBHOOK_SECRET=SECRET)
+    runner = web.AppRunner(create_app(Bot(token="42:TEST"), dp, settings), handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    async with ClientSession(f"http://127.0.0.1:{port}") as session:
+        yield session, runner, handled
+    await runner.cleanup()
+    await dbhelper.dispose_engine_async()
+
+
+@pytest.mark.asyncio
+async def test_webhook_rejects_wrong_secret(webhook):
+    session, _, handled = webhook
+    response = await session.post("/webhook", json=UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert response.status == 401
+    response = await session.post("/webhook", json=UPDATE)
+    assert response.status == 401
+    await asyncio.sleep(0.3)
+    assert handled == []
+
+
+@pytest.mark.asyncio
+async def test_webhook_shutdown_waits_for_updates_in_progress(webhook):
+    session, runner, handled = webhook
+    response = await session.post("/webhook", json=UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+    assert response.status == 200
+    assert handled == []
+    await runner.cleanup()
+    assert handled == ["hello"]
+
+
+@pytest.mark.asyncio
+async def test_health_endpoints(webhook):
+    session, _, _ = webhook
+    assert (await session.get("/health/live")).status == 200
+    assert (await session.get("/health/ready")).status == 200
+
+
+def test_webhook_mode_requires_url_and_secret():
+    with pytest.raises(ValueError):
+        WebhookSettings(BOT_MODE="webhook", WEBHOOK_URL="https://example.com")
+    with pytest.raises(ValueError):
+        WebhookSettings(BOT_MODE="webhook", WEBHOOK_URL="https://example.com", WEBHOOK_SECRET="bad secret")
+    settings = WebhookSettings(BOT_MODE="webhook", WEBHOOK_URL="https://example.com/", WEBHOOK_SECRET=SECRET)
+    assert settings.get_webhook_url() == "https://example.com/webhook"
@@ -0,0 +1,50 @@
+"""
+Последнее отправленное пользователю сообщение с занятостью стейджей и хэш его клавиатуры.
+Нужны, чтобы после брони и отмены обновлять это сообщение на месте и не трогать его, если ничего не поменялось.
+"""
+import hashlib
+from typing import Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+from adapters.redishelper import get_redis
+from configs.settings import CacheSettings
+from helpers.cache import TieredCache, MISSING
+
+_cache: Optional[TieredCache] = None
+
+
+def _get_cache() -> TieredCache:
+    global _cache
+    if _cache is None:
+        settings = CacheSettings()
+        _cache = TieredCache(
+            prefix="dashboard:",
+            maxsize=settings.DASHBOARD_CACHE_SIZE,
+            ttl=settings.DASHBOARD_CACHE_TTL,
+            redis=get_redis if settings.CACHE_USE_REDIS else None,
+        )
+    return _cache
+
+
+def get_digest(keyboard: InlineKeyboardMarkup) -> str:
+    return hashlib.sha1(keyboard.model_dump_json().encode()).hexdigest()
+
+
+async def get_last(external_id: int) -> Optional[Tuple[int, int, str]]:
+    """Возвращает chat_id, message_id и хэш клавиатуры последнего дашборда пользователя"""
+    last = await _get_cache().get(external_id)
+    return None if last is MISSING else tuple(last)
+
+
+async def remember(external_id: int, chat_id: int, message_id: int, digest: str) -> None:
+    await _get_cache().set(external_id, [chat_id, message_id, digest])
+
+
+async def forget(external_id: int) -> None:
+    await _get_cache().delete(external_id)
+
+
+def clear_local() -> None:
+    if _cache is not None:
+        _cache.local.clear()
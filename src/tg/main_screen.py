@@ -1,26 +1,39 @@
 import datetime
+import logging
+import os
+import tempfile
 from datetime import timedelta as td, datetime as dt, timezone as tz
 from re import Match
-from typing import List
+from typing import List, Optional, Tuple
 
 from aiogram import F, Router
-from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 
 import helpers.helpers
 from domain.models import Record, Visitor
-from helpers.helpers import get_time_now, format_interval
-from service_layer.records_helper import get_take_and_future_records, get_visitor_by_external_id, get_resource_by_name
-from service_layer.service import get_stage_info_for_visitor, return_resource, take_resource
-from tg import tghelper
+from helpers.helpers import get_time_now, format_interval, get_word_ending
+from service_layer.export import ExportFormat, write_old_records
+from service_layer.records_helper import get_take_and_future_records, get_visitor_by_external_id, get_resource_by_name, \
+    search_resources_page, get_old_records_page, get_history_since
+from service_layer.service import get_stage_snapshot_for_visitor, return_resource, take_resource
+from tg import tghelper, dashboards, strings
 from tg.aiogram_calendar.simple_calendar import SimpleCalendarCallback
-from tg.tghelper import get_stages_dashboard, get_take_keyboard, get_calendar_ru
+from tg.tghelper import get_stages_dashboard_for_visitor, get_take_keyboard, get_calendar_ru, KeysetPaginator, \
+    format_search_page, format_history_page
 
 router = Router()
 
+SEARCH_PAGE_HANDLE = "search"
+HISTORY_PAGE_HANDLE = "history"
+# Запрос повторяется в callback_data кнопок страниц вместе с номером страницы и курсором,
+# а Telegram ограничивает ее 64 байтами
+MAX_SEARCH_QUERY_BYTES = 64 - len(f"{SEARCH_PAGE_HANDLE} 9999 >{2 ** 31 - 1} ")
+
 
 class ReservationOnCalendar(StatesGroup):
     choose_take_date = State()
@@ -34,11 +47,29 @@ async def get_all_handler(message: Message) -> None:
     await get_all(message, message.from_user.id)
 
 
-async def get_all(message: Message, visitor_external_id: int) -> None:
+async def get_all(message: Message, visitor_external_id: int, refresh: bool = False) -> None:
+    """
+    Показывает занятость стейджей. При refresh (после брони или отмены) обновляет последний отправленный дашборд
+    на месте, а если его содержимое не поменялось - ничего не делает. Новое сообщение отправляется, только если
+    прошлого дашборда нет или его уже нельзя отредактировать
+    """
     visitor = await get_visitor_by_external_id(visitor_external_id)
-    info = await get_stage_info_for_visitor(visitor.email)
-    keyboard = get_stages_dashboard(info)
-    await message.answer("Занятость стейджей", reply_markup=keyboard)
+    snapshot, info = await get_stage_snapshot_for_visitor(visitor.email)
+    keyboard = get_stages_dashboard_for_visitor(snapshot, info)
+    digest = dashboards.get_digest(keyboard)
+    last = await dashboards.get_last(visitor_external_id) if refresh else None
+    if last is not None:
+        chat_id, message_id, last_digest = last
+        if last_digest == digest:
+            return
+        try:
+            await message.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=keyboard)
+            await dashboards.remember(visitor_external_id, chat_id, message_id, digest)
+            return
+        except TelegramBadRequest as e:
+            logging.info(f"Не удалось обновить дашборд {message_id} у {visitor_external_id}, отправляем новый: {e}")
+    sent = await message.answer("Занятость стейджей", reply_markup=keyboard)
+    await dashboards.remember(visitor_external_id, sent.chat.id, sent.message_id, digest)
 
 
 @router.callback_query(F.data.regexp(r"^calendar_(\w+)$").as_("match"))
@@ -69,7 +100,7 @@ async def choose_take_date_from_calendar_hanlder(call: CallbackQuery, callback_d
             reply_markup=await calendar.start_calendar()
         )
         return
-    await state.update_data(take_date=take_date)
+    await state.update_data(take_date=take_date.isoformat())
     await state.set_state(ReservationOnCalendar.choose_return_date)
     await call.message.delete()
     await call.message.answer(
@@ -87,7 +118,7 @@ async def choose_return_date_from_calendar_handler(call: CallbackQuery, callback
         return
     return_date = helpers.helpers.reduce_datetime_to_date_utc(date)
     data = await state.get_data()
-    take_date = data["take_date"]
+    take_date = dt.fromisoformat(data["take_date"])
     if return_date < take_date:
         await call.message.delete()
         await call.message.answer(
@@ -95,7 +126,7 @@ async def choose_return_date_from_calendar_handler(call: CallbackQuery, callback
             reply_markup=await calendar.start_calendar()
         )
         return
-    await state.update_data(return_date=return_date)
+    await state.update_data(return_date=return_date.isoformat())
     await state.set_state(ReservationOnCalendar.confirm_reservation)
     resource_name = data["resource_name"]
     await call.message.delete()
@@ -112,11 +143,14 @@ async def confirm_reservation_on_calendar(call: CallbackQuery, state: FSMContext
     if answer == "Да":
         data = await state.get_data()
         resource_name = data["resource_name"]
-        take_date = dt.combine(data["take_date"].date(), datetime.time.min, tz.utc)
-        return_date = dt.combine(data["return_date"].date(), datetime.time.max, tz.utc)
+        take_date = dt.combine(dt.fromisoformat(data["take_date"]).date(), datetime.time.min, tz.utc)
+        return_date = dt.combine(dt.fromisoformat(data["return_date"]).date(), datetime.time.max, tz.utc)
         resource, record, conflict_record = await take_resource(resource_name, call.from_user.id, take_date,
                                                                 return_date)
-        if record is None:
+        if record is None and conflict_record is None:
+            await call.message.delete()
+            await call.message.answer(f"Не удалось забронировать: {resource_name} занят в указанное время")
+        elif record is None:
             await call.message.delete()
             await call.message.answer(
                 f"Не удалось забронировать: {resource_name} занят {format_interval(conflict_record.take_date, conflict_record.return_date, True)} пользователем {conflict_record.email}"
@@ -130,7 +164,7 @@ async def confirm_reservation_on_calendar(call: CallbackQuery, state: FSMContext
         await call.message.delete()
         await call.message.answer("Бронирование отменено")
     await state.clear()
-    await get_all(call.message, call.from_user.id)
+    await get_all(call.message, call.from_user.id, refresh=True)
 
 
 @router.callback_query(F.data.regexp(r"^take_(\w+)$").as_("match"))
@@ -172,7 +206,7 @@ async def cancel_reservation_handler(message: Message, match: Match[str]) -> Non
     await message.answer(
         f"Вы отменили бронь {resource.name}! Запись была {format_interval(record.take_date, record.return_date, True)}"
     )
-    await get_all(message, message.from_user.id)
+    await get_all(message, message.from_user.id, refresh=True)
 
 
 @router.callback_query(F.data.regexp(r"^confirm_days_(\w+)_(\d+)$").as_("match"))
@@ -186,13 +220,13 @@ async def confirm_reservation_handler(call: CallbackQuery, match: Match[str]) ->
     if record is None:
         await call.message.answer(f"Не удалось забронировать: {resource_name} занят в указанное время")
         await call.message.delete()
-        await get_all(call.message, call.from_user.id)
+        await get_all(call.message, call.from_user.id, refresh=True)
         return
     await call.message.answer(
         f"Вы забронировали {resource_name} {format_interval(record.take_date, record.return_date, True)}"
     )
     await call.message.delete()
-    await get_all(call.message, call.from_user.id)
+    await get_all(call.message, call.from_user.id, refresh=True)
 
 
 @router.callback_query(F.data.regexp(r"^records_(\w+)$").as_("match"))
@@ -229,3 +263,105 @@ async def describe_stage_handler(call: CallbackQuery, match: Match[str]) -> None
     resource_name = match.group(1)
     await call.message.delete()
     await call.message.answer(f"Вы отменили бронирование ресурса {resource_name}")
+
+
+def parse_cursor(cursor: str) -> dict:
+    """Разбирает курсор из коллбэка пагинатора: >айди - страница после объекта, <айди - перед ним"""
+    return {"after": int(cursor[1:])} if cursor.startswith(">") else {"before": int(cursor[1:])}
+
+
+@router.message(Command("search"))
+async def search_handler(message: Message, command: CommandObject) -> None:
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Напишите, что искать: /search название, айди, адрес или часть комментария")
+        return
+    if len(query.encode()) > MAX_SEARCH_QUERY_BYTES:
+        await message.answer("Слишком длинный запрос, сократите его")
+        return
+    page = await search_resources_page(query)
+    if len(page.items) == 0:
+        await message.answer(f"По запросу «{query}» ничего не найдено")
+        return
+    paginator = KeysetPaginator(1, page)
+    keyboard = paginator.create_keyboard(SEARCH_PAGE_HANDLE, query)
+    await message.answer(format_search_page(paginator), reply_markup=keyboard)
+
+
+@router.callback_query(F.data.regexp(rf"^{SEARCH_PAGE_HANDLE} (\d+) ([<>]\d+) (.+)$").as_("match"))
+async def search_page_handler(call: CallbackQuery, match: Match[str]) -> None:
+    await call.answer()
+    number, query = int(match.group(1)), match.group(3)
+    page = await search_resources_page(query, **parse_cursor(match.group(2)))
+    if len(page.items) == 0:
+        await call.message.edit_text(f"По запросу «{query}» больше ничего не найдено")
+        return
+    paginator = KeysetPaginator(number if page.has_previous else 1, page)
+    keyboard = paginator.create_keyboard(SEARCH_PAGE_HANDLE, query)
+    await call.message.edit_text(format_search_page(paginator), reply_markup=keyboard)
+
+
+@router.message(Command("history"))
+async def history_handler(message: Message) -> None:
+    visitor = await get_visitor_by_external_id(message.from_user.id)
+    page = await get_old_records_page(visitor.email)
+    if len(page.items) == 0:
+        await message.answer("У вас еще не было завершенных броней")
+        return
+    paginator = KeysetPaginator(1, page)
+    await message.answer(format_history_page(paginator), reply_markup=paginator.create_keyboard(HISTORY_PAGE_HANDLE))
+
+
+@router.callback_query(F.data.regexp(rf"^{HISTORY_PAGE_HANDLE} (\d+) ([<>]\d+) $").as_("match"))
+async def history_page_handler(call: CallbackQuery, match: Match[str]) -> None:
+    await call.answer()
+    visitor = await get_visitor_by_external_id(call.from_user.id)
+    page = await get_old_records_page(visitor.email, **parse_cursor(match.group(2)))
+    if len(page.items) == 0:
+        await call.message.edit_text("У вас еще не было завершенных броней")
+        return
+    paginator = KeysetPaginator(int(match.group(1)) if page.has_previous else 1, page)
+    await call.message.edit_text(format_history_page(paginator),
+                                 reply_markup=paginator.create_keyboard(HISTORY_PAGE_HANDLE))
+
+
+def parse_export_args(args: Optional[str]) -> Tuple[ExportFormat, Optional[str], Optional[str]]:
+    """Аргументы /export: формат (csv или jsonl), почта посетителя или имя ресурса - в любом порядке"""
+    export_format, email, resource_name = ExportFormat.csv, None, None
+    for arg in (args or "").split():
+        if arg.lower() in list(ExportFormat):
+            export_format = ExportFormat(arg.lower())
+        elif "@" in arg:
+            email = arg
+        else:
+            resource_name = arg
+    return export_format, email, resource_name
+
+
+@router.message(Command("export"))
+async def export_handler(message: Message, command: CommandObject) -> None:
+    """
+    Выгружает историю броней за окно истории файлом. Файл пишется на диск по пачкам строк,
+    поэтому бот не держит в памяти всю историю. Админ может выгрузить историю любого посетителя,
+    ресурса или всех сразу, остальные - только свою
+    """
+    visitor = await get_visitor_by_external_id(message.from_user.id)
+    export_format, email, resource_name = parse_export_args(command.args)
+    if not visitor.is_admin:
+        if resource_name is not None or email not in (None, visitor.email):
+            await message.answer(strings.not_admin_error_msg)
+            return
+        email = visitor.email
+    since, until = get_history_since(), get_time_now()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"history_{since:%Y-%m-%d}_{until:%Y-%m-%d}.{export_format}")
+        with open(path, "wb") as file:
+            count = await write_old_records(file, export_format, since, until, email, resource_name)
+        if count == 0:
+            await message.answer("За этот период завершенных броней нет")
+            return
+        await message.answer_document(
+            FSInputFile(path),
+            caption=f"История {format_interval(since, until, True)}: "
+                    f"{count} {get_word_ending(count, ['бронь', 'брони', 'броней'])}"
+        )
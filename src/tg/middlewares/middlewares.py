@@ -0,0 +1,77 @@
+"""
+Middleware, которые оборачивают обработку апдейтов телеграма.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, CallbackQuery
+
+from helpers.cache import TTLCache
+from service_layer.unit_of_work import UnitOfWork
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """
+    Открывает один UnitOfWork на весь апдейт. Сервисные функции, вызванные из фильтров и хэндлеров,
+    присоединяются к нему, а хэндлер может получить его напрямую через аргумент uow.
+    Сервисные функции фиксируют свои изменения сами, до ответа пользователю. После успешной обработки
+    апдейта фиксируется то, что хэндлер сделал через uow напрямую, а при ошибке это откатывается.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        async with UnitOfWork() as uow:
+            data["uow"] = uow
+            result = await handler(event, data)
+            await uow.commit()
+        return result
+
+
+class CallbackThrottleMiddleware(BaseMiddleware):
+    """
+    Сглаживает частые нажатия на кнопки, которые перерисовывают клавиатуру сообщения (например, +/- в выборе дней).
+    Повтор уже отрисованного callback для того же сообщения отбрасывается: это нажатие на устаревшую клавиатуру.
+    Перерисовки одного пользователя идут не чаще раза в interval секунд, а из нажатий, пришедших за время
+    ожидания, обрабатывается только последнее. Регистрируется как outer middleware на callback_query диспетчера,
+    чтобы фильтры роутеров проверялись уже для последнего нажатия.
+    """
+
+    def __init__(self, prefixes: Tuple[str, ...], interval: float = 0.5, maxsize: int = 10000):
+        self.prefixes = prefixes
+        self.interval = interval
+        self._handled = TTLCache(maxsize=maxsize, ttl=60)
+        self._next_slot = TTLCache(maxsize=maxsize, ttl=60)
+        self._latest: Dict[Tuple[int, int], Tuple[CallbackQuery, Dict[str, Any]]] = {}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: CallbackQuery,
+            data: Dict[str, Any]
+    ) -> Any:
+        if event.message is None or not (event.data or "").startswith(self.prefixes):
+            return await handler(event, data)
+        key = (event.message.chat.id, event.message.message_id)
+        if self._handled.get(key) == event.data:
+            await event.answer()
+            return None
+        previous = self._latest.get(key)
+        self._latest[key] = (event, data)
+        if previous is not None:
+            await previous[0].answer()
+            return None
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(event.from_user.id, now))
+        self._next_slot.set(event.from_user.id, slot + self.interval)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        event, data = self._latest.pop(key)
+        self._handled.set(key, event.data)
+        return await handler(event, data)
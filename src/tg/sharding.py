@@ -0,0 +1,171 @@
+"""
+Шардирование обработки апдейтов по процессам.
+Фронтовой процесс принимает вебхук и раскладывает апдейты по очередям шардов по chat_id,
+поэтому все апдейты одного чата попадают в один процесс и обрабатываются в порядке поступления.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import secrets
+from collections import defaultdict
+from multiprocessing.process import BaseProcess
+from typing import Any, Dict, List, Sequence, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+from aiohttp import web
+
+from configs.settings import WebhookSettings
+from tg.webhook import DRAINING, live, ready
+
+SHARD_PROCESSES = web.AppKey("shard_processes", Sequence[BaseProcess])
+
+
+def get_chat_key(update: Dict[str, Any]) -> int:
+    """Чат апдейта, а если его нет (например, inline-запрос) - пользователь"""
+    context = UserContextMiddleware.resolve_event_context(Update.model_validate(update))
+    return context.chat_id or context.user_id or 0
+
+
+def get_shard(update: Dict[str, Any], shards: int) -> int:
+    return get_chat_key(update) % shards
+
+
+class ChatOrderedFeeder:
+    """
+    Передает апдейты в диспетчер конкурентно для разных чатов и строго по очереди внутри одного чата,
+    чтобы переходы FSM одного пользователя не перемешивались. Одновременно принимает не больше
+    max_in_flight апдейтов: следующий берется из очереди только после acquire
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, max_in_flight: int):
+        self.bot = bot
+        self.dp = dp
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = defaultdict(int)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def acquire(self) -> None:
+        """Ждет места для следующего апдейта. Место освобождается после его обработки или release"""
+        await self._in_flight.acquire()
+
+    def release(self) -> None:
+        self._in_flight.release()
+
+    def submit(self, update: Dict[str, Any]) -> None:
+        key = get_chat_key(update)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._pending[key] += 1
+        task = asyncio.create_task(self._feed(key, lock, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _feed(self, key: int, lock: asyncio.Lock, update: Dict[str, Any]) -> None:
+        try:
+            async with lock:
+                await self.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            logging.exception(f"Ошибка при обработке апдейта {update.get('update_id')}")
+        finally:
+            self.release()
+            self._pending[key] -= 1
+            if self._pending[key] == 0:
+                del self._pending[key]
+                del self._locks[key]
+
+    async def wait(self) -> None:
+        """Дожидается всех принятых апдейтов"""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+
+async def consume(queue: multiprocessing.Queue, bot: Bot, dp: Dispatcher, max_in_flight: int) -> None:
+    """
+    Читает апдейты из очереди шарда, пока не придет None, и дожидается их обработки.
+    Пока обрабатываются max_in_flight апдейтов, очередь не читается - она заполняется,
+    и фронт начинает отвечать телеграму 503
+    """
+    feeder = ChatOrderedFeeder(bot, dp, max_in_flight)
+    loop = asyncio.get_running_loop()
+    while True:
+        await feeder.acquire()
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            feeder.release()
+            break
+        feeder.submit(update)
+    await feeder.wait()
+
+
+def get_dead_shards(processes: Sequence[BaseProcess]) -> List[int]:
+    return [i for i, process in enumerate(processes) if not process.is_alive()]
+
+
+async def watch_shards(processes: Sequence[BaseProcess], stop: asyncio.Event, interval: float = 1) -> List[int]:
+    """
+    Следит за процессами шардов, пока не выставлен stop. Если шард упал, апдейты его чатов некому обработать:
+    выставляет stop, чтобы фронт завершился и был перезапущен, и возвращает номера упавших шардов
+    """
+    while not stop.is_set():
+        dead = get_dead_shards(processes)
+        if dead:
+            logging.error(f"Остановились шарды {dead}, фронт завершается")
+            stop.set()
+            return dead
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+    return []
+
+
+async def front_ready(request: web.Request) -> web.Response:
+    """Готовность фронта: все шарды живы, и сам фронт готов"""
+    dead = get_dead_shards(request.app[SHARD_PROCESSES])
+    if dead:
+        return web.json_response({"status": "shards down", "shards": dead}, status=503)
+    return await ready(request)
+
+
+def create_front_app(
+        queues: List[multiprocessing.Queue],
+        settings: WebhookSettings,
+        processes: Sequence[BaseProcess] = ()
+) -> web.Application:
+    """
+    Приложение фронтового процесса: проверяет секрет и кладет апдейт в очередь его шарда.
+    Если очередь шарда заполнена, ответ задерживается не дольше SHARD_PUT_TIMEOUT, после чего фронт
+    отвечает 503, и телеграм повторит апдейт позже. Апдейты для упавшего шарда сразу получают 503
+    """
+    app = web.Application()
+    app[DRAINING] = False
+    app[SHARD_PROCESSES] = processes
+    app.router.add_get("/health/live", live)
+    app.router.add_get("/health/ready", front_ready)
+
+    async def handle(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, settings.WEBHOOK_SECRET):
+            return web.Response(status=401, text="Unauthorized")
+        update = await request.json()
+        shard = get_shard(update, len(queues))
+        if shard < len(processes) and not processes[shard].is_alive():
+            return web.Response(status=503, text="Shard is down")
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: queues[shard].put(update, timeout=settings.SHARD_PUT_TIMEOUT)
+            )
+        except queue.Full:
+            logging.warning(f"Очередь шарда {shard} заполнена, апдейт {update.get('update_id')} отклонен")
+            return web.Response(status=503, text="Shard queue is full")
+        return web.Response()
+
+    async def drain(app: web.Application) -> None:
+        app[DRAINING] = True
+
+    app.router.add_post(settings.WEBHOOK_PATH, handle)
+    app.on_shutdown.append(drain)
+    return app
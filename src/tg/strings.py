@@ -71,12 +71,15 @@ def get_pass_to_user_msg(resource: Resource) -> str:
 
 base_welcome_message = "Чтобы увидеть состояние стейджей, введите команду /all. " \
                       "В колонке 1 будет возможность получить инфу про стейдж, " \
-                      "в колонке 2 - получить список записей, в колонке 3 - забронировать стейдж на нужное время"
+                      "в колонке 2 - получить список записей, в колонке 3 - забронировать стейдж на нужное время. " \
+                      "Найти стейдж по названию, айди, адресу или комментарию можно командой /search, " \
+                      "посмотреть свои прошлые брони - командой /history, а выгрузить их файлом - командой /export"
 
 welcome_msg = "Добро пожаловать в бот для бронирования стейджей!\r\n\r\n" + base_welcome_message
 
-admin_welcome_msg = "Вы властелин стейджей! Пока что у вас только одна дополнительная возможность: " \
-                    "отменять любые записи.\r\n\r\n" + base_welcome_message
+admin_welcome_msg = "Вы властелин стейджей! У вас есть дополнительные возможности: отменять любые записи " \
+                    "и выгружать командой /export историю любого посетителя (/export почта), " \
+                    "стейджа (/export название) или всех сразу.\r\n\r\n" + base_welcome_message
 
 
 def auth_message(user_email: str, is_admin: bool) -> str:
@@ -16,8 +16,9 @@ from aiogram import types
 from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
-from domain.models import Status, StageInfo
-from helpers.helpers import get_word_ending
+from domain.models import Status, StageInfo, Page
+from helpers.helpers import get_word_ending, format_interval
+from service_layer.schedule_cache import ScheduleSnapshot
 from tg.aiogram_calendar.simple_calendar import SimpleCalendar
 
 
@@ -71,6 +72,17 @@ def get_take_keyboard(resource_name: str, number: int = 1) -> InlineKeyboardMark
     return builder.as_markup()
 
 
+def get_status_text(info: StageInfo) -> str:
+    status_text = f"{info.status.value}"
+    if info.status == Status.Yours:
+        status_text += f" до {info.current_return_date.strftime('%d.%m')}"
+    elif info.status == Status.Others:
+        status_text += f" до {info.last_booked_day_in_row.strftime('%d.%m')}"
+    elif info.status is Status.WillBeTaken:
+        status_text += f" с {info.first_booked_day_in_future.strftime('%d.%m')}"
+    return status_text
+
+
 def get_stages_dashboard(infos: list[StageInfo]) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for info in sorted(infos):
@@ -78,15 +90,8 @@ def get_stages_dashboard(infos: list[StageInfo]) -> InlineKeyboardMarkup:
             text=f"{info.name}",
             callback_data=f"resource_name_{info.name}")
         )
-        owner_message = f"{info.status.value}"
-        if info.status == Status.Yours:
-            owner_message += f" до {info.current_return_date.strftime('%d.%m')}"
-        elif info.status == Status.Others:
-            owner_message += f" до {info.last_booked_day_in_row.strftime('%d.%m')}"
-        elif info.status is Status.WillBeTaken:
-            owner_message += f" с {info.first_booked_day_in_future.strftime('%d.%m')}"
         builder.row(types.InlineKeyboardButton(
-            text=owner_message,
+            text=get_status_text(info),
             callback_data=f"records_{info.name}")
         )
         builder.row(types.InlineKeyboardButton(
@@ -97,6 +102,25 @@ def get_stages_dashboard(infos: list[StageInfo]) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+def get_stages_dashboard_for_visitor(snapshot: ScheduleSnapshot, infos: list[StageInfo]) -> InlineKeyboardMarkup:
+    """
+    Базовая клавиатура снимка (все занятые стейджи - чужие) строится один раз и хранится в снимке.
+    Для посетителя в ней заменяются только кнопки статуса его собственных броней
+    """
+    base = snapshot.rendered.get("dashboard")
+    if base is None:
+        base = snapshot.rendered["dashboard"] = get_stages_dashboard(snapshot.base_infos)
+    yours = [(row, info) for row, info in enumerate(sorted(infos)) if info.status == Status.Yours]
+    if not yours:
+        return base
+    inline_keyboard = list(base.inline_keyboard)
+    for row, info in yours:
+        name_button, status_button, take_button = inline_keyboard[row]
+        status_button = status_button.model_copy(update={"text": get_status_text(info)})
+        inline_keyboard[row] = [name_button, status_button, take_button]
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+
 class Paginator:
     """Класс, который по списку объектов формирует срез и клавиатуру"""
     field = 8
@@ -163,3 +187,54 @@ class Paginator:
         count = len(self.objects)
         return f"Всего найден{get_word_ending(count, ['', 'о', 'о'])} " \
                f"{count} результат{get_word_ending(count, ['', 'а', 'ов'])}:\r\n\r\n"
+
+
+class KeysetPaginator(Paginator):
+    """
+    Режим пагинатора для выборки из БД: получает одну уже выбранную страницу (keyset-пагинация)
+    и листает кнопками назад и вперед от ее крайних объектов, а не по номерам страниц.
+    Количество страниц приблизительное - оно считается по приблизительному количеству объектов
+    """
+
+    def __init__(self, page: int, keyset_page: Page, visible_results: int = 5):
+        super().__init__(page, keyset_page.items, visible_results)
+        self.keyset_page = keyset_page
+        self.total = keyset_page.total or len(keyset_page.items)
+        # Оценка может отставать от реальности, но страниц не меньше, чем уже пролистано
+        self.pages = max(math.ceil(self.total / visible_results), page + int(keyset_page.has_next))
+
+    def create_keyboard(self, page_handle: str, query: str = '') -> InlineKeyboardMarkup:
+        """Формирует кнопки назад и вперед: в коллбэке номер страницы и айди крайнего объекта"""
+        builder = InlineKeyboardBuilder()
+        if self.keyset_page.has_previous:
+            builder.button(text="«", callback_data=f"{page_handle} {max(self.page - 1, 1)} "
+                                                    f"<{self.keyset_page.first_key} {query}")
+        if self.keyset_page.has_next:
+            builder.button(text="»", callback_data=f"{page_handle} {self.page + 1} "
+                                                    f">{self.keyset_page.last_key} {query}")
+        builder.adjust(2)
+        return builder.as_markup()
+
+    def get_objects_on_page(self) -> list:
+        return self.objects
+
+    def get_array_indexes(self) -> tuple[int, int]:
+        return 0, len(self.objects) - 1
+
+    def result_message(self) -> str:
+        return f"Всего около {self.total} результат{get_word_ending(self.total, ['а', 'ов', 'ов'])}, " \
+               f"страница {self.page} из {self.pages}:\r\n\r\n"
+
+
+def format_search_page(paginator: Paginator) -> str:
+    """Формирует сообщение со страницей результатов поиска ресурсов"""
+    lines = [f"{i.resource_id}. {i.name}" + (f" ({i.address})" if i.address else "")
+             for i in paginator.get_objects_on_page()]
+    return paginator.result_message() + "\r\n".join(lines)
+
+
+def format_history_page(paginator: Paginator) -> str:
+    """Формирует сообщение со страницей прошлых броней посетителя"""
+    lines = [f"{i.resource_name}: {format_interval(i.take_date, i.return_date, True)}"
+             for i in paginator.get_objects_on_page()]
+    return paginator.result_message() + "\r\n".join(lines)
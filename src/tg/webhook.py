@@ -0,0 +1,98 @@
+"""
+Прием апдейтов через вебхук: aiohttp-приложение с обработчиком aiogram и health-эндпоинтами.
+"""
+import asyncio
+import logging
+import secrets
+from typing import Any, Dict, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+from sqlalchemy import text
+
+from adapters import dbhelper
+from configs.settings import WebhookSettings
+
+DRAINING = web.AppKey("draining", bool)
+
+
+async def live(request: web.Request) -> web.Response:
+    """Процесс жив и отвечает"""
+    return web.json_response({"status": "ok"})
+
+
+async def ready(request: web.Request) -> web.Response:
+    """Готов принимать апдейты: не останавливается и достучался до БД"""
+    if request.app[DRAINING]:
+        return web.json_response({"status": "shutting down"}, status=503)
+    try:
+        async with dbhelper.get_engine_async().connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    except Exception as e:
+        logging.warning(f"Проверка готовности не прошла: {e}")
+        return web.json_response({"status": "db unavailable"}, status=503)
+    return web.json_response({"status": "ok"})
+
+
+def create_app(bot: Bot, dp: Dispatcher, settings: WebhookSettings) -> web.Application:
+    """
+    Собирает приложение. Апдейт обрабатывается в фоне, телеграм получает ответ сразу.
+    Задачи обработки хранятся в приложении: при остановке сначала дожидаемся апдейтов, которые уже
+    обрабатываются, затем закрываем сессию бота и вызываем shutdown-хэндлеры диспетчера
+    """
+    app = web.Application()
+    app[DRAINING] = False
+    app.router.add_get("/health/live", live)
+    app.router.add_get("/health/ready", ready)
+    tasks: Set[asyncio.Task] = set()
+
+    async def feed(update: Dict[str, Any]) -> None:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            logging.exception(f"Ошибка при обработке апдейта {update.get('update_id')}")
+
+    async def handle(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not secrets.compare_digest(token, settings.WEBHOOK_SECRET):
+            return web.Response(status=401, text="Unauthorized")
+        task = asyncio.create_task(feed(await request.json()))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.json_response({})
+
+    async def drain(app: web.Application) -> None:
+        app[DRAINING] = True
+        if tasks:
+            logging.info(f"Ждем завершения {len(tasks)} апдейтов")
+            await asyncio.wait(list(tasks), timeout=settings.WEBHOOK_DRAIN_TIMEOUT)
+        await bot.session.close()
+
+    app.router.add_post(settings.WEBHOOK_PATH, handle)
+    app.on_shutdown.append(drain)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, settings: WebhookSettings, stop: asyncio.Event) -> None:
+    """Регистрирует вебхук в телеграме и обслуживает его, пока не будет выставлен stop"""
+    await bot.set_webhook(
+        url=settings.get_webhook_url(),
+        secret_token=settings.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    await serve(create_app(bot, dp, settings), settings, stop)
+
+
+async def serve(app: web.Application, settings: WebhookSettings, stop: asyncio.Event) -> None:
+    """Запускает aiohttp-приложение и останавливает его, когда выставлен stop"""
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.WEB_SERVER_HOST, settings.WEB_SERVER_PORT)
+    await site.start()
+    logging.info(f"Слушаем вебхук на {settings.WEB_SERVER_HOST}:{settings.WEB_SERVER_PORT}{settings.WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
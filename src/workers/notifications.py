@@ -2,67 +2,77 @@ import logging
 from typing import Any
 
 from aiogram import Bot
-from aiogram.exceptions import TelegramBadRequest
 from arq import cron
 
 from adapters import dbhelper
 from configs.settings import CommonSettings, RedisConfig
-from helpers.helpers import format_interval, format_date, get_time_now, get_word_ending
-from service_layer.records_helper import get_visitor, get_resource_by_name
-from service_layer.service import get_all_expired_records, delete_records, get_all_expiring_records
+from helpers.helpers import format_interval, get_time_now, get_word_ending
+from service_layer import invalidation
+from service_layer.service import archive_expired_records, get_expiring_notifications, maintain_history_partitions
+from workers.sender import send_messages
 
 initialized = False
 
 
-async def remind_about_return_time(ctx: Any) -> None:
+async def initialize() -> None:
     global initialized
     if not initialized:
         logging.basicConfig(
             level=logging.INFO,
             format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
         )
-        await dbhelper.start_db_async()
+        dbhelper.start_mappers()
         initialized = True
+
+
+async def maintain_history(ctx: Any) -> None:
+    """Разделы истории на ближайшие месяцы и отцепление тех, что старше срока хранения"""
+    await initialize()
+    created, detached = await maintain_history_partitions()
+    logging.info(f"Созданы разделы истории: {created or 'нет'}, отцеплены: {detached or 'нет'}")
+
+
+async def remind_about_return_time(ctx: Any) -> None:
+    await initialize()
     bot = Bot(token=CommonSettings().TOKEN)
-    expired_records = await get_all_expired_records()
-    for expired_record in expired_records:
+    try:
         logging.info("Началась обработка expired records")
-        visitor = await get_visitor(expired_record.email)
-        if visitor.external_id is None:
-            continue
-        resource = await get_resource_by_name(expired_record.resource_name)
-        try:
-            await bot.send_message(
-                chat_id=visitor.external_id,
-                text=f"{resource.name} был автоматически освобожден. Ваша запись {format_interval(expired_record.take_date, expired_record.return_date, True)} закончилась"
-            )
-        except TelegramBadRequest:
-            await bot.session.close()
-            continue
-    await delete_records(expired_records)
-    for expiring_record in await get_all_expiring_records():
+        expired_records = await archive_expired_records()
+        messages = [
+            (record.external_id,
+             f"{record.resource_name} был автоматически освобожден. Ваша запись {format_interval(record.take_date, record.return_date, True)} закончилась")
+            for record in expired_records if record.external_id is not None
+        ]
+        sent = await send_messages(bot, messages)
+        logging.info(f"Отправлено {sent} из {len(messages)} уведомлений об освобождении")
+
         logging.info("Началась обработка expiring records")
-        visitor = await get_visitor(expiring_record.email)
-        if visitor.external_id is None:
-            continue
-        resource = await get_resource_by_name(expiring_record.resource_name)
-        days_to_expire = (expiring_record.return_date.date() - get_time_now().date()).days
-        try:
+        messages = list()
+        for record in await get_expiring_notifications():
+            if record.external_id is None:
+                continue
+            days_to_expire = (record.return_date.date() - get_time_now().date()).days
             when = "сегодня" if days_to_expire == 0 else f"через {days_to_expire} {get_word_ending(days_to_expire, ['день', 'дня', 'дней'])}"
-            message = f"Напоминание: {when} надо будет освободить {resource.name}"
-            await bot.send_message(
-                chat_id=visitor.external_id,
-                text=message
-            )
-        except TelegramBadRequest:
-            await bot.session.close()
-            continue
+            messages.append((record.external_id, f"Напоминание: {when} надо будет освободить {record.resource_name}"))
+        sent = await send_messages(bot, messages)
+        logging.info(f"Отправлено {sent} из {len(messages)} напоминаний")
+    finally:
+        await bot.session.close()
 
 
+async def startup(ctx: Any) -> None:
+    await invalidation.start_listener()
+
+
+async def shutdown(ctx: Any) -> None:
+    await invalidation.stop_listener()
+    await dbhelper.dispose_engine_async()
 
 
 class WorkerSettings:
     redis_settings = RedisConfig().get_pool_settings()
+    on_startup = startup
+    on_shutdown = shutdown
     cron_jobs = [
         cron(
             name="reminder",
@@ -73,7 +83,16 @@ class WorkerSettings:
             weekday={0, 1, 2, 3, 4},
             hour=7,
             minute=0
-        )
+        ),
+        cron(
+            name="history_partitions",
+            coroutine=maintain_history,
+            run_at_startup=True,
+            keep_result=True,
+            keep_result_forever=False,
+            hour=3,
+            minute=0
+        ),
         # cron(
         #     name="reminder",
         #     coroutine=remind_about_return_time,
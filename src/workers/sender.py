@@ -0,0 +1,86 @@
+"""
+Массовая рассылка сообщений с учетом лимитов Telegram:
+не больше ~30 сообщений в секунду на бота и одного сообщения в секунду в один чат.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError, TelegramAPIError
+
+GLOBAL_MESSAGES_PER_SECOND = 30
+CHAT_MESSAGES_PER_SECOND = 1
+MAX_CONCURRENCY = 20
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 1
+
+
+class RateLimiter:
+    """Равномерно распределяет вызовы acquire: не больше rate вызовов в секунду"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_time = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Следующий вызов acquire пройдет не раньше, чем через seconds секунд"""
+        self._next_time = max(self._next_time, asyncio.get_running_loop().time() + seconds)
+
+
+async def send_messages(
+        bot: Bot,
+        messages: List[Tuple[int, str]],
+        concurrency: int = MAX_CONCURRENCY,
+        global_rate: float = GLOBAL_MESSAGES_PER_SECOND,
+        chat_rate: float = CHAT_MESSAGES_PER_SECOND,
+        backoff: float = RETRY_BACKOFF
+) -> int:
+    """
+    Отправляет сообщения (chat_id, text) параллельно и возвращает количество доставленных.
+    Ошибка одного сообщения не прерывает рассылку: сетевые ошибки и ошибки сервера телеграма
+    повторяются с растущей паузой, флуд-лимит телеграма приостанавливает всю рассылку,
+    а после MAX_ATTEMPTS попыток сообщение считается неотправленным
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    global_limiter = RateLimiter(global_rate)
+    chat_limiters: Dict[int, RateLimiter] = dict()
+
+    async def send(chat_id: int, text: str) -> bool:
+        chat_limiter = chat_limiters.setdefault(chat_id, RateLimiter(chat_rate))
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            # Очередь в чат ждем до того, как занять слот, чтобы ожидание одного чата не задерживало другие
+            await chat_limiter.acquire()
+            async with semaphore:
+                await global_limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text)
+                    return True
+                except TelegramRetryAfter as e:
+                    # Флуд-лимит общий на бота: ждут все отправки, а не только эта
+                    logging.warning(f"Телеграм просит подождать {e.retry_after} с перед отправкой в {chat_id}")
+                    global_limiter.pause(e.retry_after)
+                    delay = 0
+                except (TelegramBadRequest, TelegramForbiddenError) as e:
+                    logging.warning(f"Не удалось отправить сообщение в {chat_id}: {e.message}")
+                    return False
+                except TelegramAPIError as e:
+                    # В том числе TelegramNetworkError и TelegramServerError
+                    logging.warning(f"Ошибка при отправке сообщения в {chat_id} (попытка {attempt}): {e.message}")
+                    delay = backoff * 2 ** (attempt - 1)
+            if attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(delay)
+        logging.error(f"Сообщение в {chat_id} не отправлено после {MAX_ATTEMPTS} попыток")
+        return False
+
+    results = await asyncio.gather(*[send(chat_id, text) for chat_id, text in messages])
+    return sum(results)